@@ -4,3 +4,12 @@ from django.apps import AppConfig
 class ApiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'autocompany.api'
+
+    def ready(self):
+        # Connects the signals which keep the token cache up to date and
+        # instrument new connections, and registers the system checks
+        from autocompany.api import (  # noqa: F401
+            authentication,
+            checks,
+            metrics,
+        )
@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+
+__author__ = "Surya Banerjee"
+
+from calendar import timegm
+from collections import defaultdict
+
+from asgiref.sync import sync_to_async
+from django.http import HttpResponse, HttpResponseNotAllowed
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+from rest_framework import exceptions, status
+from rest_framework.authentication import get_authorization_header
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+
+from autocompany.api.authentication import CachedTokenAuthentication
+from autocompany.api.cache import get_product_cache, uncached_products
+from autocompany.api.fast_serializers import ValuesSerializer
+from autocompany.api.metrics import timed
+from autocompany.api.models import Product, Cart, CartItem, CatalogVersion
+from autocompany.api.pagination import ProductCursorPagination
+from autocompany.api.serializers import (
+    CartSerializer,
+    ProductListSerializer,
+    ProductDetailSerializer,
+)
+from autocompany.api.stock import product_stock
+
+# Django 4.0 has no async ORM yet, so every database access runs through
+# sync_to_async. Under ASGI each request gets its own thread for these
+# calls, so a slow query only blocks the request waiting for it, never the
+# event loop.
+
+renderer = JSONRenderer()
+list_rows = ValuesSerializer(ProductListSerializer)
+detail_rows = ValuesSerializer(ProductDetailSerializer)
+cart_rows = ValuesSerializer(
+    CartSerializer,
+    fields=[
+        name for name in CartSerializer.Meta.fields if name != "items"
+    ],
+)
+
+
+def render(data, status_code=status.HTTP_200_OK, headers=None):
+    with timed("render"):
+        content = renderer.render(data)
+    response = HttpResponse(
+        content, status=status_code, content_type=renderer.media_type
+    )
+    for name, value in (headers or {}).items():
+        response.headers[name] = value
+    return response
+
+
+def render_exception(exc):
+    headers = {}
+    if isinstance(
+        exc, (exceptions.NotAuthenticated, exceptions.AuthenticationFailed)
+    ):
+        headers["WWW-Authenticate"] = CachedTokenAuthentication.keyword
+    data = exc.detail
+    if not isinstance(data, (list, dict)):
+        data = {"detail": data}
+    return render(data, exc.status_code, headers)
+
+
+def async_api_view(view):
+    """
+    Restrict an async view to GET and turn API exceptions into JSON errors,
+    the way DRF does for the sync views
+    """
+
+    async def wrapper(request, *args, **kwargs):
+        if request.method not in ("GET", "HEAD"):
+            return HttpResponseNotAllowed(["GET", "HEAD"])
+        try:
+            return await view(request, *args, **kwargs)
+        except exceptions.APIException as exc:
+            return render_exception(exc)
+
+    wrapper.__name__ = view.__name__
+    wrapper.__doc__ = view.__doc__
+    return wrapper
+
+
+async def authenticate(request):
+    """
+    Return the user of the token in the Authorization header. Tokens found
+    in the in-process cache are answered straight away, the lookup of any
+    other token runs off the event loop.
+    """
+    auth = get_authorization_header(request).split()
+    keyword = CachedTokenAuthentication.keyword.lower().encode()
+    if not auth or auth[0].lower() != keyword:
+        raise exceptions.NotAuthenticated()
+    if len(auth) != 2:
+        raise exceptions.AuthenticationFailed("Invalid token header.")
+    try:
+        key = auth[1].decode()
+    except UnicodeError:
+        raise exceptions.AuthenticationFailed("Invalid token header.")
+
+    authentication = CachedTokenAuthentication()
+    credentials = authentication.cached_credentials(key)
+    if credentials is None:
+        credentials = await sync_to_async(
+            authentication.authenticate_credentials
+        )(key)
+    return credentials[0]
+
+
+def conditional_response(request, etag, updated_at):
+    """
+    Return a 304 if the client already has this version, otherwise None,
+    along with the validator headers every answer carries
+    """
+    last_modified = timegm(updated_at.utctimetuple())
+    response = get_conditional_response(
+        request, etag=etag, last_modified=last_modified
+    )
+    headers = {"ETag": etag, "Last-Modified": http_date(last_modified)}
+    return response, headers
+
+
+def product_page(request):
+    paginator = ProductCursorPagination()
+    rows = list_rows.values(Product.objects.all())
+    page = paginator.paginate_queryset(rows, Request(request))
+    return paginator.get_paginated_response(list_rows.serialize(page)).data
+
+
+def product_detail(pk):
+    row = Product.objects.values(*detail_rows.fields).filter(pk=pk).first()
+    if row is None:
+        raise exceptions.NotFound()
+    return detail_rows.to_representation(row)
+
+
+def stock_or_404(pk):
+    stock = product_stock(pk)
+    if stock is None:
+        raise exceptions.NotFound()
+    return stock
+
+
+@async_api_view
+async def product_list(request):
+    """
+    Async version of GET /api/product/, answering with the same body
+    """
+    cache = get_product_cache() or uncached_products
+    version, updated_at = await sync_to_async(cache.get_catalog_version)(
+        CatalogVersion.current
+    )
+    etag = f'"catalog-{version}-json"'
+    response, headers = conditional_response(request, etag, updated_at)
+    if response is None:
+        data = await sync_to_async(cache.get_list)(
+            version,
+            request.build_absolute_uri(),
+            lambda: product_page(request),
+        )
+        response = render(data)
+
+    for name, value in headers.items():
+        response.headers[name] = value
+    return response
+
+
+@async_api_view
+async def product_retrieve(request, pk):
+    """
+    Async version of GET /api/product/<pk>/, answering with the same body
+    """
+    cache = get_product_cache() or uncached_products
+    stock, updated_at, catalog_version = await sync_to_async(
+        cache.get_stock
+    )(pk, lambda: stock_or_404(pk))
+    version = int(updated_at.timestamp() * 1000000)
+    etag = f'"{pk}-{version}-json"'
+    response, headers = conditional_response(request, etag, updated_at)
+    if response is None:
+        data = await sync_to_async(cache.get_detail)(
+            pk, catalog_version, lambda: product_detail(pk)
+        )
+        response = render(dict(data, stock=stock))
+
+    for name, value in headers.items():
+        response.headers[name] = value
+    return response
+
+
+def load_carts(user, pk=None):
+    """
+    Serialize the carts of a user with their items, in two queries
+    """
+    carts = Cart.objects.filter(user=user)
+    if pk is not None:
+        carts = carts.filter(pk=pk)
+    carts = cart_rows.serialize(cart_rows.values(carts))
+
+    items = defaultdict(list)
+    lines = CartItem.objects.filter(
+        cart_id__in=[cart["pk"] for cart in carts]
+    ).values_list("cart_id", "product_id", "quantity", "unit_price")
+    for cart_pk, product_pk, quantity, unit_price in lines:
+        items[cart_pk].append(
+            {"product": product_pk, "quantity": quantity,
+             "unit_price": unit_price}
+        )
+
+    for cart in carts:
+        cart["items"] = items[cart["pk"]]
+    return carts
+
+
+@async_api_view
+async def cart_list(request):
+    """
+    Async version of GET /api/cart/
+    """
+    user = await authenticate(request)
+    return render(await sync_to_async(load_carts)(user))
+
+
+@async_api_view
+async def cart_retrieve(request, pk):
+    """
+    Async version of GET /api/cart/<pk>/
+    """
+    user = await authenticate(request)
+    carts = await sync_to_async(load_carts)(user, pk)
+    if not carts:
+        raise exceptions.NotFound()
+    return render(carts[0])
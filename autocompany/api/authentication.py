@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+
+__author__ = "Surya Banerjee"
+
+import copy
+
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+
+from autocompany.api.cache import get_token_cache
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """
+    Token authentication that remembers which user a token belongs to, so
+    repeated requests with the same token skip the Token and User query.
+
+    Behaves like TokenAuthentication when TOKEN_CACHE is disabled.
+    """
+
+    def authenticate_credentials(self, key):
+        cache = get_token_cache()
+        if cache is None:
+            return super().authenticate_credentials(key)
+
+        entry = cache.get(key)
+        if entry is None:
+            entry = super().authenticate_credentials(key)
+            cache.set(key, entry)
+        return self.copy_entry(entry)
+
+    def cached_credentials(self, key):
+        """
+        Return the user and token of a key from the in-process tier only,
+        which never blocks, or None
+        """
+        cache = get_token_cache()
+        entry = cache.get_local(key) if cache is not None else None
+        return self.copy_entry(entry) if entry is not None else None
+
+    def copy_entry(self, entry):
+        # Every request gets its own instances, the cached ones are shared
+        user, token = entry
+        return copy.copy(user), copy.copy(token)
+
+
+def invalidate_tokens(keys):
+    cache = get_token_cache()
+    if cache is None:
+        return
+
+    keys = list(keys)
+    cache.invalidate(keys)
+    # A request in between may have cached the rows from before the write
+    transaction.on_commit(lambda: cache.invalidate(keys))
+
+
+@receiver(post_delete, sender=Token)
+def invalidate_deleted_token(sender, instance, **kwargs):
+    invalidate_tokens([instance.key])
+
+
+@receiver(post_save, sender=get_user_model())
+def invalidate_tokens_of_user(sender, instance, created, **kwargs):
+    """
+    Drop the cached tokens of a changed user, so a deactivated user is
+    refused straight away and nobody keeps using stale user fields
+    """
+    if created or get_token_cache() is None:
+        return
+    invalidate_tokens(
+        Token.objects.filter(user_id=instance.pk).values_list("key", flat=True)
+    )
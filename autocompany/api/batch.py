@@ -0,0 +1,436 @@
+#!/usr/bin/env python3
+
+__author__ = "Surya Banerjee"
+
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils.timezone import now
+from rest_framework import serializers, status
+from rest_framework.exceptions import APIException, NotFound
+
+from autocompany.api.checkout import check_queue_capacity, enqueue_checkouts
+from autocompany.api.models import Cart, CartItem, CheckoutJob, Product
+from autocompany.api.serializers import (
+    CartSerializer,
+    cart_lines,
+    load_stock,
+    unknown_product,
+)
+from autocompany.api.services import take_order
+from autocompany.api.stock import (
+    InsufficientStock,
+    quantities_by_product,
+    reserve_stock,
+)
+
+# A batch applies many cart operations of one user in a single request and
+# transaction:
+#
+#   validate every operation --> check the stock of all of them at once
+#     --> bulk write the new carts --> save the changed carts one by one
+#
+# In atomic mode one failed operation rolls the whole batch back. Otherwise
+# every operation is written in its own savepoint, and a failure only undoes
+# its own writes. New carts are written together in one savepoint, if that
+# fails they are written one by one to find the failing ones.
+
+CREATE = "create"
+UPDATE = "update"
+CHECKOUT = "checkout"
+
+
+class NotApplied(APIException):
+    """
+    Result of the operations of an atomic batch which was rolled back
+    because of another operation
+    """
+
+    status_code = status.HTTP_424_FAILED_DEPENDENCY
+    default_detail = "Not applied, another operation of the batch failed."
+    default_code = "not_applied"
+
+
+class BatchOperationSerializer(serializers.Serializer):
+    op = serializers.ChoiceField(choices=[CREATE, UPDATE, CHECKOUT])
+    # The cart changed by update and checkout operations
+    cart = serializers.IntegerField(required=False)
+    # Fields of the cart, as sent to the cart endpoint
+    data = serializers.DictField(default=dict)
+    idempotency_key = serializers.CharField(required=False, max_length=200)
+
+    def validate(self, attrs):
+        if attrs["op"] != CREATE and "cart" not in attrs:
+            raise serializers.ValidationError(
+                {"cart": ["This field is required."]}
+            )
+        return attrs
+
+
+class CartBatchSerializer(serializers.Serializer):
+    atomic = serializers.BooleanField(default=True)
+    operations = BatchOperationSerializer(many=True, allow_empty=False)
+
+    def validate_operations(self, operations):
+        limit = settings.CART_BATCH["MAX_OPERATIONS"]
+        if len(operations) > limit:
+            raise serializers.ValidationError(
+                f"Ensure this field has no more than {limit} elements."
+            )
+        return operations
+
+
+class BatchOperation:
+    """
+    An operation of a batch, with what validating and writing it found
+    """
+
+    def __init__(self, index, op, data, cart=None, idempotency_key=None):
+        self.index = index
+        self.op = op
+        self.data = data
+        self.cart_pk = cart
+        self.key = idempotency_key
+        self.cart = None
+        self.serializer = None
+        self.replayed = False
+        # Quantities the cart ends up with, and those it held before
+        self.lines = {}
+        self.held = {}
+        self.takes_stock = False
+        self.error = None
+
+    def fail(self, error):
+        self.error = error
+        self.serializer = None
+
+    def result(self, carts):
+        if self.error is not None:
+            errors = self.error.detail
+            # Shaped like the body of the exception's own response
+            if not isinstance(errors, (list, dict)):
+                errors = {"detail": errors}
+            return {
+                "index": self.index,
+                "status": self.error.status_code,
+                "errors": errors,
+            }
+        result = {
+            "index": self.index,
+            "status": (
+                status.HTTP_201_CREATED
+                if self.op == CREATE and not self.replayed
+                else status.HTTP_200_OK
+            ),
+            "cart": CartSerializer(carts[self.cart.pk]).data,
+        }
+        if self.replayed:
+            result["replayed"] = True
+        return result
+
+
+class CartBatch:
+    """
+    Creates, changes and orders carts of the user of a request, returning
+    a result per operation.
+
+    Every operation is validated by CartSerializer, except for its stock,
+    which is checked for the whole batch with one query. Operations are
+    handed the stock in their order, so a batch can't take more than
+    there is. New carts and their items are written with bulk inserts and
+    one UPDATE of the stock, changed carts go through the serializer one
+    by one, as their order transitions need.
+    """
+
+    def __init__(self, request, operations, atomic=True):
+        self.request = request
+        self.user = request.user
+        self.atomic = atomic
+        self.operations = [
+            BatchOperation(index, **attrs)
+            for index, attrs in enumerate(operations)
+        ]
+
+    def scoped_key(self, operation):
+        if operation.key is None:
+            return None
+        return f"user:{self.user.pk}:{operation.key}"
+
+    def run(self):
+        with transaction.atomic():
+            self.validate()
+            self.check_stock()
+            if self.failed() and self.atomic:
+                return self.results()
+
+            if any(self.places_order(operation) for operation in self.valid()):
+                check_queue_capacity()
+            self.write_created(
+                [op for op in self.valid() if op.op == CREATE]
+            )
+            for operation in self.valid():
+                if operation.op != CREATE:
+                    self.write(operation)
+            if self.failed() and self.atomic:
+                transaction.set_rollback(True)
+            return self.results()
+
+    def valid(self):
+        return [op for op in self.operations if op.serializer is not None]
+
+    def failed(self):
+        return any(op.error is not None for op in self.operations)
+
+    def places_order(self, operation):
+        return operation.serializer.is_checkout() and not (
+            operation.cart and operation.cart.order_completed
+        )
+
+    def validate(self):
+        """
+        Validate every operation, loading the carts, their items and the
+        checkouts of used idempotency keys with a query each
+        """
+        keys = [
+            self.scoped_key(operation)
+            for operation in self.operations
+            if operation.key is not None
+        ]
+        jobs = {}
+        if keys:
+            jobs = dict(
+                CheckoutJob.objects.filter(idempotency_key__in=keys)
+                .values_list("idempotency_key", "cart_id")
+            )
+
+        pks = {op.cart_pk for op in self.operations if op.cart_pk is not None}
+        pks.update(jobs.values())
+        carts, existing = {}, defaultdict(list)
+        if pks:
+            # Locked until the batch commits, like the carts of single writes
+            carts = (
+                Cart.objects.filter(user=self.user, pk__in=pks)
+                .order_by("pk")
+                .select_for_update()
+                .in_bulk()
+            )
+            items = CartItem.objects.filter(cart_id__in=carts).values_list(
+                "cart_id", "product_id", "quantity"
+            )
+            for cart_pk, product_pk, quantity in items:
+                existing[cart_pk].append((product_pk, quantity))
+
+        hold = settings.CART_EXPIRY["HOLD_SECONDS"]
+        seen = set()
+        for operation in self.operations:
+            if operation.key is not None:
+                if operation.key in seen:
+                    operation.fail(
+                        serializers.ValidationError(
+                            {
+                                "idempotency_key": [
+                                    "Already used by another operation."
+                                ]
+                            }
+                        )
+                    )
+                    continue
+                seen.add(operation.key)
+
+            job_cart = jobs.get(self.scoped_key(operation))
+            if job_cart is not None:
+                # A retried checkout answers with the cart it ordered
+                if operation.cart_pk not in (None, job_cart):
+                    operation.fail(
+                        serializers.ValidationError(
+                            {
+                                "idempotency_key": [
+                                    "Already used for another cart."
+                                ]
+                            }
+                        )
+                    )
+                else:
+                    operation.cart = carts[job_cart]
+                    operation.replayed = True
+                continue
+
+            if operation.op != CREATE:
+                operation.cart = carts.get(operation.cart_pk)
+                if operation.cart is None:
+                    operation.fail(NotFound())
+                    continue
+            self.validate_cart(operation)
+            if operation.serializer is None:
+                continue
+
+            cart = operation.cart
+            stored = quantities_by_product(existing[cart.pk]) if cart else {}
+            if cart and (cart.order_completed or cart.held_until):
+                operation.held = stored
+            items = operation.serializer.validated_data.get("items")
+            if items is not None:
+                # Lines with a quantity of 0 are only checked for their
+                # product
+                operation.lines = dict.fromkeys(
+                    (item["product_id"] for item in items), 0
+                )
+                operation.lines.update(cart_lines(items))
+            else:
+                operation.lines = stored
+            operation.takes_stock = operation.serializer.is_checkout() or bool(
+                hold and any(operation.lines.values())
+            )
+
+    def validate_cart(self, operation):
+        data = operation.data
+        if operation.op == CHECKOUT:
+            data = dict(data, order_completed=True)
+        serializer = CartSerializer(
+            operation.cart,
+            data=data,
+            partial=operation.op != CREATE,
+            context={"request": self.request, "stock_checked": True},
+        )
+        try:
+            valid = serializer.is_valid()
+        except APIException as error:
+            # A full delivery slot
+            operation.fail(error)
+            return
+        if not valid:
+            operation.fail(serializers.ValidationError(serializer.errors))
+            return
+        operation.serializer = serializer
+
+    def check_stock(self):
+        """
+        Check the stock of every operation with one query, taking what an
+        operation reserves away from the stock the next ones see
+        """
+        operations = self.valid()
+        pks = {pk for operation in operations for pk in operation.lines}
+        if not pks:
+            return
+        stock = load_stock(
+            pks, lock=any(operation.takes_stock for operation in operations)
+        )
+
+        for operation in operations:
+            unknown = [pk for pk in operation.lines if pk not in stock]
+            if unknown:
+                operation.fail(
+                    serializers.ValidationError(
+                        {"items": unknown_product(unknown[0]).detail}
+                    )
+                )
+                continue
+            # What the cart holds already is not taken again
+            needed = {
+                pk: quantity - operation.held.get(pk, 0)
+                for pk, quantity in operation.lines.items()
+            }
+            if any(stock[pk] < quantity for pk, quantity in needed.items()):
+                operation.fail(InsufficientStock())
+                continue
+            if operation.takes_stock:
+                for pk, quantity in needed.items():
+                    stock[pk] -= max(quantity, 0)
+
+    def write_created(self, operations):
+        if not operations:
+            return
+        try:
+            with transaction.atomic():
+                self.bulk_create(operations)
+            return
+        except APIException:
+            pass
+        for operation in operations:
+            self.write(operation)
+
+    def bulk_create(self, operations):
+        """
+        Write new carts with one INSERT for the carts, one for their items,
+        one UPDATE of the stock they take and one INSERT of their checkout
+        jobs
+        """
+        timestamp = now()
+        hold = settings.CART_EXPIRY["HOLD_SECONDS"]
+        ordered = [
+            operation for operation in operations
+            if operation.serializer.validated_data.get("order_completed")
+        ]
+        prices = {}
+        if ordered:
+            pks = {pk for operation in ordered for pk in operation.lines}
+            prices = dict(
+                Product.objects.filter(pk__in=pks).values_list("pk", "price")
+            )
+
+        reserved, orders = [], []
+        for operation in operations:
+            attrs = dict(operation.serializer.validated_data)
+            attrs.pop("items", None)
+            cart = Cart(user=self.user, updated_at=timestamp, **attrs)
+            lines = {pk: qty for pk, qty in operation.lines.items() if qty}
+            if cart.order_completed:
+                cart.ordered_at = timestamp
+                # Lines as place_order loads them, of items which are
+                # inserted with their price
+                reserved += take_order(
+                    cart,
+                    [
+                        (None, pk, quantity, prices.get(pk), prices.get(pk))
+                        for pk, quantity in lines.items()
+                    ],
+                )
+                orders.append((cart, self.scoped_key(operation)))
+            elif hold and lines:
+                cart.held_until = timestamp + timedelta(seconds=hold)
+                reserved += lines.items()
+            operation.cart = cart
+        Cart.objects.bulk_create([operation.cart for operation in operations])
+
+        CartItem.objects.bulk_create(
+            CartItem(
+                cart=operation.cart,
+                product_id=pk,
+                quantity=quantity,
+                unit_price=(
+                    prices.get(pk) if operation.cart.order_completed else None
+                ),
+            )
+            for operation in operations
+            for pk, quantity in operation.lines.items()
+            if quantity
+        )
+        reserve_stock(reserved)
+        enqueue_checkouts(orders)
+
+    def write(self, operation):
+        try:
+            with transaction.atomic():
+                operation.cart = operation.serializer.save(
+                    checkout_key=self.scoped_key(operation)
+                )
+        except APIException as error:
+            operation.fail(error)
+
+    def results(self):
+        """
+        Result of every operation, with the carts read with their items in
+        two queries
+        """
+        if self.failed() and self.atomic:
+            for operation in self.operations:
+                if operation.error is None:
+                    operation.fail(NotApplied())
+            return [operation.result({}) for operation in self.operations]
+
+        pks = [op.cart.pk for op in self.operations if op.error is None]
+        carts = Cart.objects.filter(pk__in=pks).prefetch_related("items")
+        carts = carts.in_bulk()
+        return [operation.result(carts) for operation in self.operations]
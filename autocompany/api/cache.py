@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+
+__author__ = "Surya Banerjee"
+
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.db import transaction
+from django.dispatch import receiver
+
+
+class LRUBackend:
+    """
+    In-process LRU cache with a TTL per entry.
+
+    Every uWSGI worker holds its own copy, so an invalidation only reaches
+    the worker doing the write and the TTL bounds staleness in the others.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, timeout):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + timeout, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete_many(self, keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+
+class DjangoCacheBackend:
+    """
+    Cache stored through Django's cache framework, so it can be shared by all
+    workers once CACHE_URL points at a shared store
+    """
+
+    def __init__(self, alias):
+        self.cache = caches[alias]
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def set(self, key, value, timeout):
+        self.cache.set(key, value, timeout)
+
+    def delete_many(self, keys):
+        self.cache.delete_many(keys)
+
+
+class NullBackend:
+    """
+    Backend that stores nothing, used when the product cache is disabled
+    """
+
+    def get(self, key):
+        return None
+
+    def set(self, key, value, timeout):
+        pass
+
+    def delete_many(self, keys):
+        pass
+
+
+class ProductCache:
+    """
+    Caches product list pages and product details.
+
+    Stock changes far more often than the rest of a product, so it is kept
+    with the product version and the catalog version under its own key
+    with a short timeout and merged into the cached detail on read. The
+    ETag is built from the product version, which stock writes move too.
+    Details are keyed by the catalog version, which only product writes
+    move, so a stock change keeps the cached detail and a worker which
+    missed an invalidation can't answer a new ETag with an old body. List
+    pages are keyed by the catalog version as well, which is cached with
+    the same short timeout so other workers pick up product writes quickly.
+    """
+
+    catalog_key = "product-catalog-version"
+
+    def __init__(self, backend, timeout, stock_timeout):
+        self.backend = backend
+        self.timeout = timeout
+        self.stock_timeout = stock_timeout
+        self.hits = defaultdict(int)
+        self.misses = defaultdict(int)
+
+    def _get(self, kind, key, loader, timeout):
+        value = self.backend.get(key)
+        if value is None:
+            self.misses[kind] += 1
+            value = loader()
+            self.backend.set(key, value, timeout)
+        else:
+            self.hits[kind] += 1
+        return value
+
+    def get_catalog_version(self, loader):
+        return self._get(
+            "catalog", self.catalog_key, loader, self.stock_timeout
+        )
+
+    def get_list(self, version, url, loader):
+        key = f"product-list:{version}:{url}"
+        return self._get("list", key, loader, self.timeout)
+
+    def get_detail(self, pk, version, loader):
+        key = f"product:{pk}:{version}"
+        return self._get("detail", key, loader, self.timeout)
+
+    def get_stock(self, pk, loader):
+        key = f"product-stock:{pk}"
+        return self._get("stock", key, loader, self.stock_timeout)
+
+    def invalidate_products(self, pks):
+        # Details of older versions are never read again
+        self.backend.delete_many(
+            [f"product-stock:{pk}" for pk in pks] + [self.catalog_key]
+        )
+
+    def invalidate_stock(self, pks):
+        self.backend.delete_many([f"product-stock:{pk}" for pk in pks])
+
+    def stats(self):
+        return {
+            kind: {"hits": self.hits[kind], "misses": self.misses[kind]}
+            for kind in ("catalog", "list", "detail", "stock")
+        }
+
+
+class TokenCache:
+    """
+    Caches the user and token behind an API token key.
+
+    Lookups go to the in-process LRU first and then to the optional shared
+    tier, which refills the LRU. Invalidations reach the shared tier and
+    the LRU of the worker doing the write, other workers drop the entry
+    once its short local timeout runs out.
+    """
+
+    def __init__(self, local, shared, timeout, shared_timeout):
+        self.local = local
+        self.shared = shared
+        self.timeout = timeout
+        self.shared_timeout = shared_timeout
+
+    def _key(self, key):
+        return f"auth-token:{key}"
+
+    def get(self, key):
+        entry = self.local.get(self._key(key))
+        if entry is None and self.shared is not None:
+            entry = self.shared.get(self._key(key))
+            if entry is not None:
+                self.local.set(self._key(key), entry, self.timeout)
+        return entry
+
+    def get_local(self, key):
+        return self.local.get(self._key(key))
+
+    def set(self, key, entry):
+        self.local.set(self._key(key), entry, self.timeout)
+        if self.shared is not None:
+            self.shared.set(self._key(key), entry, self.shared_timeout)
+
+    def invalidate(self, keys):
+        keys = [self._key(key) for key in keys]
+        self.local.delete_many(keys)
+        if self.shared is not None:
+            self.shared.delete_many(keys)
+
+
+_product_cache = None
+_token_cache = None
+
+# Loads everything straight from the database
+uncached_products = ProductCache(NullBackend(), 0, 0)
+
+
+def get_product_cache():
+    """
+    Return the configured product cache, or None when caching is disabled
+    """
+    global _product_cache
+
+    config = settings.PRODUCT_CACHE
+    if not config.get("BACKEND"):
+        return None
+
+    if _product_cache is None:
+        if config["BACKEND"] == "lru":
+            backend = LRUBackend(config.get("MAX_ENTRIES", 10000))
+        elif config["BACKEND"] == "django":
+            backend = DjangoCacheBackend(config.get("CACHE_ALIAS", "default"))
+        else:
+            raise ValueError(
+                f"Unknown product cache backend '{config['BACKEND']}'"
+            )
+        _product_cache = ProductCache(
+            backend, config.get("TIMEOUT", 300), config.get("STOCK_TIMEOUT", 5)
+        )
+    return _product_cache
+
+
+def invalidate_products(pks, stock_only=False):
+    """
+    Drop cached entries of the given products, or only their stock
+    """
+    cache = get_product_cache()
+    if cache is None:
+        return
+
+    pks = list(pks)
+    invalidate = cache.invalidate_stock if stock_only else (
+        cache.invalidate_products
+    )
+    invalidate(pks)
+    # Drop them again once committed, a read in between may have cached the
+    # rows as they were before the write
+    transaction.on_commit(lambda: invalidate(pks))
+
+
+def get_token_cache():
+    """
+    Return the configured token cache, or None when caching is disabled
+    """
+    global _token_cache
+
+    config = settings.TOKEN_CACHE
+    if not config.get("BACKEND"):
+        return None
+
+    if _token_cache is None:
+        if config["BACKEND"] != "lru":
+            raise ValueError(
+                f"Unknown token cache backend '{config['BACKEND']}'"
+            )
+        shared = None
+        if config.get("SHARED"):
+            shared = DjangoCacheBackend(config.get("CACHE_ALIAS", "default"))
+        _token_cache = TokenCache(
+            LRUBackend(config.get("MAX_ENTRIES", 10000)),
+            shared,
+            config.get("TIMEOUT", 30),
+            config.get("SHARED_TIMEOUT", 300),
+        )
+    return _token_cache
+
+
+@receiver(setting_changed)
+def reset_caches(setting, **kwargs):
+    global _product_cache, _token_cache
+
+    if setting in ("PRODUCT_CACHE", "CACHES"):
+        _product_cache = None
+    if setting in ("TOKEN_CACHE", "CACHES"):
+        _token_cache = None
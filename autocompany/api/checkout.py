@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+
+__author__ = "Surya Banerjee"
+
+import logging
+import os
+import socket
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F, Q
+from django.utils.module_loading import import_string
+from django.utils.timezone import now
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+from autocompany.api.models import Cart, CheckoutJob
+
+logger = logging.getLogger(__name__)
+
+# A checkout is accepted in the request, which reserves the stock, captures
+# the order summary and enqueues a CheckoutJob in the same transaction.
+# run_checkout_worker then runs CHECKOUT_QUEUE["STEPS"] on the ordered
+# cart, retrying failed jobs with an exponential backoff:
+#
+#   pending --claim--> running --steps ok--> done
+#      ^                  |
+#      +---- retry -------+--attempts used up--> failed
+#
+# Reversing the order cancels its pending job. Steps may run more than once
+# and must be idempotent.
+
+
+class CheckoutQueueFull(APIException):
+    """
+    Raised when more checkouts are waiting for the worker than the queue
+    accepts, clients should retry after `wait` seconds
+    """
+
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = "Too many checkouts in progress, try again shortly."
+    default_code = "checkout_queue_full"
+
+    def __init__(self, wait):
+        super().__init__()
+        self.wait = wait
+
+
+class CheckoutConflict(APIException):
+    """
+    Raised when a concurrent checkout took the same idempotency key first,
+    the order placed by this one has to be rolled back
+    """
+
+    status_code = status.HTTP_409_CONFLICT
+    default_detail = "A checkout with this idempotency key is in progress."
+    default_code = "checkout_conflict"
+
+
+def check_queue_capacity():
+    """
+    Refuse new checkouts while the backlog is at its limit, so accepting a
+    checkout stays fast and the backlog can't grow without bounds
+    """
+    limit = settings.CHECKOUT_QUEUE["MAX_PENDING"]
+    if not limit:
+        return
+    # Counts at most limit rows, however long the backlog
+    pending = CheckoutJob.objects.filter(status=CheckoutJob.PENDING)
+    if pending[:limit].count() >= limit:
+        raise CheckoutQueueFull(settings.CHECKOUT_QUEUE["RETRY_AFTER"])
+
+
+def default_key(cart):
+    ordered_at = int(cart.ordered_at.timestamp() * 1000000)
+    return f"cart:{cart.pk}:{ordered_at}"
+
+
+def checkout_job(cart, key=None):
+    return CheckoutJob(
+        cart_id=cart.pk,
+        idempotency_key=key or default_key(cart),
+        run_after=now(),
+    )
+
+
+def enqueue_checkout(cart, key=None):
+    """
+    Add the job of an ordered cart, raises CheckoutConflict if its key was
+    used already
+    """
+    enqueue_checkouts([(cart, key)])
+
+
+def enqueue_checkouts(orders):
+    """
+    Add the jobs of ordered carts from (cart, key) pairs with one INSERT
+    """
+    try:
+        CheckoutJob.objects.bulk_create(
+            [checkout_job(cart, key) for cart, key in orders]
+        )
+    except IntegrityError:
+        # The transaction is rolled back with the order, no savepoint
+        raise CheckoutConflict()
+
+
+def cancel_checkout(cart):
+    CheckoutJob.objects.filter(
+        cart_id=cart.pk, status=CheckoutJob.PENDING
+    ).update(status=CheckoutJob.CANCELLED, finished_at=now())
+
+
+def confirm_order(cart):
+    """
+    The default checkout step, marks the order as confirmed
+    """
+    if cart.confirmed_at is None:
+        cart.confirmed_at = now()
+        Cart.objects.filter(pk=cart.pk).update(confirmed_at=cart.confirmed_at)
+
+
+def checkout_steps():
+    return [import_string(path) for path in settings.CHECKOUT_QUEUE["STEPS"]]
+
+
+class CheckoutWorker:
+    """
+    Claims due checkout jobs in batches and runs the checkout steps on
+    them.
+
+    Claiming locks the jobs with SKIP LOCKED on PostgreSQL, so any number
+    of workers can poll the same table. A job whose worker died is claimed
+    again once its lease ran out.
+    """
+
+    def __init__(self, batch_size=None, log=None):
+        config = settings.CHECKOUT_QUEUE
+        self.batch_size = batch_size or config["BATCH_SIZE"]
+        self.max_attempts = config["MAX_ATTEMPTS"]
+        self.retry_delay = config["RETRY_DELAY"]
+        self.lease = timedelta(seconds=config["LEASE_SECONDS"])
+        self.name = f"{socket.gethostname()}:{os.getpid()}"
+        self.steps = checkout_steps()
+        self.log = log or (lambda message: None)
+
+    def claim(self):
+        timestamp = now()
+        with transaction.atomic():
+            jobs = list(
+                CheckoutJob.objects.select_for_update(skip_locked=True)
+                .filter(
+                    Q(status=CheckoutJob.PENDING, run_after__lte=timestamp)
+                    | Q(
+                        status=CheckoutJob.RUNNING,
+                        locked_at__lt=timestamp - self.lease,
+                    )
+                )
+                .order_by("run_after")[:self.batch_size]
+            )
+            CheckoutJob.objects.filter(pk__in=[job.pk for job in jobs]).update(
+                status=CheckoutJob.RUNNING,
+                locked_at=timestamp,
+                locked_by=self.name,
+                attempts=F("attempts") + 1,
+            )
+        for job in jobs:
+            job.attempts += 1
+        return jobs
+
+    def run_once(self):
+        """
+        Process one batch of due jobs, returning the number of jobs
+        """
+        start = time.perf_counter()
+        jobs = self.claim()
+        results = {}
+        for job in jobs:
+            result = self.process(job)
+            results[result] = results.get(result, 0) + 1
+        if jobs:
+            seconds = time.perf_counter() - start
+            self.log(
+                f"{len(jobs)} jobs in {seconds:.2f}s: "
+                + ", ".join(f"{n} {result}" for result, n in results.items())
+            )
+        return len(jobs)
+
+    def process(self, job):
+        try:
+            with transaction.atomic():
+                cart = (
+                    Cart.objects.select_for_update()
+                    .filter(pk=job.cart_id, order_completed=True)
+                    .first()
+                )
+                result = CheckoutJob.CANCELLED
+                if cart is not None:
+                    for step in self.steps:
+                        step(cart)
+                    result = CheckoutJob.DONE
+                CheckoutJob.objects.filter(pk=job.pk).update(
+                    status=result, finished_at=now(), last_error=""
+                )
+            return result
+        except Exception as error:
+            logger.exception("Checkout job %s failed", job.pk)
+            return self.retry(job, error)
+
+    def retry(self, job, error):
+        if job.attempts >= self.max_attempts:
+            result, run_after = CheckoutJob.FAILED, job.run_after
+        else:
+            result = CheckoutJob.PENDING
+            delay = self.retry_delay * 2 ** (job.attempts - 1)
+            run_after = now() + timedelta(seconds=delay)
+        CheckoutJob.objects.filter(pk=job.pk).update(
+            status=result,
+            run_after=run_after,
+            last_error=f"{type(error).__name__}: {error}"[:1000],
+            finished_at=now() if result == CheckoutJob.FAILED else None,
+        )
+        return "retried" if result == CheckoutJob.PENDING else result
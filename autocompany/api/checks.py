@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+
+__author__ = "Surya Banerjee"
+
+import time
+
+from django.conf import settings
+from django.core.checks import Error, Tags, Warning, register
+from django.db import DatabaseError, connections
+
+
+@register(Tags.database)
+def check_database_connection(databases=None, **kwargs):
+    """
+    Connect to every database and run a query, so a deployment with a
+    wrong or unreachable database fails before serving requests.
+
+    Only runs with `manage.py check --database <alias>`.
+    """
+    errors = []
+    for alias in databases or []:
+        connection = connections[alias]
+        start = time.perf_counter()
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT 1")
+        except DatabaseError as error:
+            errors.append(
+                Error(
+                    f"Cannot query the '{alias}' database: {error}",
+                    id="api.E001",
+                )
+            )
+            continue
+        elapsed = (time.perf_counter() - start) * 1000
+        if elapsed > settings.DB_SLOW_CONNECT_MS:
+            errors.append(
+                Warning(
+                    f"Connecting to the '{alias}' database took "
+                    f"{elapsed:.0f}ms",
+                    hint="Keep connections open with DB_CONN_MAX_AGE or "
+                    "use DB_POOL, opening one per request adds this to "
+                    "every request.",
+                    id="api.W002",
+                )
+            )
+    return errors
+
+
+def connection_settings_errors(alias, config):
+    errors = []
+    pool = config.get("POOL")
+    if pool and pool.get("MAX_SIZE", 10) < 1:
+        errors.append(
+            Error(
+                f"The connection pool of '{alias}' needs a MAX_SIZE of at "
+                "least 1",
+                id="api.E002",
+            )
+        )
+    if (
+        settings.APPLICATION_SERVER == "asgi"
+        and config.get("CONN_MAX_AGE", 0) != 0
+    ):
+        errors.append(
+            Warning(
+                f"CONN_MAX_AGE of '{alias}' is not 0 under ASGI, where every "
+                "request runs with its own connection",
+                hint="Set DB_CONN_MAX_AGE=0, with DB_POOL=true to reuse "
+                "connections.",
+                id="api.W001",
+            )
+        )
+    return errors
+
+
+@register()
+def check_connection_settings(**kwargs):
+    errors = []
+    for alias, config in settings.DATABASES.items():
+        errors += connection_settings_errors(alias, config)
+    return errors
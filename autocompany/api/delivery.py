@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+
+__author__ = "Surya Banerjee"
+
+from datetime import datetime, time, timedelta
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models import F
+from django.utils.timezone import get_current_timezone, make_aware, now
+from rest_framework import serializers, status
+from rest_framework.exceptions import APIException
+
+from autocompany.api.models import DeliverySlot
+
+AVAILABILITY_KEY = "delivery-availability"
+
+
+class DeliverySlotFull(APIException):
+    """
+    Raised when an order is placed in a slot without capacity left
+    """
+
+    status_code = status.HTTP_400_BAD_REQUEST
+    default_detail = {
+        "delivery_slot": "No capacity left in this delivery slot."
+    }
+    default_code = "delivery_slot_full"
+
+
+def book_slot(pk):
+    """
+    Take one order of the capacity of a slot with a single conditional
+    UPDATE, concurrent bookings of the last place can't both succeed
+    """
+    if pk is None:
+        return
+    updated = DeliverySlot.objects.filter(
+        pk=pk, booked__lt=F("capacity")
+    ).update(booked=F("booked") + 1)
+    if not updated:
+        raise DeliverySlotFull()
+
+
+def release_slot(pk):
+    if pk is None:
+        return
+    DeliverySlot.objects.filter(pk=pk, booked__gt=0).update(
+        booked=F("booked") - 1
+    )
+
+
+def move_slot(old_pk, new_pk):
+    """
+    Move the booking of an ordered cart, the new slot is booked first so
+    a full slot leaves the old booking in place
+    """
+    if old_pk == new_pk:
+        return
+    book_slot(new_pk)
+    release_slot(old_pk)
+
+
+def load_availability():
+    """
+    Upcoming slots up to MAX_DAYS ahead with the number of orders they can
+    still take, an index range scan of the slot table
+    """
+    start = now()
+    end = start + timedelta(days=settings.DELIVERY_SLOTS["MAX_DAYS"])
+    slots = (
+        DeliverySlot.objects.filter(start__gt=start, start__lt=end)
+        .order_by("start")
+        .values_list("pk", "start", "end", "capacity", "booked")
+    )
+    return [
+        {
+            "pk": pk,
+            "start": start,
+            "end": end,
+            "capacity": capacity,
+            "available": max(capacity - booked, 0),
+        }
+        for pk, start, end, capacity, booked in slots
+    ]
+
+
+def get_availability(days):
+    """
+    Upcoming slots of the next `days` days, read from a cache refreshed
+    every CACHE_TIMEOUT seconds.
+
+    Bookings don't invalidate it, the conditional UPDATE decides whether a
+    slot still has room, so a burst of checkouts doesn't turn every read
+    into a query.
+    """
+    config = settings.DELIVERY_SLOTS
+    cache = caches[config["CACHE_ALIAS"]]
+    slots = cache.get(AVAILABILITY_KEY)
+    if slots is None:
+        slots = load_availability()
+        cache.set(AVAILABILITY_KEY, slots, config["CACHE_TIMEOUT"])
+
+    start = now()
+    end = start + timedelta(days=days)
+    return [slot for slot in slots if start < slot["start"] < end]
+
+
+def slot_starts(first_day, days, first_hour, last_hour, length):
+    """
+    Start times of the slots of `days` days from `first_day`, every
+    `length` minutes from first_hour until last_hour in the current time
+    zone
+    """
+    timezone = get_current_timezone()
+    step = timedelta(minutes=length)
+    for day in range(days):
+        date = first_day + timedelta(days=day)
+        start = make_aware(datetime.combine(date, time(first_hour)), timezone)
+        end = make_aware(datetime.combine(date, time(last_hour)), timezone)
+        while start + step <= end:
+            yield start
+            start += step
+
+
+class AvailabilityQuerySerializer(serializers.Serializer):
+    days = serializers.IntegerField(min_value=1, required=False)
+
+    def validate_days(self, days):
+        max_days = settings.DELIVERY_SLOTS["MAX_DAYS"]
+        if days > max_days:
+            raise serializers.ValidationError(
+                f"Ensure this value is less than or equal to {max_days}."
+            )
+        return days
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+
+__author__ = "Surya Banerjee"
+
+import json
+import tempfile
+
+from django.conf import settings
+from django.http import StreamingHttpResponse
+from django.utils.text import compress_sequence
+
+from autocompany.api.fast_serializers import ValuesSerializer
+from autocompany.api.load_data import batched
+from autocompany.api.models import Product
+from autocompany.api.serializers import ProductDetailSerializer
+from autocompany.api.stock import add_shard_stock
+
+EXPORT_FORMATS = {
+    "json": "application/json",
+    "ndjson": "application/x-ndjson",
+}
+
+# Rows fetched from the database at a time
+EXPORT_CHUNK_SIZE = 2000
+
+# Rows encoded into each chunk of the body, small writes are slow to send
+ROWS_PER_CHUNK = 500
+
+# Size of an ASGI export kept in memory before it goes to disk
+SPOOL_MAX_SIZE = 8 * 1024 * 1024
+
+detail_rows = ValuesSerializer(ProductDetailSerializer)
+
+
+def export_rows(chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Yield every product as ProductDetailSerializer renders it, in pk order,
+    holding at most `chunk_size` rows in memory
+    """
+    products = detail_rows.values(Product.objects.order_by("pk"))
+    for rows in batched(products.iterator(chunk_size=chunk_size), chunk_size):
+        for row in add_shard_stock(rows):
+            yield detail_rows.to_representation(row)
+
+
+def dumps(row):
+    # Same output as the compact, unicode JSONRenderer of the API
+    return json.dumps(row, ensure_ascii=False, separators=(",", ":"))
+
+
+def encode_catalog(rows, export_format="json"):
+    """
+    Encode rows as one JSON array or as NDJSON, one object per line,
+    yielding bytes a few hundred rows at a time
+    """
+    if export_format == "ndjson":
+        for batch in batched(rows, ROWS_PER_CHUNK):
+            yield "".join(f"{dumps(row)}\n" for row in batch).encode()
+        return
+
+    yield b"["
+    separator = ""
+    for batch in batched(rows, ROWS_PER_CHUNK):
+        yield (separator + ",".join(map(dumps, batch))).encode()
+        separator = ","
+    yield b"]"
+
+
+def export_catalog(export_format="json", compress=False, rows=None):
+    """
+    Chunks of the catalog export, of every product unless other `rows` are
+    given, gzipped if `compress`
+    """
+    chunks = encode_catalog(
+        export_rows() if rows is None else rows, export_format
+    )
+    return compress_sequence(chunks) if compress else chunks
+
+
+def spooled(chunks):
+    """
+    Write the chunks to a temporary file and yield them back from it.
+
+    Django 4.0 iterates streaming bodies on the event loop under ASGI,
+    where the queryset iterator may not run, so the export is written
+    out in the request thread first.
+    """
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    for chunk in chunks:
+        spool.write(chunk)
+    spool.seek(0)
+
+    def read():
+        with spool:
+            while chunk := spool.read(64 * 1024):
+                yield chunk
+
+    return read()
+
+
+def export_response(export_format="json", compress=False):
+    chunks = export_catalog(export_format, compress)
+    if settings.APPLICATION_SERVER == "asgi":
+        chunks = spooled(chunks)
+
+    response = StreamingHttpResponse(
+        chunks, content_type=EXPORT_FORMATS[export_format]
+    )
+    response.headers["Content-Disposition"] = (
+        f'attachment; filename="catalog.{export_format}"'
+    )
+    if compress:
+        response.headers["Content-Encoding"] = "gzip"
+    return response
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+
+__author__ = "Surya Banerjee"
+
+from django.db import models
+from rest_framework import ISO_8601, serializers
+from rest_framework.settings import api_settings
+
+from autocompany.api.metrics import timed
+
+
+def _converter_for(field):
+    """
+    Return a callable turning the raw database value of a model field into
+    what the matching DRF field gives from to_representation, or None if
+    the value can be used as is.
+    """
+    # DateTimeField is a DateField, but DRF renders it with timezone handling
+    if isinstance(field, models.DateTimeField):
+        return serializers.DateTimeField().to_representation
+    if isinstance(field, models.DecimalField):
+        raise TypeError(
+            f"{type(field).__name__} '{field.name}' is not supported by "
+            "ValuesSerializer"
+        )
+    if isinstance(field, models.DateField):
+        return lambda value: value.isoformat()
+    return None
+
+
+class ValuesSerializer:
+    """
+    Read-only serializer for rows fetched with `.values()`.
+
+    It takes the field list of a ModelSerializer and produces the same
+    representation straight from the row dicts, skipping the per-field and
+    per-instance work of the DRF field machinery. Only plain model fields
+    are supported, pass `fields` to leave out nested ones.
+    """
+
+    def __init__(self, serializer_class, fields=None):
+        if api_settings.DATE_FORMAT != ISO_8601:
+            raise TypeError("ValuesSerializer only renders ISO 8601 dates")
+
+        opts = serializer_class.Meta.model._meta
+        self.fields = list(fields or serializer_class.Meta.fields)
+        self.converters = {}
+
+        for name in self.fields:
+            field = opts.pk if name == "pk" else opts.get_field(name)
+            converter = _converter_for(field)
+            if converter is not None:
+                self.converters[name] = converter
+
+    def values(self, queryset):
+        """
+        Restrict a queryset to the serialized fields, returning row dicts
+        """
+        return queryset.values(*self.fields)
+
+    def to_representation(self, row):
+        for name, convert in self.converters.items():
+            if row[name] is not None:
+                row[name] = convert(row[name])
+        return row
+
+    def serialize(self, rows):
+        with timed("serialize"):
+            return [self.to_representation(row) for row in rows]
@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+
+__author__ = "Surya Banerjee"
+
+import csv
+import io
+import json
+import time
+from collections import defaultdict
+from datetime import date
+
+from django.db import connection, transaction
+from django.utils.timezone import now
+
+from autocompany.api.cache import invalidate_products
+from autocompany.api.load_data import batched, can_copy
+from autocompany.api.models import CatalogVersion, Product
+from autocompany.api.stock import set_stock_shards
+
+IMPORT_FORMATS = {
+    "csv": "text/csv",
+    "ndjson": "application/x-ndjson",
+}
+
+TEXT_FIELDS = ("name", "overview", "model")
+# Left unchanged on existing products when a row does not have them
+OPTIONAL_FIELDS = ("stock", "price")
+UPDATE_FIELDS = ("overview", "model", "year") + OPTIONAL_FIELDS
+
+IMPORT_BATCH_SIZE = 5000
+
+# Rejected rows listed in a report, any further ones are only counted
+MAX_REPORTED_ERRORS = 100
+
+STAGING_TABLE = "api_product_import"
+
+
+def read_csv(lines):
+    """
+    Yield the line number and dict of every record of a CSV with a header
+    """
+    reader = csv.DictReader(lines)
+    for row in reader:
+        yield reader.line_num, row
+
+
+def read_ndjson(lines):
+    """
+    Yield the line number and object of every non-blank line, or None for
+    lines which are not valid JSON
+    """
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            yield number, json.loads(line)
+        except ValueError:
+            yield number, None
+
+
+READERS = {"csv": read_csv, "ndjson": read_ndjson}
+
+
+def parse_count(value):
+    if isinstance(value, str) and value.strip().isdigit():
+        return int(value)
+    if isinstance(value, int) and not isinstance(value, bool) and value >= 0:
+        return value
+    raise ValueError
+
+
+def parse_year(value):
+    """
+    Accept a year, as a number or string, or an ISO date
+    """
+    if isinstance(value, str):
+        value = value.strip()
+        if not value.isdigit():
+            return date.fromisoformat(value)
+    if isinstance(value, bool):
+        raise ValueError
+    return date(int(value), 1, 1)
+
+
+def clean_row(row):
+    """
+    Validate a row of the feed, returning the product values and a dict
+    of errors by field, only one of them is not None
+    """
+    if not isinstance(row, dict):
+        return None, {"row": "Expected an object with product fields."}
+
+    values, errors = {}, {}
+    for name in TEXT_FIELDS:
+        value = row.get(name)
+        if isinstance(value, str):
+            value = value.strip()
+        max_length = Product._meta.get_field(name).max_length
+        if value is None or value == "":
+            errors[name] = "This field is required."
+        elif not isinstance(value, str):
+            errors[name] = "Not a valid string."
+        elif len(value) > max_length:
+            errors[name] = (
+                f"Ensure this field has no more than {max_length} characters."
+            )
+        else:
+            values[name] = value
+
+    if row.get("year") in (None, ""):
+        errors["year"] = "This field is required."
+    else:
+        try:
+            values["year"] = parse_year(row["year"])
+        except (TypeError, ValueError):
+            errors["year"] = "Expected a year or a date as YYYY-MM-DD."
+
+    for name in OPTIONAL_FIELDS:
+        if row.get(name) in (None, ""):
+            continue
+        try:
+            values[name] = parse_count(row[name])
+        except ValueError:
+            errors[name] = "Expected a whole number of at least 0."
+
+    if errors:
+        return None, errors
+    return values, None
+
+
+class ImportReport:
+    """
+    Counts of an import, the first rejected rows and per batch throughput
+    """
+
+    def __init__(self):
+        self.created = 0
+        self.updated = 0
+        self.rejected = 0
+        self.errors = []
+        self.batches = []
+
+    def reject(self, line, errors):
+        self.rejected += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({"line": line, "errors": errors})
+
+    def as_dict(self):
+        rows = sum(batch["rows"] for batch in self.batches)
+        seconds = sum(batch["seconds"] for batch in self.batches)
+        return {
+            "created": self.created,
+            "updated": self.updated,
+            "rejected": self.rejected,
+            "errors": self.errors,
+            "batches": self.batches,
+            "rows_per_second": round(rows / seconds, 1) if seconds else None,
+        }
+
+
+class ProductImporter:
+    """
+    Upserts products on their unique name from the rows of a feed.
+
+    Rows are validated and written a batch at a time, each batch in its
+    own transaction, so memory use does not grow with the feed and
+    rejected rows never hold back the valid ones. On PostgreSQL a batch is
+    copied into a staging table and merged with two statements, elsewhere
+    it is written with bulk_update and bulk_create.
+    """
+
+    def __init__(self, batch_size=IMPORT_BATCH_SIZE, use_copy=None, log=None):
+        self.batch_size = batch_size
+        self.use_copy = can_copy() if use_copy is None else use_copy
+        self.log = log or (lambda message: None)
+
+    def run(self, rows):
+        """
+        Import (line number, row) pairs, returning an ImportReport
+        """
+        report = ImportReport()
+        for batch in batched(rows, self.batch_size):
+            self.import_batch(batch, report)
+        return report
+
+    def import_batch(self, batch, report):
+        start = time.perf_counter()
+        products = {}
+        rejected_before = report.rejected
+        for line, row in batch:
+            values, errors = clean_row(row)
+            if errors:
+                report.reject(line, errors)
+            else:
+                # The last row of a name wins, as if imported one by one
+                products[values["name"]] = values
+        rejected = report.rejected - rejected_before
+
+        with transaction.atomic():
+            upsert = self.copy_upsert if self.use_copy else self.bulk_upsert
+            created, updated_pks, sharded = upsert(list(products.values()))
+            # Bulk writes put the stock of products with sharded stock in
+            # the product row, it goes to the shards instead
+            for pk, shards, stock in sharded:
+                set_stock_shards(pk, shards, stock=stock)
+            invalidate_products(updated_pks)
+            # Bulk writes skip the signals which bump the catalog version
+            CatalogVersion.bump()
+
+        seconds = time.perf_counter() - start
+        report.created += created
+        report.updated += len(updated_pks)
+        report.batches.append(
+            {
+                "rows": len(batch),
+                "created": created,
+                "updated": len(updated_pks),
+                "rejected": rejected,
+                "seconds": round(seconds, 3),
+            }
+        )
+        self.log(
+            f"Batch {len(report.batches)}: {len(batch)} rows, {created} "
+            f"created, {len(updated_pks)} updated, {rejected} rejected, "
+            f"{len(batch) / max(seconds, 1e-9):.0f} rows/s"
+        )
+
+    def bulk_upsert(self, products):
+        existing = Product.objects.in_bulk(
+            [values["name"] for values in products], field_name="name"
+        )
+        timestamp = now()
+        to_create, to_update, sharded = [], defaultdict(list), []
+        for values in products:
+            product = existing.get(values["name"])
+            if product is None:
+                to_create.append(Product(**values))
+                continue
+            for name, value in values.items():
+                setattr(product, name, value)
+            product.updated_at = timestamp
+            # Stock and price read above are not written back, a checkout
+            # may have changed them since
+            fields = tuple(name for name in UPDATE_FIELDS if name in values)
+            to_update[fields].append(product)
+            if product.stock_shards and "stock" in values:
+                sharded.append(
+                    (product.pk, product.stock_shards, values["stock"])
+                )
+
+        for fields, group in to_update.items():
+            Product.objects.bulk_update(
+                group, fields + ("updated_at",), batch_size=1000
+            )
+        Product.objects.bulk_create(to_create, batch_size=1000)
+        return (
+            len(to_create),
+            [product.pk for group in to_update.values() for product in group],
+            sharded,
+        )
+
+    def copy_upsert(self, products):
+        quote = connection.ops.quote_name
+        table = quote(Product._meta.db_table)
+        columns = TEXT_FIELDS + ("year",) + OPTIONAL_FIELDS
+
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for values in products:
+            writer.writerow([values.get(name, r"\N") for name in columns])
+        buffer.seek(0)
+
+        timestamp = now()
+        defaults = [
+            Product._meta.get_field(name).get_default()
+            for name in OPTIONAL_FIELDS
+        ]
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"CREATE TEMPORARY TABLE IF NOT EXISTS {STAGING_TABLE} "
+                f"(name varchar(255), overview varchar(255), "
+                f"model varchar(255), year date, stock integer, "
+                f"price integer) ON COMMIT DELETE ROWS"
+            )
+            # Batches only commit when no outer transaction is open
+            cursor.execute(f"TRUNCATE {STAGING_TABLE}")
+            cursor.copy_expert(
+                f"COPY {STAGING_TABLE} ({', '.join(columns)}) "
+                f"FROM STDIN WITH (FORMAT csv, NULL '\\N')",
+                buffer,
+            )
+            cursor.execute(
+                f"UPDATE {table} AS p SET overview = s.overview, "
+                f"model = s.model, year = s.year, "
+                f"stock = COALESCE(s.stock, p.stock), "
+                f"price = COALESCE(s.price, p.price), updated_at = %s "
+                f"FROM {STAGING_TABLE} AS s WHERE p.name = s.name "
+                f"RETURNING p.id, p.stock_shards, s.stock",
+                [timestamp],
+            )
+            updated = cursor.fetchall()
+            cursor.execute(
+                f"INSERT INTO {table} (name, overview, model, year, stock, "
+                f"price, stock_shards, updated_at) "
+                f"SELECT s.name, s.overview, s.model, s.year, "
+                f"COALESCE(s.stock, %s), COALESCE(s.price, %s), 0, %s "
+                f"FROM {STAGING_TABLE} AS s WHERE NOT EXISTS "
+                f"(SELECT 1 FROM {table} AS p WHERE p.name = s.name) "
+                f"ON CONFLICT (name) DO NOTHING",
+                defaults + [timestamp],
+            )
+            created = cursor.rowcount
+        sharded = [
+            (pk, shards, stock)
+            for pk, shards, stock in updated
+            if shards and stock is not None
+        ]
+        return created, [pk for pk, _, _ in updated], sharded
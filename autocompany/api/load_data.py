@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+
+__author__ = "Surya Banerjee"
+
+import csv
+import io
+import itertools
+import random
+import time
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta, timezone
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management.color import no_style
+from django.db import connection
+from django.db.models import F, IntegerField, Max, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+from rest_framework.authtoken.models import Token
+
+from autocompany.api.models import Product, Cart, CartItem, CatalogVersion
+
+# Building blocks for realistic looking products
+BRANDS = [
+    "Bosch", "MRF", "Goodyear", "Michelin", "Wagner", "Mobis", "Lumax",
+    "Denso", "Valeo", "Brembo", "NGK", "Mann", "Castrol", "Hella",
+]
+PARTS = [
+    "Tyre", "Brake Shoe", "Brake Pad", "Windshield Wiper", "Shock Absorber",
+    "Headlight", "Spark Plug", "Oil Filter", "Air Filter", "Clutch Plate",
+    "Radiator", "Battery", "Tail Light", "Fuel Pump", "Timing Belt",
+]
+CAR_MODELS = [
+    "Honda City", "Honda Civic", "Toyota Lancer", "Maruti Omni",
+    "Tesla Model X", "Hyundai Verna", "Volkswagen Polo GT", "Ford Fiesta",
+    "Suzuki Swift", "Toyota Corolla", "Hyundai i20", "Kia Seltos",
+]
+
+# Fixed point in time so generated timestamps are reproducible
+EPOCH = datetime(2022, 1, 1, tzinfo=timezone.utc)
+
+# Every generated user logs in with this password
+PASSWORD = "loadtestpassword"
+
+
+def zipf_weights(count, exponent=1.1):
+    """
+    Cumulative weights where rank r is picked proportional to 1 / r^exponent
+    """
+    return list(
+        itertools.accumulate(1 / (rank ** exponent)
+                             for rank in range(1, count + 1))
+    )
+
+
+def batched(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def can_copy():
+    return connection.vendor == "postgresql"
+
+
+def copy_objects(model, objs):
+    """
+    Write model instances with PostgreSQL COPY, which skips the per-row
+    statement overhead of INSERT
+    """
+    fields = model._meta.concrete_fields
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for obj in objs:
+        row = []
+        for field in fields:
+            value = field.get_db_prep_save(
+                field.pre_save(obj, add=True), connection
+            )
+            row.append(r"\N" if value is None else value)
+        writer.writerow(row)
+    buffer.seek(0)
+
+    columns = ", ".join(
+        connection.ops.quote_name(field.column) for field in fields
+    )
+    with connection.cursor() as cursor:
+        cursor.copy_expert(
+            f"COPY {connection.ops.quote_name(model._meta.db_table)} "
+            f"({columns}) FROM STDIN WITH (FORMAT csv, NULL '\\N')",
+            buffer,
+        )
+
+
+@contextmanager
+def kept_auto_now(model):
+    """
+    Write the values set on the auto_now fields of `model` instead of the
+    time of the write
+    """
+    fields = [
+        field for field in model._meta.concrete_fields
+        if getattr(field, "auto_now", False)
+    ]
+    for field in fields:
+        field.auto_now = False
+    try:
+        yield
+    finally:
+        for field in fields:
+            field.auto_now = True
+
+
+class LoadDataGenerator:
+    """
+    Generates products, users with tokens, and carts with items.
+
+    Everything is drawn from a random generator seeded with `seed`, and
+    primary keys are assigned here, so the same arguments on an empty
+    database always give the same data. Rows are written in batches with
+    bulk_create, or COPY on PostgreSQL.
+    """
+
+    def __init__(self, seed=0, batch_size=5000, use_copy=None, log=None):
+        self.rng = random.Random(seed)
+        self.batch_size = batch_size
+        self.use_copy = can_copy() if use_copy is None else use_copy
+        self.log = log or (lambda message: None)
+
+    def next_pk(self, model):
+        return (model.objects.aggregate(pk=Max("pk"))["pk"] or 0) + 1
+
+    def write(self, model, objs):
+        start = time.perf_counter()
+        count = 0
+        for batch in batched(objs, self.batch_size):
+            if self.use_copy:
+                copy_objects(model, batch)
+            else:
+                model.objects.bulk_create(batch)
+            count += len(batch)
+
+        # Explicit primary keys leave the sequences behind
+        with connection.cursor() as cursor:
+            for sql in connection.ops.sequence_reset_sql(no_style(), [model]):
+                cursor.execute(sql)
+
+        elapsed = time.perf_counter() - start
+        self.log(
+            f"{model._meta.verbose_name_plural}: {count} rows in "
+            f"{elapsed:.1f}s ({count / max(elapsed, 1e-9):.0f} rows/s)"
+        )
+        return count
+
+    def generate_products(self, count):
+        first_pk = self.next_pk(Product)
+        rng = self.rng
+
+        def products():
+            year = timedelta(days=365).total_seconds()
+            for pk in range(first_pk, first_pk + count):
+                brand, part = rng.choice(BRANDS), rng.choice(PARTS)
+                yield Product(
+                    pk=pk,
+                    name=f"{brand} {part} {pk}",
+                    overview=f"{part} by {brand}",
+                    model=rng.choice(CAR_MODELS),
+                    year=date(rng.randint(1995, 2024), 1, 1),
+                    stock=rng.randint(0, 500),
+                    price=rng.randint(10, 2000),
+                    updated_at=EPOCH + timedelta(seconds=rng.uniform(0, year)),
+                )
+
+        # Not the time of the run, which would differ every time
+        with kept_auto_now(Product):
+            self.write(Product, products())
+        # Bulk writes skip the signals which bump the catalog version
+        CatalogVersion.bump()
+        return list(range(first_pk, first_pk + count))
+
+    def generate_users(self, count):
+        first_pk = self.next_pk(User)
+        password = make_password(PASSWORD, salt="loaddata")
+        rng = self.rng
+
+        self.write(
+            User,
+            (
+                User(
+                    pk=pk,
+                    username=f"loaduser{pk}",
+                    email=f"loaduser{pk}@example.com",
+                    password=password,
+                    date_joined=EPOCH,
+                )
+                for pk in range(first_pk, first_pk + count)
+            ),
+        )
+        self.write(
+            Token,
+            (
+                Token(
+                    key=f"{rng.getrandbits(160):040x}",
+                    user_id=pk,
+                    created=EPOCH,
+                )
+                for pk in range(first_pk, first_pk + count)
+            ),
+        )
+        return list(range(first_pk, first_pk + count))
+
+    def generate_carts(
+        self, count, user_pks, product_pks, max_items=10, completed=0.7
+    ):
+        """
+        Create carts for a long tail of users, where a few users own most
+        carts, filled with items drawn mostly from a few hot products
+        """
+        rng = self.rng
+        # Shuffle so the heavy users and hot products are spread over the pks
+        users = rng.sample(user_pks, len(user_pks))
+        products = rng.sample(product_pks, len(product_pks))
+        user_weights = zipf_weights(len(users))
+        product_weights = zipf_weights(len(products))
+
+        first_cart_pk = self.next_pk(Cart)
+        first_item_pk = self.next_pk(CartItem)
+        cart_pks = range(first_cart_pk, first_cart_pk + count)
+        items_per_cart = [
+            min(int(rng.expovariate(0.4)) + 1, max_items) for _ in cart_pks
+        ]
+
+        def carts():
+            year = timedelta(days=365).total_seconds()
+            for pk in cart_pks:
+                created = EPOCH + timedelta(seconds=rng.uniform(0, year))
+                yield Cart(
+                    pk=pk,
+                    user_id=rng.choices(users, cum_weights=user_weights)[0],
+                    cart_creation_time=created,
+                    delivery_time=created + timedelta(days=rng.randint(1, 7)),
+                    order_completed=rng.random() < completed,
+                    updated_at=created,
+                )
+
+        def items():
+            pk = first_item_pk
+            for cart_pk, item_count in zip(cart_pks, items_per_cart):
+                chosen = set(
+                    rng.choices(
+                        products, cum_weights=product_weights, k=item_count
+                    )
+                )
+                for product_pk in sorted(chosen):
+                    yield CartItem(
+                        pk=pk,
+                        cart_id=cart_pk,
+                        product_id=product_pk,
+                        quantity=rng.randint(1, 3),
+                    )
+                    pk += 1
+
+        self.write(Cart, carts())
+        self.write(CartItem, items())
+        self.capture_order_summaries(cart_pks)
+        return list(cart_pks)
+
+    def capture_order_summaries(self, cart_pks):
+        """
+        Fill in the prices and totals of the completed carts among
+        `cart_pks` with a few set based UPDATEs
+        """
+        carts = Cart.objects.filter(
+            pk__gte=cart_pks.start, pk__lt=cart_pks.stop, order_completed=True
+        )
+        CartItem.objects.filter(cart__in=carts).update(
+            unit_price=Subquery(
+                Product.objects.filter(pk=OuterRef("product_id")).values(
+                    "price"
+                )
+            )
+        )
+
+        def per_cart(expression):
+            return Subquery(
+                CartItem.objects.filter(cart_id=OuterRef("pk"))
+                .values("cart_id")
+                .annotate(value=Sum(expression, output_field=IntegerField()))
+                .values("value")
+            )
+
+        carts.update(
+            ordered_at=F("cart_creation_time"),
+            item_count=Coalesce(per_cart(F("quantity")), 0),
+            total_price=Coalesce(
+                per_cart(F("quantity") * F("unit_price")), 0
+            ),
+        )
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+__author__ = "Surya Banerjee"
+
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.timezone import localdate
+
+from autocompany.api.delivery import slot_starts
+from autocompany.api.models import DeliverySlot
+
+
+class Command(BaseCommand):
+    help = (
+        "Create the delivery slots of the coming days. Slots which already "
+        "exist are left as they are, so it can run every day."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--days",
+            type=int,
+            default=settings.DELIVERY_SLOTS["MAX_DAYS"],
+            help="Days to create slots for, starting today",
+        )
+        parser.add_argument("--first-hour", type=int, default=8)
+        parser.add_argument(
+            "--last-hour",
+            type=int,
+            default=20,
+            help="Hour the last slot of a day ends",
+        )
+        parser.add_argument(
+            "--length", type=int, default=60, help="Minutes per slot"
+        )
+        parser.add_argument(
+            "--capacity",
+            type=int,
+            default=settings.DELIVERY_SLOTS["CAPACITY"],
+            help="Orders per slot",
+        )
+
+    def handle(self, *args, **options):
+        if not 0 <= options["first_hour"] < options["last_hour"] <= 23:
+            raise CommandError("Expected 0 <= --first-hour < --last-hour < 24")
+        if options["length"] <= 0 or options["capacity"] < 0:
+            raise CommandError("Expected a positive --length and --capacity")
+
+        length = timedelta(minutes=options["length"])
+        starts = list(
+            slot_starts(
+                localdate(),
+                options["days"],
+                options["first_hour"],
+                options["last_hour"],
+                options["length"],
+            )
+        )
+        existing = set(
+            DeliverySlot.objects.filter(start__in=starts).values_list(
+                "start", flat=True
+            )
+        )
+        slots = DeliverySlot.objects.bulk_create(
+            [
+                DeliverySlot(
+                    start=start,
+                    end=start + length,
+                    capacity=options["capacity"],
+                )
+                for start in starts
+                if start not in existing
+            ],
+            ignore_conflicts=True,
+        )
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Created {len(slots)} delivery slots, "
+                f"{len(existing)} existed already"
+            )
+        )
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+
+__author__ = "Surya Banerjee"
+
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Max, Min
+from django.utils.timezone import now
+
+from autocompany.api.models import Product, Cart, CartItem
+from autocompany.api.pagination import (
+    OrderHistoryPagination,
+    ProductCursorPagination,
+)
+from autocompany.api.search import ProductSearch
+from autocompany.api.serializers import (
+    OrderSummarySerializer,
+    ProductListSerializer,
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Run EXPLAIN on the main queries behind CartViewset and "
+        "ProductViewset and fail if any of them uses a sequential scan. "
+        "Run it against a seeded, production sized database, on a handful "
+        "of rows the planner rightly prefers sequential scans."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--no-analyze",
+            action="store_true",
+            help="Do not refresh the planner statistics first",
+        )
+        parser.add_argument(
+            "--verbose-plans",
+            action="store_true",
+            help="Print the plan of every query, not only failing ones",
+        )
+
+    def get_queries(self):
+        """
+        The querysets the API runs, with realistic parameters from the data
+        """
+        # The owner of the newest cart, found on the primary key index
+        user_id = (
+            Cart.objects.order_by("-pk").values_list("user_id", flat=True)
+            .first()
+        )
+        cart_id = Cart.objects.filter(user_id=user_id).values_list(
+            "pk", flat=True
+        ).first()
+        bounds = Product.objects.aggregate(low=Min("pk"), high=Max("pk"))
+        if user_id is None or bounds["low"] is None:
+            raise CommandError("Seed products and carts first")
+
+        middle_pk = (bounds["low"] + bounds["high"]) // 2
+        page_size = ProductCursorPagination.page_size + 1
+        search_word = Product.objects.values_list("name", flat=True).first()
+        search_word = search_word.split()[0]
+        products = Product.objects.only(*ProductListSerializer.Meta.fields)
+
+        return {
+            "cart list": Cart.objects.filter(user_id=user_id),
+            "cart items prefetch": CartItem.objects.filter(
+                cart_id__in=list(
+                    Cart.objects.filter(user_id=user_id).values_list(
+                        "pk", flat=True
+                    )[:100]
+                )
+            ),
+            "cart retrieve": Cart.objects.filter(user_id=user_id, pk=cart_id),
+            "open carts": Cart.objects.filter(
+                user_id=user_id, order_completed=False
+            ).order_by("cart_creation_time"),
+            "completed carts": Cart.objects.filter(
+                user_id=user_id, order_completed=True
+            ),
+            "latest carts": Cart.objects.filter(user_id=user_id).order_by(
+                "-cart_creation_time"
+            )[:20],
+            "order history": Cart.objects.filter(
+                user_id=user_id, order_completed=True
+            ).order_by(*OrderHistoryPagination.ordering).values(
+                *OrderSummarySerializer.Meta.fields
+            )[:OrderHistoryPagination.page_size + 1],
+            "product first page": products.order_by("pk")[:page_size],
+            "product deep page": products.filter(pk__gt=middle_pk).order_by(
+                "pk"
+            )[:page_size],
+            "product retrieve": Product.objects.filter(pk=middle_pk),
+            "product version": Product.objects.filter(pk=middle_pk).values_list(
+                "stock", "updated_at"
+            ),
+            "products by model": Product.objects.filter(
+                model=Product.objects.values_list("model", flat=True).first()
+            ),
+            "product search": ProductSearch({"q": search_word}).queryset(),
+            "stale open carts": Cart.objects.filter(
+                order_completed=False,
+                updated_at__lt=now() - timedelta(
+                    days=settings.CART_EXPIRY["OPEN_CART_DAYS"]
+                ),
+            ).order_by("updated_at", "pk").values_list("updated_at", "pk")[
+                :settings.CART_EXPIRY["BATCH_SIZE"]
+            ],
+        }
+
+    def handle(self, *args, **options):
+        if connection.vendor != "postgresql":
+            raise CommandError("EXPLAIN checks need a PostgreSQL database")
+
+        if not options["no_analyze"]:
+            with connection.cursor() as cursor:
+                for model in (Product, Cart, CartItem):
+                    cursor.execute(f"ANALYZE {model._meta.db_table}")
+
+        failures = []
+        for name, queryset in self.get_queries().items():
+            plan = queryset.explain()
+            if "Seq Scan" in plan:
+                failures.append(name)
+                self.stdout.write(self.style.ERROR(f"{name}: sequential scan"))
+                self.stdout.write(plan)
+            else:
+                self.stdout.write(self.style.SUCCESS(f"{name}: ok"))
+                if options["verbose_plans"]:
+                    self.stdout.write(plan)
+
+        if failures:
+            raise CommandError(
+                f"Sequential scans in {len(failures)} queries: "
+                + ", ".join(failures)
+            )
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+
+__author__ = "Surya Banerjee"
+
+import sys
+import time
+
+from django.core.management.base import BaseCommand
+
+from autocompany.api.export import (
+    EXPORT_CHUNK_SIZE,
+    EXPORT_FORMATS,
+    export_catalog,
+    export_rows,
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Write the product catalog as a JSON array or NDJSON, the same rows "
+        "as /api/product/export/. Products are read in chunks, so memory "
+        "use does not grow with the catalog."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--format", choices=list(EXPORT_FORMATS), default="json"
+        )
+        parser.add_argument("--gzip", action="store_true")
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=EXPORT_CHUNK_SIZE,
+            help="Products fetched from the database at a time",
+        )
+        parser.add_argument(
+            "--output",
+            default="-",
+            help="File to write to, standard output by default",
+        )
+
+    def handle(self, *args, **options):
+        count = 0
+
+        def counted(rows):
+            nonlocal count
+            for row in rows:
+                count += 1
+                yield row
+
+        chunks = export_catalog(
+            options["format"],
+            options["gzip"],
+            counted(export_rows(options["chunk_size"])),
+        )
+
+        start = time.perf_counter()
+        if options["output"] == "-":
+            self.write(sys.stdout.buffer, chunks)
+        else:
+            with open(options["output"], "wb") as output:
+                self.write(output, chunks)
+        elapsed = time.perf_counter() - start
+
+        self.stderr.write(
+            f"Exported {count} products in {elapsed:.1f}s "
+            f"({count / max(elapsed, 1e-9):.0f} rows/s)",
+            style_func=self.style.SUCCESS,
+        )
+
+    def write(self, output, chunks):
+        for chunk in chunks:
+            output.write(chunk)
+        output.flush()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+
+__author__ = "Surya Banerjee"
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from autocompany.api.load_data import LoadDataGenerator, can_copy
+from autocompany.api.models import Product
+
+
+class Command(BaseCommand):
+    help = (
+        "Generate synthetic products, users with tokens and carts for load "
+        "tests. The same seed on an empty database gives the same data."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--products", type=int, default=10000)
+        parser.add_argument("--users", type=int, default=1000)
+        parser.add_argument("--carts", type=int, default=10000)
+        parser.add_argument(
+            "--max-items",
+            type=int,
+            default=10,
+            help="Maximum number of items in a cart",
+        )
+        parser.add_argument(
+            "--completed",
+            type=float,
+            default=0.7,
+            help="Share of carts which are ordered",
+        )
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--batch-size", type=int, default=5000)
+        parser.add_argument(
+            "--no-copy",
+            action="store_true",
+            help="Use bulk_create even when COPY is available",
+        )
+
+    def handle(self, *args, **options):
+        generator = LoadDataGenerator(
+            seed=options["seed"],
+            batch_size=options["batch_size"],
+            use_copy=can_copy() and not options["no_copy"],
+            log=self.stdout.write,
+        )
+
+        product_pks = generator.generate_products(options["products"])
+        user_pks = generator.generate_users(options["users"])
+
+        if options["carts"]:
+            # Carts may also go to products and users generated earlier
+            product_pks = product_pks or list(
+                Product.objects.values_list("pk", flat=True)
+            )
+            user_pks = user_pks or list(
+                User.objects.values_list("pk", flat=True)
+            )
+            if not product_pks or not user_pks:
+                raise CommandError("Carts need at least one product and user")
+
+            generator.generate_carts(
+                options["carts"],
+                user_pks,
+                product_pks,
+                max_items=options["max_items"],
+                completed=options["completed"],
+            )
+
+        self.stdout.write(self.style.SUCCESS("Load data generated"))
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+__author__ = "Surya Banerjee"
+
+import gzip
+import sys
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+
+from autocompany.api.imports import (
+    IMPORT_BATCH_SIZE,
+    READERS,
+    ProductImporter,
+)
+from autocompany.api.load_data import can_copy
+
+SUFFIXES = {".csv": "csv", ".ndjson": "ndjson", ".jsonl": "ndjson"}
+
+
+class Command(BaseCommand):
+    help = (
+        "Create or update products from a CSV or NDJSON feed, matching "
+        "them on name. Rows are validated and written in batches, rejected "
+        "rows are reported and skipped."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "path",
+            help="CSV or NDJSON file, gzipped if it ends in .gz, or - for "
+            "standard input",
+        )
+        parser.add_argument(
+            "--format",
+            choices=list(READERS),
+            help="Format of the feed, by default from the file extension",
+        )
+        parser.add_argument(
+            "--batch-size", type=int, default=IMPORT_BATCH_SIZE
+        )
+        parser.add_argument(
+            "--no-copy",
+            action="store_true",
+            help="Use bulk_update and bulk_create even when COPY is "
+            "available",
+        )
+
+    def handle(self, *args, **options):
+        path = options["path"]
+        import_format = options["format"] or self.guess_format(path)
+
+        importer = ProductImporter(
+            batch_size=options["batch_size"],
+            use_copy=can_copy() and not options["no_copy"],
+            log=self.stdout.write,
+        )
+        try:
+            lines = self.open(path)
+        except OSError as exc:
+            raise CommandError(str(exc))
+        with lines:
+            report = importer.run(READERS[import_format](lines))
+
+        for rejected in report.errors:
+            self.stderr.write(
+                f"Line {rejected['line']}: "
+                + "; ".join(
+                    f"{field}: {message}"
+                    for field, message in rejected["errors"].items()
+                )
+            )
+        summary = report.as_dict()
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"{summary['created']} created, {summary['updated']} "
+                f"updated, {summary['rejected']} rejected, "
+                f"{summary['rows_per_second'] or 0:.0f} rows/s"
+            )
+        )
+
+    def guess_format(self, path):
+        suffixes = Path(path).suffixes
+        if suffixes and suffixes[-1] == ".gz":
+            suffixes = suffixes[:-1]
+        if not suffixes or suffixes[-1] not in SUFFIXES:
+            raise CommandError("Pass --format, it is not clear from the path")
+        return SUFFIXES[suffixes[-1]]
+
+    def open(self, path):
+        # utf-8-sig drops the byte order mark spreadsheets like to write
+        if path == "-":
+            sys.stdin.reconfigure(encoding="utf-8-sig", newline="")
+            return sys.stdin
+        if path.endswith(".gz"):
+            return gzip.open(path, "rt", encoding="utf-8-sig", newline="")
+        return open(path, encoding="utf-8-sig", newline="")
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+
+__author__ = "Surya Banerjee"
+
+import signal
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from autocompany.api.checkout import CheckoutWorker
+
+
+class Command(BaseCommand):
+    help = (
+        "Run the background steps of accepted checkouts. Polls the checkout "
+        "job table until stopped with SIGTERM or SIGINT, several workers can "
+        "run side by side."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int)
+        parser.add_argument(
+            "--poll-interval",
+            type=float,
+            default=settings.CHECKOUT_QUEUE["POLL_INTERVAL"],
+            help="Seconds to wait when no job is due",
+        )
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            help="Exit once no job is due instead of waiting for more",
+        )
+
+    def handle(self, *args, **options):
+        worker = CheckoutWorker(
+            batch_size=options["batch_size"], log=self.stdout.write
+        )
+        stopping = []
+
+        def stop(signum, frame):
+            stopping.append(signum)
+
+        # The batch being processed is finished before exiting
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+
+        while not stopping:
+            close_old_connections()
+            if worker.run_once():
+                continue
+            if options["once"]:
+                break
+            time.sleep(options["poll_interval"])
+        self.stdout.write(self.style.SUCCESS("Checkout worker stopped"))
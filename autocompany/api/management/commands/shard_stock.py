@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+
+__author__ = "Surya Banerjee"
+
+from django.core.management.base import BaseCommand, CommandError
+
+from autocompany.api.models import Product
+from autocompany.api.stock import set_stock_shards
+
+
+class Command(BaseCommand):
+    help = (
+        "Split the stock of hot products over several rows, so concurrent "
+        "checkouts of them don't queue on one row lock. Running it again "
+        "spreads the current stock anew, --shards 0 moves it back into the "
+        "product row."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("pks", type=int, nargs="+", metavar="pk")
+        parser.add_argument(
+            "--shards",
+            type=int,
+            default=8,
+            help="Rows to spread the stock of every product over",
+        )
+
+    def handle(self, *args, **options):
+        if options["shards"] < 0:
+            raise CommandError("Expected --shards of at least 0")
+        for pk in options["pks"]:
+            try:
+                stock = set_stock_shards(pk, options["shards"])
+            except Product.DoesNotExist:
+                raise CommandError(f"Product {pk} does not exist")
+            self.stdout.write(
+                self.style.SUCCESS(
+                    f"Product {pk}: {stock} in stock over "
+                    f"{options['shards']} shards"
+                )
+            )
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+
+__author__ = "Surya Banerjee"
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from autocompany.api.sweep import CartSweeper
+
+
+class Command(BaseCommand):
+    help = (
+        "Give back the stock held by open carts whose hold ran out, and "
+        "delete open carts which were not changed for a while. Meant to run "
+        "regularly, for example from cron every few minutes."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=settings.CART_EXPIRY["BATCH_SIZE"],
+            help="Carts locked and written per transaction",
+        )
+        parser.add_argument(
+            "--days",
+            type=int,
+            default=settings.CART_EXPIRY["OPEN_CART_DAYS"],
+            help="Delete open carts not changed for this many days",
+        )
+
+    def handle(self, *args, **options):
+        if options["batch_size"] <= 0 or options["days"] < 0:
+            raise CommandError("Expected a positive --batch-size and --days")
+
+        sweeper = CartSweeper(
+            batch_size=options["batch_size"],
+            open_cart_days=options["days"],
+            log=self.stdout.write,
+        )
+        summary = sweeper.run().as_dict()
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"{summary['released']} holds released, {summary['deleted']} "
+                f"carts and {summary['deleted_items']} items deleted, "
+                f"{summary['rows_per_second'] or 0:.0f} rows/s"
+            )
+        )
@@ -0,0 +1,405 @@
+#!/usr/bin/env python3
+
+__author__ = "Surya Banerjee"
+
+import asyncio
+import json
+import os
+import random
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+# Upper bounds in seconds of the request duration histogram
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Timed parts of a sampled request, in the order of the Server-Timing header
+PHASES = ("db", "serialize", "render")
+
+# Record of the request being handled, only set for sampled requests
+current_request = ContextVar("current_request", default=None)
+
+
+class RequestRecord:
+    """
+    Time spent in each phase of a sampled request and its number of queries
+    """
+
+    __slots__ = ("durations", "queries", "active")
+
+    def __init__(self):
+        self.durations = dict.fromkeys(PHASES, 0.0)
+        self.queries = 0
+        self.active = set()
+
+    @contextmanager
+    def timed(self, phase):
+        # Nested serializers are already counted by the outer one
+        if phase in self.active:
+            yield
+            return
+        self.active.add(phase)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.durations[phase] += time.perf_counter() - start
+            self.active.discard(phase)
+
+    def server_timing(self, total):
+        entries = [f"total;dur={total * 1000:.1f}"]
+        for phase in PHASES:
+            duration = f"{phase};dur={self.durations[phase] * 1000:.1f}"
+            if phase == "db":
+                duration += f';desc="{self.queries} queries"'
+            entries.append(duration)
+        return ", ".join(entries)
+
+
+@contextmanager
+def timed(phase):
+    """
+    Add the time of the block to `phase` of the current request, if it is
+    sampled
+    """
+    record = current_request.get()
+    if record is None:
+        yield
+    else:
+        with record.timed(phase):
+            yield
+
+
+class TimedSerializerMixin:
+    """
+    Count the representation of a serializer as serializer time of sampled
+    requests
+    """
+
+    def to_representation(self, instance):
+        record = current_request.get()
+        if record is None:
+            return super().to_representation(instance)
+        with record.timed("serialize"):
+            return super().to_representation(instance)
+
+
+def record_query(execute, sql, params, many, context):
+    record = current_request.get()
+    if record is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        record.durations["db"] += time.perf_counter() - start
+        record.queries += 1
+
+
+def instrument(connection):
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+@receiver(connection_created)
+def instrument_new_connection(sender, connection, **kwargs):
+    # Connections are per thread, async views query from other threads
+    instrument(connection)
+
+
+class MetricsRegistry:
+    """
+    Counters and histograms of the requests handled by this process,
+    rendered in the Prometheus text format.
+
+    With METRICS["DIR"] set, every process writes its counters to its own
+    file in that directory at most every METRICS["FLUSH_SECONDS"], and
+    rendering sums the files of all processes, including those which
+    exited, so counters never go back whichever process is scraped.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.lock = threading.Lock()
+        self.requests = defaultdict(int)
+        self.buckets = defaultdict(lambda: [0] * (len(DURATION_BUCKETS) + 1))
+        self.duration_sum = defaultdict(float)
+        self.sampled = defaultdict(int)
+        self.queries = defaultdict(int)
+        self.phases = defaultdict(float)
+        # A process reusing the pid of an exited one keeps its own file
+        self.file = f"{os.getpid()}-{time.time_ns()}.json"
+        self.flushed = 0
+
+    def observe(self, view, method, status, duration, record=None):
+        bucket = bisect_left(DURATION_BUCKETS, duration)
+        with self.lock:
+            self.requests[view, method, status] += 1
+            self.buckets[view][bucket] += 1
+            self.duration_sum[view] += duration
+            if record is not None:
+                self.sampled[view] += 1
+                self.queries[view] += record.queries
+                for phase, seconds in record.durations.items():
+                    self.phases[view, phase] += seconds
+        self.flush()
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "requests": [[*key, n] for key, n in self.requests.items()],
+                "buckets": dict(self.buckets),
+                "duration_sum": dict(self.duration_sum),
+                "sampled": dict(self.sampled),
+                "queries": dict(self.queries),
+                "phases": [[*key, n] for key, n in self.phases.items()],
+            }
+
+    def merge(self, snapshot):
+        with self.lock:
+            for view, method, status, n in snapshot["requests"]:
+                self.requests[view, method, status] += n
+            for view, counts in snapshot["buckets"].items():
+                self.buckets[view] = [
+                    a + b for a, b in zip(self.buckets[view], counts)
+                ]
+            for name in ("duration_sum", "sampled", "queries"):
+                totals = getattr(self, name)
+                for view, value in snapshot[name].items():
+                    totals[view] += value
+            for view, phase, seconds in snapshot["phases"]:
+                self.phases[view, phase] += seconds
+
+    def flush(self, force=False):
+        """
+        Write the counters of this process to the metrics directory, if
+        there is one and the last write is old enough
+        """
+        config = settings.METRICS
+        if not config["DIR"]:
+            return
+        started = time.monotonic()
+        if not force and started - self.flushed < config["FLUSH_SECONDS"]:
+            return
+        self.flushed = started
+        path = Path(config["DIR"]) / self.file
+        # Written aside and renamed, so readers never see half a file
+        partial = path.with_name(f"{self.file}.{threading.get_ident()}.tmp")
+        partial.write_text(json.dumps(self.snapshot()))
+        os.replace(partial, path)
+
+    def render(self):
+        """
+        The metrics of this process, or of every process sharing the
+        metrics directory
+        """
+        directory = settings.METRICS["DIR"]
+        if not directory:
+            return self.render_own()
+        self.flush(force=True)
+        total = MetricsRegistry()
+        for path in Path(directory).glob("*.json"):
+            try:
+                total.merge(json.loads(path.read_text()))
+            except (OSError, ValueError):
+                # Removed while reading
+                continue
+        return total.render_own()
+
+    def render_own(self):
+        with self.lock:
+            requests = [
+                ("", {"view": view, "method": method, "status": status}, n)
+                for (view, method, status), n in sorted(self.requests.items())
+            ]
+            durations = list(self.histogram_samples())
+            sampled = [
+                ("", {"view": view}, n)
+                for view, n in sorted(self.sampled.items())
+            ]
+            queries = [
+                ("", {"view": view}, n)
+                for view, n in sorted(self.queries.items())
+            ]
+            phases = [
+                ("", {"view": view, "phase": phase}, seconds)
+                for (view, phase), seconds in sorted(self.phases.items())
+            ]
+
+        return "".join(
+            [
+                render_metric(
+                    "requests_total", "counter", "Requests handled.", requests
+                ),
+                render_metric(
+                    "request_duration_seconds",
+                    "histogram",
+                    "Wall time of requests.",
+                    durations,
+                ),
+                render_metric(
+                    "sampled_requests_total",
+                    "counter",
+                    "Requests timed per phase.",
+                    sampled,
+                ),
+                render_metric(
+                    "sql_queries_total",
+                    "counter",
+                    "Queries of sampled requests.",
+                    queries,
+                ),
+                render_metric(
+                    "phase_seconds_total",
+                    "counter",
+                    "Time of sampled requests per phase.",
+                    phases,
+                ),
+            ]
+        )
+
+    def histogram_samples(self):
+        bounds = [str(bound) for bound in DURATION_BUCKETS] + ["+Inf"]
+        for view, counts in sorted(self.buckets.items()):
+            cumulative = 0
+            for bound, count in zip(bounds, counts):
+                cumulative += count
+                yield "_bucket", dict(view=view, le=bound), cumulative
+            yield "_sum", dict(view=view), self.duration_sum[view]
+            yield "_count", dict(view=view), cumulative
+
+
+def render_metric(name, kind, description, samples):
+    """
+    A metric in the Prometheus text format, samples are (name suffix,
+    labels, value) tuples
+    """
+    name = f"autocompany_{name}"
+    lines = [f"# HELP {name} {description}", f"# TYPE {name} {kind}"]
+    for suffix, labels, value in samples:
+        lines.append(f"{name}{suffix}{format_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def format_labels(labels):
+    def escape(value):
+        return (
+            str(value)
+            .replace("\\", "\\\\")
+            .replace('"', '\\"')
+            .replace("\n", "\\n")
+        )
+
+    return "{" + ",".join(
+        f'{name}="{escape(value)}"' for name, value in labels.items()
+    ) + "}"
+
+
+registry = MetricsRegistry()
+# Workers forked by uWSGI count their own requests from 0
+os.register_at_fork(after_in_child=registry.reset)
+
+
+def view_name(request):
+    """
+    Name of the view and action which handled the request, like
+    CartViewset.create
+    """
+    match = request.resolver_match
+    if match is None:
+        return "unmatched"
+    view = match.func
+    cls = getattr(view, "cls", None)
+    if cls is None:
+        return f"{view.__module__.rsplit('.', 1)[-1]}.{view.__name__}"
+    actions = getattr(view, "actions", None) or {}
+    action = actions.get(request.method.lower(), request.method.lower())
+    return f"{cls.__name__}.{action}"
+
+
+class RequestMetricsMiddleware:
+    """
+    Count and time every request, and break a sample of them down into
+    SQL, serializer and render time.
+
+    Sampled requests answer with a Server-Timing header. Everything is
+    collected per process and exposed by the /metrics endpoint.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        config = settings.METRICS
+        if not config["ENABLED"]:
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+        self.sample_rate = config["SAMPLE_RATE"]
+        self.is_async = asyncio.iscoroutinefunction(get_response)
+        if self.is_async:
+            # Marks the instance as a coroutine function to Django, as
+            # MiddlewareMixin does
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        record, token, start = self.start()
+        try:
+            response = self.get_response(request)
+        finally:
+            current_request.reset(token)
+        return self.finish(request, response, record, start)
+
+    async def __acall__(self, request):
+        record, token, start = self.start()
+        try:
+            response = await self.get_response(request)
+        finally:
+            current_request.reset(token)
+        return self.finish(request, response, record, start)
+
+    def start(self):
+        record = None
+        if self.sample_rate and random.random() < self.sample_rate:
+            record = RequestRecord()
+            for connection in connections.all():
+                instrument(connection)
+        return record, current_request.set(record), time.perf_counter()
+
+    def process_template_response(self, request, response):
+        # DRF responses are rendered after the view, time it separately
+        record = current_request.get()
+        if record is not None:
+            start = time.perf_counter()
+
+            def rendered(response):
+                record.durations["render"] += time.perf_counter() - start
+
+            response.add_post_render_callback(rendered)
+        return response
+
+    def finish(self, request, response, record, start):
+        duration = time.perf_counter() - start
+        registry.observe(
+            view_name(request),
+            request.method,
+            response.status_code,
+            duration,
+            record,
+        )
+        if record is not None:
+            response.headers["Server-Timing"] = record.server_timing(duration)
+        return response
@@ -0,0 +1,29 @@
+# Generated by Django 4.0.3 on 2026-10-18 14:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0002_product_updated_at_catalogversion'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='cart',
+            index=models.Index(fields=['user', 'order_completed'], name='cart_user_completed_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='cart',
+            index=models.Index(fields=['user', '-cart_creation_time'], name='cart_user_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='cart',
+            index=models.Index(condition=models.Q(('order_completed', False)), fields=['user', 'cart_creation_time'], name='cart_open_user_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['model', 'year'], name='product_model_year_idx'),
+        ),
+    ]
@@ -0,0 +1,69 @@
+# Generated by Django 4.0.3 on 2026-10-18 15:04
+
+from django.db import migrations, models
+from django.db.models import F, IntegerField, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+
+def capture_past_orders(apps, schema_editor):
+    # Past orders only know today's prices, the best snapshot there is
+    Cart = apps.get_model('api', 'Cart')
+    CartItem = apps.get_model('api', 'CartItem')
+    Product = apps.get_model('api', 'Product')
+
+    CartItem.objects.filter(cart__order_completed=True).update(
+        unit_price=Subquery(
+            Product.objects.filter(pk=OuterRef('product_id')).values('price')
+        )
+    )
+
+    def per_cart(expression):
+        return Subquery(
+            CartItem.objects.filter(cart_id=OuterRef('pk'))
+            .values('cart_id')
+            .annotate(value=Sum(expression, output_field=IntegerField()))
+            .values('value')
+        )
+
+    Cart.objects.filter(order_completed=True).update(
+        ordered_at=F('cart_creation_time'),
+        item_count=Coalesce(per_cart(F('quantity')), 0),
+        total_price=Coalesce(
+            per_cart(F('quantity') * F('unit_price')), 0
+        ),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0003_cart_product_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cart',
+            name='item_count',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='cart',
+            name='ordered_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='cart',
+            name='total_price',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='cartitem',
+            name='unit_price',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='cart',
+            index=models.Index(condition=models.Q(('order_completed', True)), fields=['user', '-ordered_at'], name='cart_order_history_idx'),
+        ),
+        migrations.RunPython(capture_past_orders, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,24 @@
+import autocompany.api.models
+import django.contrib.postgres.search
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0004_order_summary'),
+    ]
+
+    operations = [
+        # GIN indexes over a tsvector only exist on PostgreSQL, elsewhere the
+        # search falls back to an in-memory index
+        migrations.AddIndex(
+            model_name='product',
+            index=autocompany.api.models.PostgreSQLGinIndex(
+                django.contrib.postgres.search.SearchVector(
+                    'name', 'overview', 'model', config='english'
+                ),
+                name='product_search_idx',
+            ),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 4.0.3 on 2026-10-18 15:33
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.db.models.expressions
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0006_checkout_jobs'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DeliverySlot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('start', models.DateTimeField(unique=True)),
+                ('end', models.DateTimeField()),
+                ('capacity', models.IntegerField()),
+                ('booked', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='deliveryslot',
+            constraint=models.CheckConstraint(check=models.Q(('booked__gte', 0), ('booked__lte', django.db.models.expressions.F('capacity'))), name='delivery_slot_booked_within_capacity'),
+        ),
+        migrations.AddField(
+            model_name='cart',
+            name='delivery_slot',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='carts', to='api.deliveryslot'),
+        ),
+    ]
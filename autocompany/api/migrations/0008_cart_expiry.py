@@ -0,0 +1,44 @@
+# Generated by Django 4.0.3 on 2026-10-18 15:36
+
+from django.db import migrations, models
+from django.db.models import Q
+from django.db.models.functions import Coalesce
+import django.utils.timezone
+
+
+def backfill_updated_at(apps, schema_editor):
+    # The last activity known of existing carts. Leaving them at now()
+    # would make every old open cart look fresh to sweep_carts
+    Cart = apps.get_model('api', 'Cart')
+    Cart.objects.filter(
+        Q(ordered_at__isnull=False) | Q(cart_creation_time__isnull=False)
+    ).update(updated_at=Coalesce('ordered_at', 'cart_creation_time'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0007_delivery_slots'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cart',
+            name='held_until',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='cart',
+            name='updated_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.RunPython(backfill_updated_at, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='cart',
+            index=models.Index(condition=models.Q(('order_completed', False)), fields=['updated_at', 'id'], name='cart_open_updated_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='cart',
+            index=models.Index(condition=models.Q(('held_until__isnull', False)), fields=['held_until', 'id'], name='cart_held_idx'),
+        ),
+    ]
@@ -5,12 +5,32 @@ __author__ = "Surya Banerjee"
 import random
 import string
 
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVector
 from django.db import models
-from django.db.models.signals import pre_save
+from django.db.models.signals import pre_save, post_save, post_delete
 from django.dispatch import receiver
 from django.utils.timezone import now
 from django.contrib.auth.models import User
 
+from autocompany.api.cache import invalidate_products
+
+
+class PostgreSQLGinIndex(GinIndex):
+    """
+    A GIN index which only PostgreSQL has, other databases go without it
+    """
+
+    def create_sql(self, model, schema_editor, using="", **kwargs):
+        if schema_editor.connection.vendor != "postgresql":
+            return ""
+        return super().create_sql(model, schema_editor, using, **kwargs)
+
+    def remove_sql(self, model, schema_editor, **kwargs):
+        if schema_editor.connection.vendor != "postgresql":
+            return ""
+        return super().remove_sql(model, schema_editor, **kwargs)
+
 
 class Product(models.Model):
     """
@@ -21,6 +41,9 @@ class Product(models.Model):
     * Model: The car model the product is for
     * Year: Year of the car
     * Stock: Number of products available in inventory
+    * Stock shards: Number of StockShard rows holding more of the stock, 0
+      for products whose stock is only in this row
+    * Updated at: Last change of the product, including its unsharded stock
     """
 
     name = models.CharField(max_length=255, unique=True)
@@ -29,24 +52,241 @@ class Product(models.Model):
     year = models.DateField()
     stock = models.IntegerField(default=0)
     price = models.IntegerField(default=0)
+    stock_shards = models.IntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            # Browsing parts by car model and year
+            models.Index(
+                fields=["model", "year"], name="product_model_year_idx"
+            ),
+            # The full-text search filters on this exact expression, see
+            # search.search_vector
+            PostgreSQLGinIndex(
+                SearchVector("name", "overview", "model", config="english"),
+                name="product_search_idx",
+            ),
+        ]
 
     def __str__(self):
         return f"{self.pk}: {self.name}"
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Lets a save tell whether it sets the stock
+        instance._saved_stock = instance.__dict__.get("stock")
+        return instance
+
+
+class StockShard(models.Model):
+    """
+    A part of the stock of a product with sharded stock.
+
+    Checkouts of a hot product take their stock from a random shard, so
+    they don't all wait for the lock of the one product row.
+    """
+
+    product = models.ForeignKey(
+        Product, on_delete=models.CASCADE, related_name="shards"
+    )
+    shard = models.IntegerField()
+    stock = models.IntegerField(default=0)
+    updated_at = models.DateTimeField(default=now)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["product", "shard"], name="stock_shard_unique"
+            ),
+            models.CheckConstraint(
+                check=models.Q(stock__gte=0), name="stock_shard_not_negative"
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.product_id}/{self.shard}: {self.stock}"
+
+
+class CatalogVersion(models.Model):
+    """
+    Single row counter bumped on every product write.
+
+    Product lists are validated against it, so answering a conditional GET
+    does not need to scan the catalog.
+    """
+
+    version = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(default=now)
+
+    @classmethod
+    def current(cls):
+        current = cls.objects.values_list("version", "updated_at").first()
+        if current is None:
+            catalog = cls.objects.create(pk=1)
+            current = catalog.version, catalog.updated_at
+        return current
+
+    @classmethod
+    def bump(cls):
+        updated = cls.objects.filter(pk=1).update(
+            version=models.F("version") + 1, updated_at=now()
+        )
+        if not updated:
+            cls.objects.create(pk=1, version=1)
+
+
+class DeliverySlot(models.Model):
+    """
+    A delivery window which takes at most `capacity` orders.
+
+    `booked` counts the ordered carts in the slot. It only moves with
+    conditional UPDATEs, so availability is read from this table alone.
+    """
+
+    start = models.DateTimeField(unique=True)
+    end = models.DateTimeField()
+    capacity = models.IntegerField()
+    booked = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.CheckConstraint(
+                check=models.Q(booked__gte=0)
+                & models.Q(booked__lte=models.F("capacity")),
+                name="delivery_slot_booked_within_capacity",
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.pk}: {self.start} - {self.booked}/{self.capacity}"
+
 
 class Cart(models.Model):
     """
     This is the cart where we store the items ordered
     """
 
-    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="cart")
+    # Covered by the indexes starting with user below
+    user = models.ForeignKey(
+        User, on_delete=models.CASCADE, related_name="cart", db_index=False
+    )
     cart_creation_time = models.DateTimeField(null=True, blank=True, default=now)
     delivery_time = models.DateTimeField(null=True, blank=True)
+    # Booked while the order is completed, delivery_time is its start
+    delivery_slot = models.ForeignKey(
+        DeliverySlot,
+        on_delete=models.PROTECT,
+        related_name="carts",
+        null=True,
+        blank=True,
+    )
     order_completed = models.BooleanField(default=False)
+    # Order summary, captured when the order is completed and empty while
+    # the cart is open
+    ordered_at = models.DateTimeField(null=True, blank=True)
+    item_count = models.IntegerField(null=True, blank=True)
+    total_price = models.IntegerField(null=True, blank=True)
+    # Set by the checkout worker once the order went through its steps
+    confirmed_at = models.DateTimeField(null=True, blank=True)
+    # Last write of the cart or its items, open carts untouched for
+    # CART_EXPIRY["OPEN_CART_DAYS"] are removed by sweep_carts
+    updated_at = models.DateTimeField(default=now)
+    # While set the open cart holds the stock of its items, sweep_carts
+    # gives it back once the time passed
+    held_until = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["user", "order_completed"],
+                name="cart_user_completed_idx",
+            ),
+            models.Index(
+                fields=["user", "-cart_creation_time"],
+                name="cart_user_created_idx",
+            ),
+            # Open carts are a small, hot part of all carts
+            models.Index(
+                fields=["user", "cart_creation_time"],
+                condition=models.Q(order_completed=False),
+                name="cart_open_user_idx",
+            ),
+            # Order history, newest orders first
+            models.Index(
+                fields=["user", "-ordered_at"],
+                condition=models.Q(order_completed=True),
+                name="cart_order_history_idx",
+            ),
+            # Keyset order of the sweeps of stale carts and expired holds
+            models.Index(
+                fields=["updated_at", "id"],
+                condition=models.Q(order_completed=False),
+                name="cart_open_updated_idx",
+            ),
+            models.Index(
+                fields=["held_until", "id"],
+                condition=models.Q(held_until__isnull=False),
+                name="cart_held_idx",
+            ),
+        ]
 
     def __str__(self):
         return f"{self.pk}: Completed - {self.order_completed}"
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(Cart, cls).from_db(db, field_names, values)
+        # Remember the stored order state so transitions need no extra query
+        instance._saved_order_completed = instance.__dict__.get(
+            "order_completed"
+        )
+        if "delivery_slot_id" in instance.__dict__:
+            instance._saved_delivery_slot_id = instance.delivery_slot_id
+        if "held_until" in instance.__dict__:
+            instance._saved_held_until = instance.held_until
+        return instance
+
+    def saved_order_completed(self):
+        """
+        Order state as it was last loaded from or written to the database
+        """
+        saved = getattr(self, "_saved_order_completed", None)
+        if saved is None and self.pk is not None:
+            saved = (
+                Cart.objects.filter(pk=self.pk)
+                .values_list("order_completed", flat=True)
+                .first()
+            )
+            self._saved_order_completed = saved
+        return saved
+
+    def saved_delivery_slot_id(self):
+        """
+        Delivery slot as it was last loaded from or written to the database
+        """
+        if not hasattr(self, "_saved_delivery_slot_id"):
+            self._saved_delivery_slot_id = (
+                Cart.objects.filter(pk=self.pk)
+                .values_list("delivery_slot_id", flat=True)
+                .first()
+            )
+        return self._saved_delivery_slot_id
+
+    def saved_held_until(self):
+        """
+        End of the stock hold as last loaded from or written to the
+        database, None if the cart holds no stock as an open cart
+        """
+        if not hasattr(self, "_saved_held_until"):
+            self._saved_held_until = (
+                Cart.objects.filter(pk=self.pk)
+                .values_list("held_until", flat=True)
+                .first()
+            )
+        return self._saved_held_until
+
 
 class CartItem(models.Model):
     """
@@ -58,42 +298,109 @@ class CartItem(models.Model):
         Product, on_delete=models.SET_NULL, related_name="cartItems", null=True
     )
     quantity = models.IntegerField(default=0)
+    # Price of the product when the order was completed
+    unit_price = models.IntegerField(null=True, blank=True)
 
     def __str__(self):
         return f"Item-{self.product.name} : Quantity-{self.quantity}"
 
 
-@receiver(pre_save, sender=CartItem)
-def update_stock_for_new_cart(sender, instance, **kwargs):
-    # If its a new cart and order is complete remove stock
-    if instance.pk is None and instance.cart.order_completed:
-        update_stock(instance)
+class CheckoutJob(models.Model):
+    """
+    Background work of a checkout, run by the run_checkout_worker command.
+
+    Jobs are created in the transaction which places the order, so every
+    ordered cart has one, and the idempotency key makes sure it is only
+    one.
+    """
+
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+    STATUSES = [
+        (PENDING, "Pending"),
+        (RUNNING, "Running"),
+        (DONE, "Done"),
+        (FAILED, "Failed"),
+        (CANCELLED, "Cancelled"),
+    ]
+
+    cart = models.ForeignKey(
+        Cart, on_delete=models.CASCADE, related_name="checkout_jobs"
+    )
+    idempotency_key = models.CharField(max_length=255, unique=True)
+    status = models.CharField(max_length=16, choices=STATUSES, default=PENDING)
+    attempts = models.IntegerField(default=0)
+    # Not claimed before, pushed back after every failed attempt
+    run_after = models.DateTimeField(default=now)
+    locked_at = models.DateTimeField(null=True, blank=True)
+    locked_by = models.CharField(max_length=255, blank=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(default=now)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # The workers poll for due jobs and expired leases only
+            models.Index(
+                fields=["run_after"],
+                condition=models.Q(status="pending"),
+                name="checkout_job_due_idx",
+            ),
+            models.Index(
+                fields=["locked_at"],
+                condition=models.Q(status="running"),
+                name="checkout_job_running_idx",
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.pk}: Cart {self.cart_id} - {self.status}"
+
+
+@receiver([post_save, post_delete], sender=Product)
+def invalidate_cached_product(sender, instance, **kwargs):
+    CatalogVersion.bump()
+    invalidate_products([instance.pk])
+
+
+@receiver(post_save, sender=Product)
+def spread_sharded_stock(sender, instance, **kwargs):
+    from autocompany.api.stock import set_stock_shards
+
+    # Stock saved on a product with sharded stock is its new stock, which
+    # belongs in the shards
+    stock = instance.__dict__.get("stock")
+    if stock is None or stock == getattr(instance, "_saved_stock", None):
+        return
+    if instance.stock_shards:
+        set_stock_shards(instance.pk, instance.stock_shards, stock=stock)
+        instance.stock = 0
+    instance._saved_stock = instance.stock
 
 
 @receiver(pre_save, sender=Cart)
 def update_stock_for_existing_carts(sender, instance, **kwargs):
-    # If existing cart is modified
-    if instance.pk is not None:
-        new_cart = instance
-        old_cart = Cart.objects.get(pk=instance.pk)
+    from autocompany.api.services import apply_order_transition
+
+    # If the order state of an existing cart changed, move the stock
+    apply_order_transition(instance)
+    instance.updated_at = now()
 
-        # If order is reversed, add stock back
-        if old_cart.order_completed and not new_cart.order_completed:
-            for item in instance.items.all():
-                update_stock(item, add_stock=True)
 
-        # If old cart order complete remove stock
-        elif new_cart.order_completed and not old_cart.order_completed:
-            for item in instance.items.all():
-                update_stock(item)
+@receiver(post_save, sender=Cart)
+def track_saved_order_state(sender, instance, **kwargs):
+    instance._saved_order_completed = instance.order_completed
+    instance._saved_delivery_slot_id = instance.delivery_slot_id
+    instance._saved_held_until = instance.held_until
 
 
 def update_stock(item, add_stock=False):
-    product = item.product
+    from autocompany.api.stock import reserve_stock, release_stock
 
     if add_stock:
-        product.stock = product.stock + item.quantity
+        release_stock([item])
     else:
-        product.stock = product.stock - item.quantity
-
-    product.save()
+        reserve_stock([item])
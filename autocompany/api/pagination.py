@@ -0,0 +1,30 @@
+#!/usr/bin/env python3
+
+__author__ = "Surya Banerjee"
+
+from rest_framework.pagination import CursorPagination
+
+
+class ProductCursorPagination(CursorPagination):
+    """
+    Keyset pagination over the product primary key.
+
+    Each page continues from the last seen pk, so deep pages cost an index
+    range scan instead of an OFFSET over all the rows before them.
+    """
+
+    ordering = "pk"
+    page_size = 100
+    page_size_query_param = "page_size"
+    max_page_size = 1000
+
+
+class OrderHistoryPagination(CursorPagination):
+    """
+    Keyset pagination over completed orders, newest first
+    """
+
+    ordering = ("-ordered_at", "-pk")
+    page_size = 50
+    page_size_query_param = "page_size"
+    max_page_size = 500
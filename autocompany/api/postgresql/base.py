@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+
+__author__ = "Surya Banerjee"
+
+import os
+import threading
+
+import psycopg2
+import psycopg2.extensions
+import psycopg2.extras
+from django.db.backends.postgresql import base
+from django.db.backends.postgresql.creation import (
+    DatabaseCreation as BaseDatabaseCreation,
+)
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+class ConnectionPool:
+    """
+    Bounded pool of open psycopg2 connections.
+
+    At most `max_size` connections are handed out at once, acquire waits up
+    to `timeout` seconds for one to come back. Returned connections are
+    rolled back and kept for the next acquire.
+    """
+
+    def __init__(self, connect, max_size, timeout):
+        self.connect = connect
+        self.max_size = max_size
+        self.timeout = timeout
+        self.created = 0
+        self.reused = 0
+        self._idle = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_size)
+
+    def acquire(self, check=False):
+        """
+        Return an open connection, checking it with a round trip first when
+        `check` is set
+        """
+        if not self._slots.acquire(timeout=self.timeout):
+            raise psycopg2.OperationalError(
+                f"No free database connection within {self.timeout}s, "
+                f"all {self.max_size} are in use"
+            )
+        try:
+            while True:
+                with self._lock:
+                    connection = self._idle.pop() if self._idle else None
+                if connection is None:
+                    connection = self.connect()
+                    self.created += 1
+                    return connection
+                if not connection.closed and (
+                    not check or is_usable(connection)
+                ):
+                    self.reused += 1
+                    return connection
+                self.discard(connection)
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def release(self, connection, discard=False):
+        try:
+            if not discard and not connection.closed:
+                status = connection.info.transaction_status
+                if status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    connection.rollback()
+                with self._lock:
+                    self._idle.append(connection)
+                return
+        except psycopg2.Error:
+            pass
+        finally:
+            self._slots.release()
+        self.discard(connection)
+
+    def close_idle(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            self.discard(connection)
+
+    def discard(self, connection):
+        try:
+            connection.close()
+        except psycopg2.Error:
+            pass
+
+    def stats(self):
+        return {
+            "created": self.created,
+            "reused": self.reused,
+            "idle": len(self._idle),
+            "max_size": self.max_size,
+        }
+
+
+def is_usable(connection):
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1")
+        return True
+    except psycopg2.Error:
+        return False
+
+
+def get_pool(alias, settings_dict, conn_params):
+    """
+    Return the pool of a database alias and its connection parameters in
+    this process, a forked worker never shares the pool of its parent
+    """
+    key = (alias, os.getpid(), repr(sorted(conn_params.items())))
+    with _pools_lock:
+        if key not in _pools:
+            config = settings_dict.get("POOL") or {}
+            _pools[key] = ConnectionPool(
+                lambda: psycopg2.connect(**conn_params),
+                config.get("MAX_SIZE", 10),
+                config.get("TIMEOUT", 10),
+            )
+        return _pools[key]
+
+
+def close_idle_connections():
+    with _pools_lock:
+        pools = list(_pools.values())
+    for pool in pools:
+        pool.close_idle()
+
+
+class DatabaseCreation(BaseDatabaseCreation):
+    def _destroy_test_db(self, test_database_name, verbosity):
+        # Idle pooled connections would keep the test database in use
+        close_idle_connections()
+        super()._destroy_test_db(test_database_name, verbosity)
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    """
+    The stock PostgreSQL backend with two additions:
+
+    * CONN_HEALTH_CHECKS, a persistent connection is checked with a round
+      trip the first time a request uses it, and reopened if it broke
+    * POOL, connections are taken from a pool of this process and given
+      back on close instead of being opened and closed every time
+
+    A pool is meant for CONN_MAX_AGE = 0, where Django closes the
+    connection when a request finishes. Under ASGI that is the only way a
+    connection gets used by more than one request.
+    """
+
+    creation_class = DatabaseCreation
+
+    health_check_done = False
+
+    @property
+    def pool(self):
+        if not self.settings_dict.get("POOL"):
+            return None
+        return get_pool(
+            self.alias, self.settings_dict, self.get_connection_params()
+        )
+
+    def connect(self):
+        super().connect()
+        # A connection fresh from the server or the pool needs no check
+        self.health_check_done = True
+
+    def close_if_unusable_or_obsolete(self):
+        # Called when a request starts and finishes
+        self.health_check_done = False
+        super().close_if_unusable_or_obsolete()
+
+    def close_if_health_check_failed(self):
+        if (
+            self.connection is None
+            or self.health_check_done
+            or not self.settings_dict.get("CONN_HEALTH_CHECKS")
+        ):
+            return
+        if not self.is_usable():
+            self.close()
+        self.health_check_done = True
+
+    def _cursor(self, name=None):
+        self.close_if_health_check_failed()
+        return super()._cursor(name)
+
+    def get_new_connection(self, conn_params):
+        pool = self.pool
+        if pool is None:
+            return super().get_new_connection(conn_params)
+
+        connection = pool.acquire(
+            check=self.settings_dict.get("CONN_HEALTH_CHECKS", False)
+        )
+        # The same session setup as the stock backend
+        options = self.settings_dict["OPTIONS"]
+        self.isolation_level = options.get(
+            "isolation_level", connection.isolation_level
+        )
+        if self.isolation_level != connection.isolation_level:
+            connection.set_session(isolation_level=self.isolation_level)
+        psycopg2.extras.register_default_jsonb(
+            conn_or_curs=connection, loads=lambda x: x
+        )
+        return connection
+
+    def _close(self):
+        pool = self.pool
+        if pool is None or self.connection is None:
+            return super()._close()
+
+        # A connection that failed may be broken, don't hand it out again
+        with self.wrap_database_errors:
+            pool.release(self.connection, discard=self.errors_occurred)
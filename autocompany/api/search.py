@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+
+__author__ = "Surya Banerjee"
+
+import bisect
+import re
+import threading
+from collections import defaultdict
+from datetime import date
+
+from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVector
+from django.db import connection
+from django.db.models import Count, Exists, F, OuterRef, Q
+from django.db.models.functions import ExtractYear
+from rest_framework import serializers
+
+from autocompany.api.models import CatalogVersion, Product, StockShard
+
+SEARCH_FIELDS = ("name", "overview", "model")
+SEARCH_CONFIG = "english"
+
+# Number of values returned per facet
+FACET_SIZE = 20
+
+WORD_RE = re.compile(r"\w+")
+
+
+def search_vector():
+    """
+    The tsvector the search filters on, it has to be the exact expression
+    of the GIN index of Product for PostgreSQL to use the index
+    """
+    return SearchVector(*SEARCH_FIELDS, config=SEARCH_CONFIG)
+
+
+def words(text):
+    return WORD_RE.findall(text.lower())
+
+
+class InvertedIndex:
+    """
+    In-memory map of words to product pks, the full-text search on
+    databases other than PostgreSQL.
+
+    Every word of the query has to match a word of the product, as the
+    start of it, so "tyre" finds "tyres".
+    """
+
+    def __init__(self, rows):
+        postings = defaultdict(set)
+        for pk, *texts in rows:
+            for text in texts:
+                for word in words(text):
+                    postings[word].add(pk)
+        self.postings = dict(postings)
+        self.vocabulary = sorted(self.postings)
+
+    def match(self, query):
+        """
+        Return the set of pks matching every word of the query
+        """
+        result = None
+        for term in words(query):
+            start = bisect.bisect_left(self.vocabulary, term)
+            pks = set()
+            for word in self.vocabulary[start:]:
+                if not word.startswith(term):
+                    break
+                pks |= self.postings[word]
+            result = pks if result is None else result & pks
+            if not result:
+                break
+        return result or set()
+
+
+_inverted_index = (None, None)
+_inverted_index_lock = threading.Lock()
+
+
+def get_inverted_index():
+    """
+    Return the inverted index of the current catalog version, rebuilt when
+    products were written since it was built
+    """
+    global _inverted_index
+
+    version = CatalogVersion.current()
+    with _inverted_index_lock:
+        built_for, index = _inverted_index
+        if built_for != version:
+            index = InvertedIndex(
+                Product.objects.values_list("pk", *SEARCH_FIELDS).iterator()
+            )
+            _inverted_index = (version, index)
+        return index
+
+
+_catalog_counts = (None, None)
+_catalog_counts_lock = threading.Lock()
+
+
+def get_catalog_counts():
+    """
+    Return the product count and facets of the whole catalog, what a
+    search without query or filters finds, recounted when products were
+    written since they were counted
+    """
+    global _catalog_counts
+
+    version = CatalogVersion.current()
+    with _catalog_counts_lock:
+        counted_for, counts = _catalog_counts
+        if counted_for != version:
+            search = ProductSearch({})
+            counts = (search.queryset().count(), search.count_facets())
+            _catalog_counts = (version, counts)
+        return counts
+
+
+class ProductSearchSerializer(serializers.Serializer):
+    """
+    Query parameters of the product search
+    """
+
+    q = serializers.CharField(required=False, allow_blank=True)
+    model = serializers.CharField(required=False)
+    year_min = serializers.IntegerField(required=False, min_value=1)
+    year_max = serializers.IntegerField(required=False, max_value=9998)
+    price_min = serializers.IntegerField(required=False)
+    price_max = serializers.IntegerField(required=False)
+    in_stock = serializers.BooleanField(required=False, allow_null=True)
+    page_size = serializers.IntegerField(
+        required=False, default=20, min_value=1, max_value=100
+    )
+
+
+class ProductSearch:
+    """
+    Full-text search over the catalog with range filters and facets.
+
+    PostgreSQL matches the query against a GIN indexed tsvector and ranks
+    the results. Other databases use the in-memory inverted index and
+    order the results by pk.
+    """
+
+    facet_fields = ("model", "year")
+
+    def __init__(self, params):
+        self.params = params
+        self.use_postgres = connection.vendor == "postgresql"
+        self.query = params.get("q", "").strip()
+
+    def filters(self):
+        """
+        Lookups of the search grouped by facet field, lookups that belong to
+        no facet are under None
+        """
+        params = self.params
+        filters = defaultdict(dict)
+        if params.get("model"):
+            filters["model"]["model"] = params["model"]
+        if params.get("year_min") is not None:
+            filters["year"]["year__gte"] = date(params["year_min"], 1, 1)
+        if params.get("year_max") is not None:
+            filters["year"]["year__lt"] = date(params["year_max"] + 1, 1, 1)
+        if params.get("price_min") is not None:
+            filters[None]["price__gte"] = params["price_min"]
+        if params.get("price_max") is not None:
+            filters[None]["price__lte"] = params["price_max"]
+        if params.get("in_stock") is not None:
+            in_stock = Q(stock__gt=0) | Exists(
+                StockShard.objects.filter(product=OuterRef("pk"), stock__gt=0)
+            )
+            filters[None]["in_stock"] = (
+                in_stock if params["in_stock"] else ~in_stock
+            )
+        return filters
+
+    def queryset(self, exclude=None):
+        """
+        Products matching the query and every filter but the one of the
+        facet `exclude`
+        """
+        products = Product.objects.all()
+        if self.query:
+            if self.use_postgres:
+                products = products.annotate(search=search_vector()).filter(
+                    search=self.search_query()
+                )
+            else:
+                products = products.filter(
+                    pk__in=get_inverted_index().match(self.query)
+                )
+        for field, lookups in self.filters().items():
+            if field is None or field != exclude:
+                # Lookups are keyword arguments or already Q objects
+                products = products.filter(
+                    *[
+                        value if isinstance(value, Q) else Q(**{key: value})
+                        for key, value in lookups.items()
+                    ]
+                )
+        return products
+
+    def search_query(self):
+        return SearchQuery(
+            self.query, config=SEARCH_CONFIG, search_type="websearch"
+        )
+
+    def results(self, fields):
+        products = self.queryset()
+        if self.query and self.use_postgres:
+            products = products.annotate(
+                rank=SearchRank(search_vector(), self.search_query())
+            ).order_by("-rank", "pk")
+        else:
+            products = products.order_by("pk")
+        return list(products.values(*fields)[:self.params["page_size"]])
+
+    def matches_everything(self):
+        return not self.query and not self.filters()
+
+    def count(self):
+        # Counting the whole catalog is a scan of it
+        if self.matches_everything():
+            return get_catalog_counts()[0]
+        return self.queryset().count()
+
+    def facets(self):
+        if self.matches_everything():
+            return get_catalog_counts()[1]
+        return self.count_facets()
+
+    def count_facets(self):
+        """
+        Product counts per model and per year. Each facet leaves out its
+        own filter, so the other values stay visible once one is picked.
+        """
+        facets = {}
+        for field in self.facet_fields:
+            products = self.queryset(exclude=field)
+            if field == "year":
+                products = products.annotate(value=ExtractYear("year"))
+            else:
+                products = products.annotate(value=F(field))
+            counts = (
+                products.order_by()
+                .values("value")
+                .annotate(count=Count("pk"))
+                .order_by("-count", "value")[:FACET_SIZE]
+            )
+            facets[field] = list(counts)
+        return facets
@@ -2,20 +2,100 @@
 
 __author__ = "Surya Banerjee"
 
-from rest_framework import serializers, status
-from rest_framework.exceptions import APIException
-from drf_writable_nested.serializers import WritableNestedModelSerializer
+from django.db import transaction
+from django.utils.timezone import now
+from rest_framework import serializers
 
+from autocompany.api.checkout import enqueue_checkout
+from autocompany.api.delivery import DeliverySlotFull, book_slot
+from autocompany.api.metrics import TimedSerializerMixin
 from autocompany.api.models import Product, Cart, CartItem
+from autocompany.api.services import load_cart_items, sync_cart_items
+from autocompany.api.stock import (
+    InsufficientStock,
+    quantities_by_product,
+    shard_totals,
+    total_stock,
+)
 
 
-class CartItemSerializer(serializers.ModelSerializer):
+class CartItemSerializer(TimedSerializerMixin, serializers.ModelSerializer):
+    # Products are resolved for all items at once in CartSerializer, instead
+    # of one query per item by a PrimaryKeyRelatedField
+    product = serializers.IntegerField(source="product_id")
+    quantity = serializers.IntegerField(min_value=1)
+
     class Meta:
         model = CartItem
-        fields = ["product", "quantity"]
+        fields = ["product", "quantity", "unit_price"]
+        read_only_fields = ["unit_price"]
+
+
+class CartItemUpdateSerializer(CartItemSerializer):
+    # A quantity of 0 removes the line
+    quantity = serializers.IntegerField(min_value=0)
+
+
+def cart_lines(items):
+    """
+    Validated cart items as a dict of product pk to summed quantity
+    """
+    return quantities_by_product(
+        (item["product_id"], item["quantity"]) for item in items
+    )
+
+
+def load_stock(pks, lock=False):
+    """
+    Stock of the products by pk, with that of their shards, in a single
+    query plus one for sharded products. With `lock` the rows are locked
+    in pk order until the end of the transaction, except those of products
+    with sharded stock, whose shards are reserved with conditional
+    UPDATEs. Unknown pks are left out.
+    """
+    products = Product.objects.only("pk", "stock", "stock_shards")
+    if lock:
+        locked = products.select_for_update().filter(
+            pk__in=pks, stock_shards=0
+        )
+        locked = {product.pk: product for product in locked.order_by("pk")}
+        rest = [pk for pk in pks if pk not in locked]
+        products = {**locked, **products.in_bulk(rest)} if rest else locked
+    else:
+        products = products.in_bulk(list(pks))
+
+    sharded = [pk for pk, product in products.items() if product.stock_shards]
+    totals = shard_totals(sharded) if sharded else {}
+    return {
+        pk: product.stock + totals.get(pk, (0, None))[0]
+        for pk, product in products.items()
+    }
 
 
-class CartSerializer(WritableNestedModelSerializer):
+def unknown_product(pk):
+    return serializers.ValidationError(
+        {"product": f'Invalid pk "{pk}" - object does not exist.'}
+    )
+
+
+def check_stock(quantities, lock=False, held=None):
+    """
+    Check the requested quantity of every product against its stock, see
+    load_stock. Quantities in `held` are held by the cart already, only
+    what it needs on top of them has to be in stock.
+    """
+    held = held or {}
+    stock = load_stock(quantities, lock)
+    for pk in quantities:
+        if pk not in stock:
+            raise unknown_product(pk)
+    for pk, quantity in quantities.items():
+        if stock[pk] < quantity - held.get(pk, 0):
+            raise InsufficientStock()
+    return stock
+
+
+class CartSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     items = CartItemSerializer(many=True)
 
     class Meta:
@@ -24,33 +104,140 @@ class CartSerializer(WritableNestedModelSerializer):
             "pk",
             "cart_creation_time",
             "delivery_time",
+            "delivery_slot",
             "order_completed",
+            "ordered_at",
+            "item_count",
+            "total_price",
+            "confirmed_at",
             "items",
         ]
+        read_only_fields = [
+            "ordered_at",
+            "item_count",
+            "total_price",
+            "confirmed_at",
+        ]
+
+    def get_fields(self):
+        fields = super().get_fields()
+        # Lines of a cart being changed may drop to 0
+        if self.instance is not None:
+            fields["items"] = CartItemUpdateSerializer(many=True)
+        return fields
+
+    def is_checkout(self):
+        """
+        Whether this save leaves the cart ordered, so its stock is taken
+        """
+        completed = self.initial_data.get("order_completed")
+        if completed is None:
+            return bool(self.instance and self.instance.order_completed)
+        try:
+            return self.fields["order_completed"].to_internal_value(completed)
+        except serializers.ValidationError:
+            return False
+
+    def validate_delivery_slot(self, slot):
+        if slot is None or (
+            self.instance and self.instance.delivery_slot_id == slot.pk
+        ):
+            return slot
+        if slot.start <= now():
+            raise serializers.ValidationError(
+                "This delivery slot has already started."
+            )
+        # Fails early, the booking itself checks the capacity again
+        if self.is_checkout() and slot.booked >= slot.capacity:
+            raise DeliverySlotFull()
+        return slot
+
+    def validate(self, attrs):
+        slot = attrs.get("delivery_slot")
+        if slot is not None:
+            attrs["delivery_time"] = slot.start
+        return attrs
 
     def validate_items(self, data):
-        for item in data:
-            if item["product"].stock < item["quantity"]:
-                e = APIException(
-                    {"quantity": "higher number of quantity requested than in stock"}
-                )
-                e.status_code = status.HTTP_400_BAD_REQUEST
-                raise e
+        # Lines with a quantity of 0 are only checked for their product
+        quantities = dict.fromkeys((item["product_id"] for item in data), 0)
+        # Duplicate lines of a product are checked together
+        quantities.update(cart_lines(data))
+        # A batch checks the stock of all its operations at once
+        if self.context.get("stock_checked"):
+            return data
+        held = None
+        cart = self.instance
+        if cart is not None and (cart.order_completed or cart.held_until):
+            # What the cart holds already is not taken again, its items are
+            # written from the same rows
+            self.existing_items = load_cart_items(cart)
+            held = quantities_by_product(self.existing_items)
+        check_stock(quantities, lock=self.is_checkout(), held=held)
         return data
 
     def create(self, validated_data):
         request = self.context.get("request")
         validated_data["user"] = request.user
-        return super(CartSerializer, self).create(validated_data)
+        items = validated_data.pop("items", [])
+        checkout_key = validated_data.pop("checkout_key", None)
+        with transaction.atomic():
+            cart = Cart.objects.create(**validated_data)
+            # Items of an already ordered cart are reserved right away
+            sync_cart_items(cart, cart_lines(items), existing=[])
+            if cart.order_completed:
+                book_slot(cart.delivery_slot_id)
+                enqueue_checkout(cart, checkout_key)
+        return cart
+
+    def update(self, instance, validated_data):
+        items = validated_data.pop("items", None)
+        # Picked up by place_order if this save places the order
+        instance._checkout_key = validated_data.pop("checkout_key", None)
+        with transaction.atomic():
+            # Items change first, so an order transition in the same save
+            # moves the stock of the new items
+            if items is not None:
+                sync_cart_items(
+                    instance,
+                    cart_lines(items),
+                    getattr(self, "existing_items", None),
+                )
+            return super(CartSerializer, self).update(instance, validated_data)
 
 
-class ProductListSerializer(serializers.ModelSerializer):
+class OrderSummarySerializer(TimedSerializerMixin, serializers.ModelSerializer):
+    class Meta:
+        model = Cart
+        fields = [
+            "pk",
+            "ordered_at",
+            "delivery_time",
+            "item_count",
+            "total_price",
+        ]
+
+
+class ProductListSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = Product
         fields = ["pk", "name", "overview"]
 
 
-class ProductDetailSerializer(serializers.ModelSerializer):
+class ProductDetailSerializer(
+    TimedSerializerMixin, serializers.ModelSerializer
+):
     class Meta:
         model = Product
         fields = ["pk", "name", "overview", "model", "year", "stock", "price"]
+
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        if instance.stock_shards:
+            data["stock"], _ = total_stock(
+                instance.pk,
+                instance.stock,
+                instance.stock_shards,
+                instance.updated_at,
+            )
+        return data
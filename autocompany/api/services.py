@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+
+__author__ = "Surya Banerjee"
+
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Case, IntegerField, Value, When
+from django.utils.timezone import now
+
+from autocompany.api.checkout import cancel_checkout, enqueue_checkout
+from autocompany.api.delivery import book_slot, move_slot, release_slot
+from autocompany.api.models import Cart, CartItem
+from autocompany.api.stock import (
+    adjust_stock,
+    quantities_by_product,
+    reserve_stock,
+    release_stock,
+)
+
+# An order moves between these states through `order_completed`:
+#
+#   open --place_order--> completed --reverse_order--> open
+#
+# Stock is held while the order is completed, and the order summary
+# (prices of the lines, item count and total) only exists while it is.
+# With CART_EXPIRY["HOLD_SECONDS"] set, an open cart also holds the stock
+# of its items until `held_until`, which every change of the items pushes
+# back. sweep_carts releases the holds which ran out, and placing the
+# order takes the held stock over. The functions below trust the state the
+# cart was loaded with, callers writing a cart load it with
+# select_for_update() so no sweep or other request changes it meanwhile.
+# Placing an order enqueues its CheckoutJob, reversing it cancels the job
+# if the worker did not pick it up yet. The delivery slot of the cart is
+# booked the same way as the stock, only while the order is completed.
+
+
+def _cart_lines(cart):
+    return cart.items.values_list("product_id", "quantity")
+
+
+def _order_lines(cart):
+    return list(
+        cart.items.values_list(
+            "pk", "product_id", "quantity", "unit_price", "product__price"
+        )
+    )
+
+
+def place_order(cart):
+    """
+    Reserve stock for every item in the cart and book its delivery slot,
+    fails if any line is short or the slot is full, and capture the order
+    summary on the cart
+    """
+    lines = _order_lines(cart)
+    held = cart.saved_held_until() is not None
+    reserve_stock(take_order(cart, lines, held))
+    enqueue_checkout(cart, getattr(cart, "_checkout_key", None))
+
+
+def take_order(cart, lines, held=False):
+    """
+    Book the delivery slot of a cart being ordered, end its stock hold and
+    capture its order summary, from `lines` as returned by _order_lines.
+    Returns the (product pk, quantity) pairs the order still has to
+    reserve, none if the cart held its stock, so callers ordering many
+    carts reserve them all at once.
+    """
+    cart.held_until = None
+    book_slot(cart.delivery_slot_id)
+    capture_order_summary(cart, lines)
+    if held:
+        return []
+    return [(line[1], line[2]) for line in lines]
+
+
+def reverse_order(cart):
+    """
+    Give the stock held by an ordered cart back to the inventory and drop
+    its order summary
+    """
+    release_stock(_cart_lines(cart))
+    release_slot(cart.saved_delivery_slot_id())
+    cart.items.update(unit_price=None)
+    cart.ordered_at = cart.item_count = cart.total_price = None
+    cart.confirmed_at = None
+    cancel_checkout(cart)
+
+
+def capture_order_summary(cart, lines, save=False):
+    """
+    Snapshot the current price of every line without one and set the item
+    count and total price of the cart, from `lines` as returned by
+    _order_lines. The cart is only written with `save`, other callers save
+    it anyway.
+    """
+    prices = {}
+    item_count = total_price = 0
+    for pk, _, quantity, unit_price, price in lines:
+        if unit_price is None and price is not None:
+            unit_price = prices[pk] = price
+        item_count += quantity
+        total_price += quantity * (unit_price or 0)
+
+    if prices:
+        CartItem.objects.filter(pk__in=prices).update(
+            unit_price=Case(
+                *[When(pk=pk, then=Value(price))
+                  for pk, price in prices.items()],
+                output_field=IntegerField(),
+            )
+        )
+    cart.item_count = item_count
+    cart.total_price = total_price
+    if cart.ordered_at is None:
+        cart.ordered_at = now()
+
+    if save:
+        Cart.objects.filter(pk=cart.pk).update(
+            ordered_at=cart.ordered_at,
+            item_count=cart.item_count,
+            total_price=cart.total_price,
+        )
+
+
+def apply_order_transition(cart):
+    """
+    Move stock and the delivery slot booking according to the change of
+    `order_completed` since the cart was last loaded or saved. Saves that
+    keep the order state and slot untouched do not hit the database at all.
+    The state is switched with a conditional UPDATE first, so of two saves
+    making the same change from the same loaded state only one moves stock.
+    """
+    if cart.pk is None or getattr(cart, "_skip_order_transition", False):
+        return
+
+    was_completed = cart.saved_order_completed()
+    if was_completed is None:
+        return
+
+    if was_completed == cart.order_completed:
+        if cart.order_completed:
+            # An ordered cart moving to another delivery slot
+            move_slot(cart.saved_delivery_slot_id(), cart.delivery_slot_id)
+    elif not Cart.objects.filter(
+        pk=cart.pk, order_completed=was_completed
+    ).update(order_completed=cart.order_completed):
+        # Another save made this change since the cart was loaded
+        return
+    elif cart.order_completed:
+        place_order(cart)
+    else:
+        reverse_order(cart)
+
+
+def hold_stock(cart, lines):
+    """
+    Start or extend the stock hold of an open cart, or end it once the
+    cart is empty
+    """
+    cart.held_until = None
+    if any(lines.values()):
+        seconds = settings.CART_EXPIRY["HOLD_SECONDS"]
+        cart.held_until = now() + timedelta(seconds=seconds)
+    Cart.objects.filter(pk=cart.pk).update(held_until=cart.held_until)
+    cart._saved_held_until = cart.held_until
+
+
+def touch_cart(cart):
+    """
+    Count a change of the items alone as activity on the cart, saving the
+    cart does so anyway
+    """
+    cart.updated_at = now()
+    Cart.objects.filter(pk=cart.pk).update(updated_at=cart.updated_at)
+
+
+def load_cart_items(cart):
+    return list(cart.items.only("pk", "product_id", "quantity"))
+
+
+def sync_cart_items(cart, lines, existing=None):
+    """
+    Make the items of a saved cart match `lines`, a dict of product pk to
+    quantity, where a quantity of 0 removes the line.
+
+    Only the difference with the stored items is written, with at most one
+    bulk insert, one bulk update and one DELETE. If the cart is ordered or
+    holds stock, the stock it holds moves by the same difference. Open
+    carts start holding stock here when holds are enabled.
+    """
+    if existing is None:
+        existing = load_cart_items(cart)
+    held = quantities_by_product(existing)
+
+    current, to_delete = {}, []
+    for item in existing:
+        # Lines of deleted products and duplicate lines of a product go
+        if item.product_id is None or item.product_id in current:
+            to_delete.append(item.pk)
+        else:
+            current[item.product_id] = item
+
+    to_create, to_update = [], []
+    for product_pk, quantity in lines.items():
+        item = current.pop(product_pk, None)
+        if not quantity:
+            if item is not None:
+                to_delete.append(item.pk)
+        elif item is None:
+            to_create.append(
+                CartItem(cart=cart, product_id=product_pk, quantity=quantity)
+            )
+        elif item.quantity != quantity:
+            item.quantity = quantity
+            to_update.append(item)
+    to_delete += [item.pk for item in current.values()]
+
+    if to_create:
+        CartItem.objects.bulk_create(to_create)
+    if to_update:
+        CartItem.objects.bulk_update(to_update, ["quantity"])
+    if to_delete:
+        CartItem.objects.filter(pk__in=to_delete).delete()
+
+    ordered = cart.saved_order_completed()
+    holding = not ordered and cart.saved_held_until() is not None
+    if not (ordered or holding or settings.CART_EXPIRY["HOLD_SECONDS"]):
+        return
+    if not (ordered or holding):
+        # The hold starts with every line of the cart
+        held = {}
+
+    deltas = {pk: quantity for pk, quantity in lines.items() if quantity}
+    for pk, quantity in held.items():
+        deltas[pk] = deltas.get(pk, 0) - quantity
+    adjust_stock(deltas)
+    if ordered:
+        # New lines are priced now, the others keep their captured price
+        capture_order_summary(cart, _order_lines(cart), save=True)
+    else:
+        hold_stock(cart, lines)
@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+
+__author__ = "Surya Banerjee"
+
+import random
+from collections import defaultdict
+
+from django.db import transaction
+from django.db.models import (
+    Case,
+    F,
+    IntegerField,
+    Max,
+    Subquery,
+    Sum,
+    Value,
+    When,
+)
+from django.db.models.functions import Coalesce
+from django.utils.timezone import now
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+from autocompany.api.cache import invalidate_products
+from autocompany.api.models import CatalogVersion, Product, StockShard
+
+# Products can keep most of their stock in StockShard rows, see
+# set_stock_shards. Their stock is the stock of the product row plus that
+# of the shards. Reservations take it from one random shard, so concurrent
+# checkouts of a hot product mostly lock different rows, and only fall
+# back to locking all shards when no single shard has enough.
+
+
+class InsufficientStock(APIException):
+    """
+    Raised when one or more lines of a cart cannot be reserved
+    """
+
+    status_code = status.HTTP_400_BAD_REQUEST
+    default_detail = {
+        "quantity": "higher number of quantity requested than in stock"
+    }
+    default_code = "insufficient_stock"
+
+
+def quantities_by_product(items):
+    """
+    Sum the quantities of cart items per product pk.
+
+    Accepts CartItem instances or (product_pk, quantity) pairs so callers can
+    pass either a queryset or the output of values_list.
+    """
+    quantities = defaultdict(int)
+    for item in items:
+        if isinstance(item, tuple):
+            product_pk, quantity = item
+        else:
+            product_pk, quantity = item.product_id, item.quantity
+        if product_pk is not None and quantity:
+            quantities[product_pk] += quantity
+    return dict(quantities)
+
+
+def _quantity_case(quantities):
+    return Case(
+        *[When(pk=pk, then=Value(qty)) for pk, qty in quantities.items()],
+        output_field=IntegerField(),
+    )
+
+
+def reserve_stock(items):
+    """
+    Remove the ordered quantities from stock in a single conditional UPDATE.
+
+    Every product row is only touched if it still has enough stock, so if the
+    number of updated rows is lower than the number of products one of the
+    lines could not be reserved and the whole reservation is rolled back.
+    Products with sharded stock are reserved from their shards instead.
+    """
+    quantities = quantities_by_product(items)
+    if not quantities:
+        return
+
+    delta = _quantity_case(quantities)
+    with transaction.atomic():
+        updated = (
+            Product.objects.filter(
+                pk__in=quantities.keys(), stock_shards=0, stock__gte=delta
+            )
+            .update(stock=F("stock") - delta, updated_at=now())
+        )
+        if updated != len(quantities):
+            # Sharded products are left to their shards, only then is it
+            # sure that a line is short
+            sharded = sharded_products(quantities)
+            if updated + len(sharded) != len(quantities):
+                raise InsufficientStock()
+            for pk, shards in sharded.items():
+                reserve_from_shards(pk, shards, quantities[pk])
+    invalidate_products(quantities.keys(), stock_only=True)
+
+
+def release_stock(items):
+    """
+    Put the ordered quantities back into stock in a single UPDATE, plus one
+    per sharded product
+    """
+    quantities = quantities_by_product(items)
+    if not quantities:
+        return
+
+    timestamp = now()
+    updated = Product.objects.filter(
+        pk__in=quantities.keys(), stock_shards=0
+    ).update(
+        stock=F("stock") + _quantity_case(quantities), updated_at=timestamp
+    )
+    if updated != len(quantities):
+        for pk, shards in sharded_products(quantities).items():
+            StockShard.objects.filter(
+                product_id=pk, shard=random.randrange(shards)
+            ).update(stock=F("stock") + quantities[pk], updated_at=timestamp)
+    invalidate_products(quantities.keys(), stock_only=True)
+
+
+def sharded_products(pks):
+    """
+    Number of shards of the products among `pks` with sharded stock
+    """
+    return dict(
+        Product.objects.filter(pk__in=pks, stock_shards__gt=0).values_list(
+            "pk", "stock_shards"
+        )
+    )
+
+
+def reserve_from_shards(pk, shards, quantity):
+    """
+    Take a quantity of a sharded product from a random shard, or from the
+    next shards in turn if that one has too little
+    """
+    timestamp = now()
+    first = random.randrange(shards)
+    for offset in range(shards):
+        updated = StockShard.objects.filter(
+            product_id=pk,
+            shard=(first + offset) % shards,
+            stock__gte=quantity,
+        ).update(stock=F("stock") - quantity, updated_at=timestamp)
+        if updated:
+            return
+
+    # No shard has all of it, take it from several of them and the product
+    # row, which needs all of them locked
+    stock = (
+        Product.objects.select_for_update()
+        .values_list("stock", flat=True)
+        .get(pk=pk)
+    )
+    parts = list(
+        StockShard.objects.select_for_update()
+        .filter(product_id=pk, stock__gt=0)
+        .order_by("shard")
+    )
+    if stock + sum(part.stock for part in parts) < quantity:
+        raise InsufficientStock()
+
+    remaining = quantity
+    for part in parts:
+        taken = min(part.stock, remaining)
+        part.stock -= taken
+        part.updated_at = timestamp
+        remaining -= taken
+    StockShard.objects.bulk_update(parts, ["stock", "updated_at"])
+    if remaining:
+        Product.objects.filter(pk=pk).update(
+            stock=F("stock") - remaining, updated_at=timestamp
+        )
+
+
+def shard_totals(pks):
+    """
+    Stock in the shards of the given products and when it last changed,
+    by product pk, with one query
+    """
+    rows = (
+        StockShard.objects.filter(product_id__in=pks)
+        .values("product_id")
+        .annotate(stock=Sum("stock"), updated_at=Max("updated_at"))
+        .values_list("product_id", "stock", "updated_at")
+    )
+    return {pk: (stock, updated_at) for pk, stock, updated_at in rows}
+
+
+def total_stock(pk, stock, stock_shards, updated_at):
+    """
+    Stock of a product with that of its shards, and the last change of
+    either
+    """
+    if stock_shards:
+        shard_stock, shard_updated_at = shard_totals([pk]).get(pk, (0, None))
+        stock += shard_stock
+        if shard_updated_at is not None:
+            updated_at = max(updated_at, shard_updated_at)
+    return stock, updated_at
+
+
+def product_stock(pk):
+    """
+    Stock of a product with its last change, see total_stock, and the
+    catalog version, in one query, or None if there is no such product.
+    Stock writes leave the catalog version alone, so the rest of the
+    product is cached under it.
+    """
+    row = (
+        Product.objects.filter(pk=pk)
+        .annotate(
+            catalog_version=Coalesce(
+                Subquery(
+                    CatalogVersion.objects.filter(pk=1).values("version")
+                ),
+                0,
+            )
+        )
+        .values_list("stock", "stock_shards", "updated_at", "catalog_version")
+        .first()
+    )
+    if row is None:
+        return None
+    return (*total_stock(pk, *row[:3]), row[3])
+
+
+def add_shard_stock(rows):
+    """
+    Add the stock of the shards to serialized product rows, which have a
+    pk and stock, with one query
+    """
+    totals = shard_totals([row["pk"] for row in rows])
+    for row in rows:
+        if row["pk"] in totals:
+            row["stock"] += totals[row["pk"]][0]
+    return rows
+
+
+def set_stock_shards(pk, shards, stock=None):
+    """
+    Spread the whole stock of a product evenly over `shards` shards, or
+    move it back into the product row with 0. With `stock` that is spread
+    instead, as the new stock of the product.
+    """
+    with transaction.atomic():
+        product = Product.objects.select_for_update().get(pk=pk)
+        parts = StockShard.objects.select_for_update().filter(product=product)
+        if stock is None:
+            stock = product.stock + sum(part.stock for part in parts)
+        parts.delete()
+
+        timestamp = now()
+        StockShard.objects.bulk_create(
+            StockShard(
+                product=product,
+                shard=shard,
+                stock=stock // shards + (shard < stock % shards),
+                updated_at=timestamp,
+            )
+            for shard in range(shards)
+        )
+        Product.objects.filter(pk=pk).update(
+            stock=0 if shards else stock,
+            stock_shards=shards,
+            updated_at=timestamp,
+        )
+    invalidate_products([pk], stock_only=True)
+    return stock
+
+
+def adjust_stock(deltas):
+    """
+    Apply per product changes of the held quantity, positive deltas are
+    reserved and negative deltas are released
+    """
+    reserve_stock(
+        [(pk, delta) for pk, delta in deltas.items() if delta > 0]
+    )
+    release_stock(
+        [(pk, -delta) for pk, delta in deltas.items() if delta < 0]
+    )
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+
+__author__ = "Surya Banerjee"
+
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils.timezone import now
+
+from autocompany.api.models import Cart, CartItem
+from autocompany.api.stock import release_stock
+
+
+class SweepReport:
+    """
+    Counts of a sweep and per batch throughput
+    """
+
+    def __init__(self):
+        self.released = 0
+        self.deleted = 0
+        self.deleted_items = 0
+        self.batches = []
+
+    def as_dict(self):
+        rows = sum(batch["rows"] for batch in self.batches)
+        seconds = sum(batch["seconds"] for batch in self.batches)
+        return {
+            "released": self.released,
+            "deleted": self.deleted,
+            "deleted_items": self.deleted_items,
+            "batches": self.batches,
+            "rows_per_second": round(rows / seconds, 1) if seconds else None,
+        }
+
+
+def release_held_stock(pks):
+    """
+    Give the stock held by the carts back with one aggregated UPDATE,
+    however many items they have
+    """
+    release_stock(
+        CartItem.objects.filter(cart_id__in=pks).values_list(
+            "product_id", "quantity"
+        )
+    )
+
+
+class CartSweeper:
+    """
+    Releases the stock holds of open carts which ran out, then deletes the
+    open carts nobody touched for `open_cart_days`.
+
+    Carts are walked in keyset order of the sweep's column and pk, so
+    every batch is an index range scan no matter how far the sweep got.
+    Each batch is locked with SKIP LOCKED and written in its own
+    transaction. Requests lock the carts they write, so a cart being
+    changed is left for the next run, and a request waiting on a batch
+    loads the cart as the sweep left it.
+    """
+
+    def __init__(self, batch_size=None, open_cart_days=None, log=None):
+        config = settings.CART_EXPIRY
+        self.batch_size = batch_size or config["BATCH_SIZE"]
+        if open_cart_days is None:
+            open_cart_days = config["OPEN_CART_DAYS"]
+        self.open_cart_days = open_cart_days
+        self.log = log or (lambda message: None)
+
+    def run(self):
+        """
+        Sweep once, returning a SweepReport
+        """
+        report = SweepReport()
+        timestamp = now()
+        self.sweep(
+            Cart.objects.filter(
+                held_until__isnull=False,
+                held_until__lt=timestamp,
+                order_completed=False,
+            ),
+            "held_until",
+            self.release_holds,
+            report,
+        )
+        self.sweep(
+            Cart.objects.filter(
+                order_completed=False,
+                updated_at__lt=timestamp - timedelta(days=self.open_cart_days),
+            ),
+            "updated_at",
+            self.delete_carts,
+            report,
+        )
+        return report
+
+    def sweep(self, carts, field, process, report):
+        last = None
+        while True:
+            start = time.perf_counter()
+            with transaction.atomic():
+                batch = carts
+                if last is not None:
+                    batch = batch.filter(
+                        Q(**{f"{field}__gt": last[0]})
+                        | Q(**{field: last[0], "pk__gt": last[1]})
+                    )
+                rows = list(
+                    batch.select_for_update(skip_locked=True)
+                    .order_by(field, "pk")
+                    .values_list(field, "pk")[:self.batch_size]
+                )
+                if not rows:
+                    return
+                result = process([pk for _, pk in rows], report)
+            last = rows[-1]
+
+            seconds = time.perf_counter() - start
+            report.batches.append(
+                {
+                    "kind": process.__name__,
+                    "rows": len(rows),
+                    "seconds": round(seconds, 3),
+                }
+            )
+            self.log(
+                f"Batch {len(report.batches)}: {result}, "
+                f"{len(rows) / max(seconds, 1e-9):.0f} rows/s"
+            )
+
+    def release_holds(self, pks, report):
+        release_held_stock(pks)
+        Cart.objects.filter(pk__in=pks).update(held_until=None)
+        report.released += len(pks)
+        return f"{len(pks)} holds released"
+
+    def delete_carts(self, pks, report):
+        # Holds which did not run out yet, on carts nobody will come back to
+        release_held_stock(
+            Cart.objects.filter(pk__in=pks, held_until__isnull=False)
+            .values_list("pk", flat=True)
+        )
+        _, items = CartItem.objects.filter(cart_id__in=pks).delete()
+        Cart.objects.filter(pk__in=pks).delete()
+        items = items.get(CartItem._meta.label, 0)
+        report.deleted += len(pks)
+        report.deleted_items += items
+        return f"{len(pks)} carts and {items} items deleted"
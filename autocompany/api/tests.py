@@ -2,22 +2,76 @@
 
 __author__ = "Surya Banerjee"
 
+import gzip
+import json
+import tempfile
+import tracemalloc
 from collections import OrderedDict
+from datetime import date, timedelta
+from io import StringIO
+from types import SimpleNamespace
+from unittest import mock
 
+import psycopg2
+from psycopg2.extensions import (
+    TRANSACTION_STATUS_IDLE,
+    TRANSACTION_STATUS_INTRANS,
+)
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.core.management import call_command
+from django.core.management.base import CommandError
 from django.urls import reverse
-from django.test import TestCase, Client
+from django.db import connection
+from django.test import TestCase, Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils.timezone import now
 
 from rest_framework import status
+from rest_framework.authtoken.models import Token
 from rest_framework.test import APIClient
 
+from autocompany.api.cache import (
+    LRUBackend,
+    get_product_cache,
+    get_token_cache,
+)
+from autocompany.api.checkout import CheckoutWorker
+from autocompany.api.checks import (
+    check_connection_settings,
+    check_database_connection,
+    connection_settings_errors,
+)
+from autocompany.api.export import export_catalog, export_rows
+from autocompany.api.imports import ProductImporter, read_csv
+from autocompany.api.load_data import LoadDataGenerator
+from autocompany.api.metrics import MetricsRegistry, registry
+from autocompany.api.postgresql.base import ConnectionPool
 from autocompany.api.seed_data import seed_products, get_seed_user_token
-from autocompany.api.models import Cart, CartItem, Product
+from autocompany.api.models import (
+    Cart,
+    CartItem,
+    CatalogVersion,
+    CheckoutJob,
+    DeliverySlot,
+    Product,
+    StockShard,
+)
+from autocompany.api.stock import (
+    InsufficientStock,
+    reserve_stock,
+    release_stock,
+    set_stock_shards,
+)
 from autocompany.api.serializers import (
     CartSerializer,
     CartItemSerializer,
     ProductListSerializer,
     ProductDetailSerializer,
 )
+from autocompany.api.views import CartViewset
 
 
 class ProductAPITest(TestCase):
@@ -41,12 +95,29 @@ class ProductAPITest(TestCase):
 
         # Should just contain minimal information about product
         self.assertEqual(
-            [i for i in response.data[0].keys()], ["pk", "name", "overview"]
+            [i for i in response.data["results"][0].keys()],
+            ["pk", "name", "overview"],
         )
 
-        self.assertEqual(response.data, serializer.data)
+        self.assertEqual(response.data["results"], serializer.data)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
 
+    def test_product_overview_cursor_pagination(self):
+        url = reverse("product-list") + "?page_size=3"
+        pks = []
+        while url:
+            # Catalog version and the page itself
+            with self.assertNumQueries(2) as ctx:
+                response = self.client.get(url)
+            # Pages continue from the last pk instead of skipping rows
+            self.assertNotIn("OFFSET", ctx.captured_queries[-1]["sql"])
+            self.assertLessEqual(len(response.data["results"]), 3)
+            pks += [product["pk"] for product in response.data["results"]]
+            url = response.data["next"]
+
+        all_pks = self.products.order_by("pk").values_list("pk", flat=True)
+        self.assertEqual(pks, list(all_pks))
+
     def test_get_single_product_detail(self):
         response = self.client.get(reverse("product-list") + "1/")
 
@@ -62,6 +133,632 @@ class ProductAPITest(TestCase):
         self.assertEqual(response.data, serializer.data)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
 
+    def test_fast_serialization_is_byte_identical(self):
+        urls = [
+            reverse("product-list"),
+            reverse("product-list") + "?page_size=2",
+            reverse("product-list") + "1/",
+            reverse("product-list") + "6/",
+        ]
+        for url in urls:
+            with override_settings(PRODUCT_FAST_SERIALIZATION=True):
+                fast = self.client.get(url)
+            with override_settings(PRODUCT_FAST_SERIALIZATION=False):
+                slow = self.client.get(url)
+            self.assertEqual(fast.status_code, slow.status_code)
+            self.assertEqual(fast.content, slow.content)
+
+    def test_conditional_get_product_detail(self):
+        url = reverse("product-list") + "1/"
+        response = self.client.get(url)
+        etag = response.headers["ETag"]
+        self.assertIn("Last-Modified", response.headers)
+
+        # Only the product version is read, the body is not built
+        with self.assertNumQueries(1):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response.content, b"")
+
+        # Any stock change gives the product a new version
+        reserve_stock([(1, 1)])
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response.headers["ETag"], etag)
+        self.assertEqual(response.data["stock"], 9)
+
+    def test_conditional_get_product_list(self):
+        url = reverse("product-list")
+        etag = self.client.get(url).headers["ETag"]
+
+        # Only the catalog version is read
+        with self.assertNumQueries(1):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        # Stock is not part of the overview, so the list stays valid
+        reserve_stock([(1, 1)])
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        product = Product.objects.get(pk=2)
+        product.overview = "Still the best"
+        product.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            response.data["results"][1]["overview"], "Still the best"
+        )
+
+
+class ProductCacheTest(TestCase):
+    def setUp(self):
+        seed_products()
+        caches["default"].clear()
+        self.client = APIClient()
+
+    def check_product_cache(self):
+        detail_url = reverse("product-list") + "1/"
+        response = self.client.get(detail_url)
+        self.assertEqual(response.data["stock"], 10)
+
+        # Detail and stock are both served from the cache
+        with self.assertNumQueries(0):
+            response = self.client.get(detail_url)
+        self.assertEqual(response.data["stock"], 10)
+
+        # Stock updates drop the cached stock only, the rest of the product
+        # stays cached
+        reserve_stock([(1, 4)])
+        with self.assertNumQueries(1):
+            response = self.client.get(detail_url)
+        self.assertEqual(response.data["stock"], 6)
+        self.assertEqual(response.data["name"], "MRF tyres")
+
+        self.client.get(reverse("product-list"))
+        with self.assertNumQueries(0):
+            self.client.get(reverse("product-list"))
+
+        # Saving a product drops its detail and all list pages
+        product = Product.objects.get(pk=1)
+        product.name = "MRF tyres XL"
+        product.save()
+        response = self.client.get(reverse("product-list"))
+        self.assertEqual(response.data["results"][0]["name"], "MRF tyres XL")
+        response = self.client.get(detail_url)
+        self.assertEqual(response.data["name"], "MRF tyres XL")
+
+        admin = User.objects.create_superuser("admin", "", "password")
+        self.client.force_authenticate(admin)
+        response = self.client.get(reverse("product-cache-stats"))
+        self.assertEqual(response.data["detail"], {"hits": 2, "misses": 2})
+        self.assertEqual(response.data["stock"], {"hits": 1, "misses": 3})
+        self.assertEqual(response.data["list"], {"hits": 1, "misses": 2})
+        self.assertEqual(response.data["catalog"], {"hits": 1, "misses": 2})
+
+    @override_settings(PRODUCT_CACHE={"BACKEND": "lru"})
+    def test_lru_product_cache(self):
+        self.check_product_cache()
+
+    @override_settings(PRODUCT_CACHE={"BACKEND": "django"})
+    def test_django_product_cache(self):
+        self.check_product_cache()
+
+    @override_settings(PRODUCT_CACHE={"BACKEND": "lru"})
+    def test_new_etag_comes_with_the_new_body(self):
+        detail_url = reverse("product-list") + "1/"
+        etag = self.client.get(detail_url).headers["ETag"]
+
+        # Written by another worker, only the stock entry ran out here
+        Product.objects.filter(pk=1).update(price=2000, updated_at=now())
+        CatalogVersion.bump()
+        get_product_cache().invalidate_stock([1])
+        response = self.client.get(detail_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response.headers["ETag"], etag)
+        self.assertEqual(response.data["price"], 2000)
+
+        response = self.client.get(
+            reverse("async-product-detail", args=[1]),
+            HTTP_IF_NONE_MATCH=response.headers["ETag"],
+        )
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    @override_settings(PRODUCT_CACHE={"BACKEND": "lru"})
+    def test_cache_stats_require_admin(self):
+        response = self.client.get(reverse("product-cache-stats"))
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+class RequestMetricsTest(TestCase):
+    def setUp(self):
+        seed_products()
+        user, token = get_seed_user_token()
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + token)
+
+    def server_timing(self, response):
+        timings = {}
+        for entry in response["Server-Timing"].split(", "):
+            name, duration, *desc = entry.split(";")
+            timings[name] = (float(duration[len("dur="):]), desc)
+        return timings
+
+    @override_settings(
+        METRICS={**settings.METRICS, "SAMPLE_RATE": 1, "TOKEN": "secret"}
+    )
+    def test_sampled_requests_are_broken_down(self):
+        key = ("CartViewset.create", "POST", 201)
+        created = registry.requests[key]
+        response = self.client.post(
+            reverse("cart-list"),
+            {"items": [{"product": 1, "quantity": 1}]},
+            format="json",
+        )
+        timings = self.server_timing(response)
+        self.assertEqual(
+            list(timings), ["total", "db", "serialize", "render"]
+        )
+        self.assertGreater(timings["db"][0] + timings["serialize"][0], 0)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse("cart-list"))
+        self.assertEqual(
+            self.server_timing(response)["db"][1],
+            [f'desc="{len(queries)} queries"'],
+        )
+        self.assertEqual(registry.requests[key], created + 1)
+
+        # Async views are timed too
+        response = self.client.get(reverse("async-product-list"))
+        self.assertIn("Server-Timing", response)
+
+        client = Client()
+        response = client.get(reverse("metrics"))
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        response = client.get(
+            reverse("metrics"), HTTP_AUTHORIZATION="Bearer secret"
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        body = response.content.decode()
+        self.assertIn(
+            'autocompany_requests_total{view="CartViewset.create",'
+            f'method="POST",status="201"}} {created + 1}',
+            body,
+        )
+        self.assertIn(
+            'autocompany_request_duration_seconds_bucket{'
+            'view="CartViewset.list",le="+Inf"}',
+            body,
+        )
+        self.assertIn(
+            'autocompany_phase_seconds_total{view="async_views.product_list",'
+            'phase="render"}',
+            body,
+        )
+
+    @override_settings(
+        METRICS={**settings.METRICS, "SAMPLE_RATE": 0, "TOKEN": ""}
+    )
+    def test_requests_out_of_the_sample_are_only_counted(self):
+        key = ("ProductViewset.retrieve", "GET", 200)
+        retrieved = registry.requests[key]
+        sampled = registry.sampled["ProductViewset.retrieve"]
+        response = self.client.get(reverse("product-detail", args=[1]))
+        self.assertNotIn("Server-Timing", response)
+        self.assertEqual(registry.requests[key], retrieved + 1)
+        self.assertEqual(
+            registry.sampled["ProductViewset.retrieve"], sampled
+        )
+        # Without a token nobody can read the metrics
+        response = Client().get(
+            reverse("metrics"), HTTP_AUTHORIZATION="Bearer "
+        )
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_metrics_of_all_processes_are_summed(self):
+        key = ("ProductViewset.retrieve", "GET", 200)
+        with tempfile.TemporaryDirectory() as directory:
+            # Another worker process, which handled 2 requests
+            other = MetricsRegistry()
+            with override_settings(
+                METRICS={**settings.METRICS, "DIR": directory}
+            ):
+                other.observe(*key, 0.01)
+                other.observe(*key, 0.01)
+                other.flush(force=True)
+
+            with override_settings(
+                METRICS={
+                    **settings.METRICS,
+                    "DIR": directory,
+                    "TOKEN": "secret",
+                }
+            ):
+                self.client.get(reverse("product-detail", args=[1]))
+                response = Client().get(
+                    reverse("metrics"), HTTP_AUTHORIZATION="Bearer secret"
+                )
+        self.assertIn(
+            'autocompany_requests_total{view="ProductViewset.retrieve",'
+            f'method="GET",status="200"}} {registry.requests[key] + 2}',
+            response.content.decode(),
+        )
+
+
+class ProductExportTest(TestCase):
+    def setUp(self):
+        seed_products()
+        self.client = APIClient()
+        self.expected = json.loads(
+            json.dumps(
+                ProductDetailSerializer(
+                    Product.objects.order_by("pk"), many=True
+                ).data
+            )
+        )
+
+    def export(self, **extra):
+        response = self.client.get(
+            reverse("product-export"), extra.pop("params", {}), **extra
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.streaming)
+        return response, b"".join(response.streaming_content)
+
+    def test_json_export(self):
+        response, body = self.export()
+        self.assertEqual(response["Content-Type"], "application/json")
+        self.assertEqual(json.loads(body), self.expected)
+
+        # Under ASGI the body is spooled before it is sent
+        with override_settings(APPLICATION_SERVER="asgi"):
+            self.assertEqual(self.export()[1], body)
+
+    def test_ndjson_export_with_gzip(self):
+        response, body = self.export(
+            params={"type": "ndjson"}, HTTP_ACCEPT_ENCODING="gzip, br"
+        )
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        self.assertIn("Accept-Encoding", response["Vary"])
+        lines = gzip.decompress(body).decode().splitlines()
+        self.assertEqual([json.loads(line) for line in lines], self.expected)
+
+        response = self.client.get(reverse("product-export"), {"type": "xml"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_export_command(self):
+        with tempfile.NamedTemporaryFile(suffix=".json.gz") as output:
+            call_command(
+                "export_catalog",
+                gzip=True,
+                output=output.name,
+                stderr=StringIO(),
+            )
+            body = gzip.decompress(output.read())
+        self.assertEqual(json.loads(body), self.expected)
+
+    def test_memory_does_not_grow_with_the_catalog(self):
+        def peak_memory():
+            tracemalloc.start()
+            try:
+                for chunk in export_catalog(rows=export_rows(chunk_size=100)):
+                    pass
+                return tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+
+        generator = LoadDataGenerator(batch_size=1000)
+        generator.generate_products(1000)
+        small = peak_memory()
+        # Five times the products, the same peak
+        generator.generate_products(4000)
+        self.assertLess(peak_memory(), small * 1.2)
+
+
+class ProductImportTest(TestCase):
+    def setUp(self):
+        seed_products()
+
+    def test_import_command_upserts_on_name(self):
+        # Cached before the import, which has to invalidate it
+        self.client.get(reverse("product-detail", args=[1]))
+        feed = (
+            "name,overview,model,year,stock,price\n"
+            "MRF tyres,Even better tyres,Honda City,2020,,1100\n"
+            "Apollo tyres,All season,Honda Civic,2019-06-01,40,800\n"
+            ",No name,Honda City,2020,1,1\n"
+            "Ceat tyres,Cheap,Maruti Omni,next year,-1,1\n"
+            "Apollo tyres,All season,Honda Civic,2018,40,750\n"
+        )
+        with tempfile.NamedTemporaryFile("w", suffix=".csv") as path:
+            path.write(feed)
+            path.flush()
+            stdout, stderr = StringIO(), StringIO()
+            call_command(
+                "import_products",
+                path.name,
+                batch_size=3,
+                stdout=stdout,
+                stderr=stderr,
+            )
+
+        self.assertIn("1 created, 2 updated, 2 rejected", stdout.getvalue())
+        self.assertIn("Batch 2: 2 rows", stdout.getvalue())
+        self.assertIn(
+            "Line 4: name: This field is required.", stderr.getvalue()
+        )
+        self.assertIn("Line 5: year:", stderr.getvalue())
+        self.assertIn("stock: Expected a whole number", stderr.getvalue())
+
+        # A missing stock leaves it alone
+        updated = Product.objects.get(name="MRF tyres")
+        self.assertEqual(
+            (updated.pk, updated.overview, updated.stock, updated.price),
+            (1, "Even better tyres", 10, 1100),
+        )
+        # The last row of a name wins
+        created = Product.objects.get(name="Apollo tyres")
+        self.assertEqual((created.year, created.price), (date(2018, 1, 1), 750))
+
+        response = self.client.get(reverse("product-detail", args=[1]))
+        self.assertEqual(response.data["price"], 1100)
+
+    def test_rows_without_stock_keep_concurrent_checkouts(self):
+        feed = StringIO(
+            "name,overview,model,year,price\n"
+            "MRF tyres,Even better tyres,Honda City,2020,1100\n"
+        )
+        in_bulk = Product.objects.in_bulk
+
+        def checkout_after_read(*args, **kwargs):
+            products = in_bulk(*args, **kwargs)
+            reserve_stock([(1, 4)])
+            return products
+
+        with mock.patch.object(Product.objects, "in_bulk", checkout_after_read):
+            ProductImporter(use_copy=False).run(read_csv(feed))
+        product = Product.objects.get(pk=1)
+        self.assertEqual((product.stock, product.price), (6, 1100))
+
+    def test_import_endpoint(self):
+        url = reverse("product-import")
+        feed = "\n".join(
+            [
+                json.dumps({"name": "Bosch Windshield Wiper",
+                            "overview": "Wipes", "model": "Maruti Omni",
+                            "year": 2001, "stock": 7}),
+                json.dumps({"name": "Valeo Wiper", "overview": "Wipes too",
+                            "model": "Honda City", "year": 2019}),
+                "not json",
+                json.dumps(["a", "list"]),
+            ]
+        )
+        client = APIClient()
+        user, token = get_seed_user_token()
+        client.credentials(HTTP_AUTHORIZATION="Token " + token)
+        response = client.post(
+            url, feed, content_type="application/x-ndjson"
+        )
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+        User.objects.filter(pk=user.pk).update(is_staff=True)
+        response = client.post(url, feed, content_type="application/json")
+        self.assertEqual(
+            response.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE
+        )
+
+        response = client.post(
+            url, feed, content_type="application/x-ndjson"
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        report = response.data
+        self.assertEqual(
+            (report["created"], report["updated"], report["rejected"]),
+            (1, 1, 2),
+        )
+        self.assertEqual(
+            [error["line"] for error in report["errors"]], [3, 4]
+        )
+        self.assertEqual(len(report["batches"]), 1)
+        self.assertEqual(Product.objects.get(pk=4).stock, 7)
+        self.assertEqual(Product.objects.get(name="Valeo Wiper").stock, 0)
+
+
+class ProductSearchTest(TestCase):
+    def setUp(self):
+        seed_products()
+        self.client = APIClient()
+
+    def search(self, **params):
+        response = self.client.get(reverse("product-search"), params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data
+
+    def test_search_matches_word_prefixes(self):
+        data = self.search(q="tyre")
+        self.assertEqual(data["count"], 3)
+        self.assertEqual([row["pk"] for row in data["results"]], [1, 2, 5])
+        self.assertEqual(
+            set(data["results"][0]), set(ProductDetailSerializer.Meta.fields)
+        )
+
+        # Every word has to match, in any of the searched fields
+        data = self.search(q="tyres honda")
+        self.assertEqual([row["pk"] for row in data["results"]], [1])
+        self.assertEqual(self.search(q="tyres brake")["count"], 0)
+
+    def test_search_filters(self):
+        data = self.search(year_min=2010, price_max=900)
+        self.assertEqual(
+            [row["pk"] for row in data["results"]], [3, 7, 8]
+        )
+        Product.objects.filter(pk=7).update(stock=0)
+        data = self.search(q="tyres", in_stock="false")
+        self.assertEqual(data["count"], 0)
+        data = self.search(model="Honda City", in_stock="true")
+        self.assertEqual([row["pk"] for row in data["results"]], [1])
+        self.assertEqual(len(self.search(page_size=2)["results"]), 2)
+
+    def test_facets_leave_out_their_own_filter(self):
+        data = self.search(q="tyres", model="Honda City", year_max=2020)
+        self.assertEqual(data["count"], 1)
+        self.assertEqual(
+            data["facets"]["model"],
+            [
+                {"value": "Honda City", "count": 1},
+                {"value": "Toyota Lancer", "count": 1},
+            ],
+        )
+        self.assertEqual(
+            data["facets"]["year"], [{"value": 2020, "count": 1}]
+        )
+
+    def test_search_sees_product_writes(self):
+        self.assertEqual(self.search(q="wiper")["count"], 1)
+        Product.objects.filter(pk=4).delete()
+        Product.objects.create(
+            name="Valeo Wiper Blade",
+            overview="Clear view",
+            model="Honda City",
+            year=date(2019, 1, 1),
+        )
+        data = self.search(q="wiper")
+        self.assertEqual([row["name"] for row in data["results"]],
+                         ["Valeo Wiper Blade"])
+
+    def test_unfiltered_search_counts_the_catalog_once(self):
+        data = self.search()
+        self.assertEqual(data["count"], Product.objects.count())
+        self.assertEqual(
+            sum(facet["count"] for facet in data["facets"]["year"]),
+            data["count"],
+        )
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.search(q=" "), data)
+        self.assertFalse(
+            [query for query in queries if "COUNT(" in query["sql"]]
+        )
+
+        Product.objects.filter(pk=4).delete()
+        self.assertEqual(self.search()["count"], data["count"] - 1)
+
+    def test_invalid_parameters(self):
+        response = self.client.get(
+            reverse("product-search"), {"year_min": "soon", "page_size": 500}
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(set(response.data), {"year_min", "page_size"})
+
+
+class TokenCacheTest(TestCase):
+    def setUp(self):
+        caches["default"].clear()
+        self.user, self.token = get_seed_user_token()
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + self.token)
+
+    def token_queries(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [q for q in queries if "authtoken_token" in q["sql"]]
+
+    def check_token_cache(self, url):
+        self.assertEqual(len(self.token_queries(url)), 1)
+        self.assertEqual(self.token_queries(url), [])
+
+        # Deactivating the user drops the cached token straight away
+        self.user.is_active = False
+        self.user.save()
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+        self.user.is_active = True
+        self.user.save()
+        self.assertEqual(len(self.token_queries(url)), 1)
+        self.assertEqual(self.token_queries(url), [])
+
+        Token.objects.filter(key=self.token).delete()
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    @override_settings(TOKEN_CACHE={"BACKEND": "lru"})
+    def test_token_cache(self):
+        self.check_token_cache(reverse("cart-list"))
+
+    @override_settings(TOKEN_CACHE={"BACKEND": "lru"})
+    def test_token_cache_of_async_views(self):
+        self.check_token_cache(reverse("async-cart-list"))
+
+    @override_settings(TOKEN_CACHE={"BACKEND": "lru", "SHARED": True})
+    def test_shared_token_cache(self):
+        url = reverse("cart-list")
+        self.assertEqual(len(self.token_queries(url)), 1)
+
+        # Another worker with an empty in-process tier finds the shared entry
+        get_token_cache().local = LRUBackend(10)
+        self.assertEqual(self.token_queries(url), [])
+
+        # And deleting the token reaches the shared tier
+        self.token_queries(url)
+        get_token_cache().local = LRUBackend(10)
+        Token.objects.filter(key=self.token).delete()
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+class ConnectionSettingsTest(TestCase):
+    class FakeConnection:
+        """
+        Just enough of a psycopg2 connection for the pool
+        """
+
+        def __init__(self):
+            self.closed = 0
+            self.rollbacks = 0
+            self.info = SimpleNamespace(
+                transaction_status=TRANSACTION_STATUS_IDLE
+            )
+
+        def rollback(self):
+            self.rollbacks += 1
+            self.info.transaction_status = TRANSACTION_STATUS_IDLE
+
+        def close(self):
+            self.closed = 1
+
+    def test_connection_pool_reuses_connections(self):
+        pool = ConnectionPool(self.FakeConnection, max_size=2, timeout=0.01)
+        first, second = pool.acquire(), pool.acquire()
+        with self.assertRaises(psycopg2.OperationalError):
+            pool.acquire()
+
+        # Connections come back rolled back, broken ones are dropped
+        first.info.transaction_status = TRANSACTION_STATUS_INTRANS
+        pool.release(first)
+        self.assertEqual(first.rollbacks, 1)
+        pool.release(second, discard=True)
+        self.assertTrue(second.closed)
+
+        self.assertIs(pool.acquire(), first)
+        self.assertIsNot(pool.acquire(), second)
+        self.assertEqual(pool.stats()["created"], 3)
+        self.assertEqual(pool.stats()["reused"], 1)
+
+    def test_connection_settings_checks(self):
+        config = {"CONN_MAX_AGE": 60, "POOL": {"MAX_SIZE": 0}}
+        with override_settings(APPLICATION_SERVER="asgi"):
+            errors = connection_settings_errors("default", config)
+        self.assertEqual(
+            sorted(error.id for error in errors), ["api.E002", "api.W001"]
+        )
+        self.assertEqual(check_connection_settings(), [])
+
+        with override_settings(DB_SLOW_CONNECT_MS=1000):
+            self.assertEqual(
+                check_database_connection(databases=["default"]), []
+            )
+
 
 class CartAPITest(TestCase):
     """
@@ -103,6 +800,7 @@ class CartAPITest(TestCase):
                 {
                     "product": cart.items.all()[0].product.pk,
                     "quantity": cart.items.all()[0].quantity,
+                    "unit_price": cart.items.all()[0].product.price,
                 }
             ),
             response.data["items"][0],
@@ -185,3 +883,1338 @@ class CartAPITest(TestCase):
         cart.refresh_from_db()
         self.assertIsNotNone(cart.delivery_time)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_checkout_fails_when_stock_ran_out(self):
+        # Create cart which has not been ordered
+        post_data = (
+            '{"items":[{"product":1,"quantity":2},'
+            '{"product":4,"quantity":3}]}'
+        )
+        response = self.client.post(
+            reverse("cart-list"), post_data, content_type="application/json"
+        )
+        cart_pk = response.data["pk"]
+
+        # Someone else buys the last units of product 4 in the meantime
+        Product.objects.filter(pk=4).update(stock=2)
+
+        patch_data = '{"order_completed": "true"}'
+        response = self.client.patch(
+            reverse("cart-list") + f"{cart_pk}/",
+            patch_data,
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        # No line was reserved and the cart is still open
+        self.assertEqual(Product.objects.get(pk=1).stock, 10)
+        self.assertEqual(Product.objects.get(pk=4).stock, 2)
+        self.assertFalse(Cart.objects.get(pk=cart_pk).order_completed)
+
+    def test_replace_items_of_ordered_cart(self):
+        post_data = (
+            '{"items":[{"product":1,"quantity":2}],"order_completed":"true"}'
+        )
+        response = self.client.post(
+            reverse("cart-list"), post_data, content_type="application/json"
+        )
+        self.assertEqual(Product.objects.get(pk=1).stock, 8)
+
+        # Stock of the old items is given back and the new items are reserved
+        patch_data = '{"items":[{"product":3,"quantity":4}]}'
+        response = self.client.patch(
+            reverse("cart-list") + f"{response.data['pk']}/",
+            patch_data,
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(Product.objects.get(pk=1).stock, 10)
+        self.assertEqual(Product.objects.get(pk=3).stock, 96)
+
+    def test_list_and_retrieve_carts_with_constant_queries(self):
+        def create_carts(count):
+            for _ in range(count):
+                cart = Cart.objects.create(user=self.user)
+                CartItem.objects.bulk_create(
+                    CartItem(cart=cart, product_id=pk, quantity=1)
+                    for pk in (1, 2, 3)
+                )
+            return cart
+
+        # Token lookup, carts and the items of all carts
+        cart = create_carts(1)
+        with self.assertNumQueries(3):
+            response = self.client.get(reverse("cart-list"))
+        self.assertEqual(len(response.data), 1)
+
+        create_carts(20)
+        with self.assertNumQueries(3):
+            response = self.client.get(reverse("cart-list"))
+        self.assertEqual(len(response.data), 21)
+        self.assertEqual(len(response.data[0]["items"]), 3)
+
+        with self.assertNumQueries(3):
+            response = self.client.get(reverse("cart-list") + f"{cart.pk}/")
+        self.assertEqual(len(response.data["items"]), 3)
+
+    def test_create_cart_validates_products_in_one_query(self):
+        items = ",".join(
+            f'{{"product":{pk},"quantity":1}}' for pk in (1, 2, 3, 4, 5, 7, 8)
+        )
+        post_data = f'{{"items":[{items}]}}'
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.post(
+                reverse("cart-list"), post_data, content_type="application/json"
+            )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        product_queries = [
+            query for query in ctx.captured_queries
+            if '"api_product"' in query["sql"]
+        ]
+        self.assertEqual(len(product_queries), 1)
+
+    def test_create_cart_checks_duplicate_lines_together(self):
+        # Product 4 has 3 in stock, each line alone would fit
+        post_data = (
+            '{"items":[{"product":4,"quantity":2},'
+            '{"product":4,"quantity":2}]}'
+        )
+        response = self.client.post(
+            reverse("cart-list"), post_data, content_type="application/json"
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(Cart.objects.count(), 0)
+
+    def test_create_cart_with_unknown_product(self):
+        post_data = (
+            '{"items":[{"product":1,"quantity":1},'
+            '{"product":99,"quantity":0}]}'
+        )
+        response = self.client.post(
+            reverse("cart-list"), post_data, content_type="application/json"
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn("items", response.data)
+
+    def test_single_cart_line_endpoints(self):
+        post_data = (
+            '{"items":[{"product":1,"quantity":2}],"order_completed":"true"}'
+        )
+        response = self.client.post(
+            reverse("cart-list"), post_data, content_type="application/json"
+        )
+        items_url = reverse("cart-list") + f"{response.data['pk']}/items/"
+        self.assertEqual(Product.objects.get(pk=1).stock, 8)
+
+        # Adding to an ordered cart reserves only the added quantity
+        response = self.client.post(
+            items_url,
+            '{"product":1,"quantity":3}',
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            response.data["items"],
+            [{"product": 1, "quantity": 5, "unit_price": 1000}],
+        )
+        self.assertEqual(Product.objects.get(pk=1).stock, 5)
+
+        response = self.client.post(
+            items_url,
+            '{"product":3,"quantity":1}',
+            content_type="application/json",
+        )
+        self.assertEqual(len(response.data["items"]), 2)
+
+        # Changing the quantity gives stock back
+        response = self.client.patch(
+            items_url + "1/", '{"quantity":1}', content_type="application/json"
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(Product.objects.get(pk=1).stock, 9)
+
+        response = self.client.patch(
+            items_url + "1/", '{"quantity":50}', content_type="application/json"
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(Product.objects.get(pk=1).stock, 9)
+
+        # Only what the cart does not hold yet has to be in stock
+        response = self.client.patch(
+            items_url + "1/", '{"quantity":10}', content_type="application/json"
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(Product.objects.get(pk=1).stock, 0)
+
+        response = self.client.delete(items_url + "1/")
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(Product.objects.get(pk=1).stock, 10)
+        self.assertEqual(
+            list(CartItem.objects.values_list("product_id", "quantity")),
+            [(3, 1)],
+        )
+
+        response = self.client.delete(items_url + "1/")
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_negative_quantities_are_rejected(self):
+        post_data = (
+            '{"items":[{"product":1,"quantity":-5}],"order_completed":"true"}'
+        )
+        response = self.client.post(
+            reverse("cart-list"), post_data, content_type="application/json"
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        post_data = (
+            '{"items":[{"product":1,"quantity":1}],"order_completed":"true"}'
+        )
+        response = self.client.post(
+            reverse("cart-list"), post_data, content_type="application/json"
+        )
+        items_url = reverse("cart-list") + f"{response.data['pk']}/items/"
+        for method, url, data in [
+            ("post", items_url, '{"product":1,"quantity":0}'),
+            ("post", items_url, '{"product":1,"quantity":-1}'),
+            ("patch", items_url + "1/", '{"quantity":-50}'),
+        ]:
+            response = getattr(self.client, method)(
+                url, data, content_type="application/json"
+            )
+            self.assertEqual(
+                response.status_code, status.HTTP_400_BAD_REQUEST
+            )
+        self.assertEqual(Product.objects.get(pk=1).stock, 9)
+        self.assertEqual(Cart.objects.get().total_price, 1000)
+
+    def test_racing_checkouts_place_the_order_once(self):
+        cart = Cart.objects.create(user=self.user)
+        CartItem.objects.create(cart=cart, product_id=1, quantity=2)
+        first, second = Cart.objects.get(), Cart.objects.get()
+        for loaded in (first, second):
+            loaded.order_completed = True
+            loaded.save()
+        self.assertEqual(Product.objects.get(pk=1).stock, 8)
+        self.assertEqual(CheckoutJob.objects.count(), 1)
+
+
+class AsyncReadAPITest(TestCase):
+    """
+    The async read endpoints answer like their sync counterparts
+    """
+
+    def setUp(self):
+        seed_products()
+        self.user, self.token = get_seed_user_token()
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + self.token)
+
+    def assertSameResponse(self, sync_url, async_url, num_queries):
+        response = self.client.get(sync_url)
+        with self.assertNumQueries(num_queries):
+            async_response = self.client.get(async_url)
+        self.assertEqual(async_response.status_code, response.status_code)
+        # Only the pagination links differ, they stay on the async endpoint
+        self.assertEqual(
+            async_response.content.replace(b"/api/async/", b"/api/"),
+            response.content,
+        )
+        return async_response
+
+    def test_product_reads(self):
+        # Catalog version and the page
+        response = self.assertSameResponse(
+            reverse("product-list") + "?page_size=2",
+            reverse("async-product-list") + "?page_size=2",
+            2,
+        )
+        self.assertEqual(
+            response.headers["ETag"],
+            self.client.get(reverse("product-list")).headers["ETag"],
+        )
+        next_url = response.json()["next"]
+        self.assertIn(reverse("async-product-list"), next_url)
+        self.assertEqual(self.client.get(next_url).status_code, 200)
+
+        # Stock with the version, then the rest of the product
+        response = self.assertSameResponse(
+            reverse("product-detail", args=[1]),
+            reverse("async-product-detail", args=[1]),
+            2,
+        )
+        response = self.client.get(
+            reverse("async-product-detail", args=[1]),
+            HTTP_IF_NONE_MATCH=response.headers["ETag"],
+        )
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        self.assertSameResponse(
+            reverse("product-detail", args=[999]),
+            reverse("async-product-detail", args=[999]),
+            1,
+        )
+
+    def test_cart_reads(self):
+        for _ in range(3):
+            cart = Cart.objects.create(user=self.user, delivery_time=now())
+            CartItem.objects.bulk_create(
+                CartItem(cart=cart, product_id=pk, quantity=pk)
+                for pk in (1, 2)
+            )
+        Cart.objects.create(user=self.user)
+
+        # Token lookup, carts and the items of all carts
+        self.assertSameResponse(
+            reverse("cart-list"), reverse("async-cart-list"), 3
+        )
+        self.assertSameResponse(
+            reverse("cart-detail", args=[cart.pk]),
+            reverse("async-cart-detail", args=[cart.pk]),
+            3,
+        )
+
+        other = User.objects.create_user("other", password="password")
+        other_cart = Cart.objects.create(user=other)
+        response = self.client.get(
+            reverse("async-cart-detail", args=[other_cart.pk])
+        )
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_cart_reads_require_token(self):
+        for credentials in ({}, {"HTTP_AUTHORIZATION": "Token wrong"}):
+            self.client.credentials(**credentials)
+            response = self.client.get(reverse("async-cart-list"))
+            self.assertEqual(
+                response.status_code, status.HTTP_401_UNAUTHORIZED
+            )
+            self.assertEqual(
+                response.content,
+                self.client.get(reverse("cart-list")).content,
+            )
+
+        response = self.client.post(reverse("async-cart-list"))
+        self.assertEqual(
+            response.status_code, status.HTTP_405_METHOD_NOT_ALLOWED
+        )
+
+
+class OrderHistoryTest(TestCase):
+    def setUp(self):
+        seed_products()
+        self.user, self.token = get_seed_user_token()
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + self.token)
+
+    def order(self, items):
+        response = self.client.post(
+            reverse("cart-list"),
+            {"items": items, "order_completed": True},
+            format="json",
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        return response.data
+
+    def test_order_summary_is_captured_at_checkout(self):
+        prices = dict(Product.objects.values_list("pk", "price"))
+        response = self.client.post(
+            reverse("cart-list"),
+            {"items": [{"product": 1, "quantity": 2}]},
+            format="json",
+        )
+        cart_url = reverse("cart-detail", args=[response.data["pk"]])
+        self.assertIsNone(response.data["total_price"])
+
+        response = self.client.patch(
+            cart_url, {"order_completed": True}, format="json"
+        )
+        self.assertEqual(response.data["item_count"], 2)
+        self.assertEqual(response.data["total_price"], 2 * prices[1])
+        self.assertEqual(response.data["items"][0]["unit_price"], prices[1])
+
+        # Later price changes leave the order alone, new lines get the
+        # current price
+        Product.objects.filter(pk__in=[1, 2]).update(price=1)
+        response = self.client.post(
+            cart_url + "items/", {"product": 2, "quantity": 1}, format="json"
+        )
+        self.assertEqual(response.data["item_count"], 3)
+        self.assertEqual(response.data["total_price"], 2 * prices[1] + 1)
+
+        response = self.client.patch(
+            cart_url, {"order_completed": False}, format="json"
+        )
+        self.assertIsNone(response.data["ordered_at"])
+        self.assertIsNone(response.data["total_price"])
+        self.assertEqual(
+            [item["unit_price"] for item in response.data["items"]],
+            [None, None],
+        )
+
+    def test_order_history_in_one_query(self):
+        first = self.order([{"product": 1, "quantity": 1}])
+        second = self.order(
+            [{"product": 1, "quantity": 1}, {"product": 2, "quantity": 3}]
+        )
+        self.client.post(
+            reverse("cart-list"),
+            {"items": [{"product": 3, "quantity": 1}]},
+            format="json",
+        )
+        other = User.objects.create_user("other", password="password")
+        Cart.objects.create(user=other, order_completed=True)
+
+        # Token lookup and the orders
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse("cart-history"))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            [order["pk"] for order in response.data["results"]],
+            [second["pk"], first["pk"]],
+        )
+        self.assertEqual(
+            response.data["results"][0],
+            {
+                "pk": second["pk"],
+                "ordered_at": second["ordered_at"],
+                "delivery_time": None,
+                "item_count": 4,
+                "total_price": second["total_price"],
+            },
+        )
+
+        response = self.client.get(reverse("cart-history") + "?page_size=1")
+        self.assertEqual(len(response.data["results"]), 1)
+        response = self.client.get(response.data["next"])
+        self.assertEqual(response.data["results"][0]["pk"], first["pk"])
+
+
+class CartItemSyncTest(TestCase):
+    def setUp(self):
+        self.user, token = get_seed_user_token()
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + token)
+        self.products = Product.objects.bulk_create(
+            Product(
+                name=f"Part {i}",
+                overview="Spare part",
+                model="Honda City",
+                year=date(2020, 1, 1),
+                stock=10,
+            )
+            for i in range(201)
+        )
+        self.cart = Cart.objects.create(user=self.user)
+        CartItem.objects.bulk_create(
+            CartItem(cart=self.cart, product=product, quantity=1)
+            for product in self.products[:200]
+        )
+
+    def test_adding_item_to_large_cart_writes_one_row(self):
+        items = [
+            {"product": product.pk, "quantity": 1} for product in self.products
+        ]
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.patch(
+                reverse("cart-list") + f"{self.cart.pk}/",
+                {"items": items},
+                format="json",
+            )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data["items"]), 201)
+
+        writes = [
+            query["sql"] for query in ctx.captured_queries
+            if query["sql"].startswith(("INSERT", "UPDATE", "DELETE"))
+        ]
+        self.assertEqual(len(writes), 2)
+        self.assertTrue(writes[0].startswith('INSERT INTO "api_cartitem"'))
+        self.assertTrue(writes[1].startswith('UPDATE "api_cart"'))
+
+    def test_changed_and_removed_items_are_written_in_bulk(self):
+        items = [
+            {"product": product.pk, "quantity": 2}
+            for product in self.products[:50]
+        ]
+        with CaptureQueriesContext(connection) as ctx:
+            self.client.patch(
+                reverse("cart-list") + f"{self.cart.pk}/",
+                {"items": items},
+                format="json",
+            )
+
+        writes = [
+            query["sql"].split(" ")[0] for query in ctx.captured_queries
+            if query["sql"].startswith(("INSERT", "UPDATE", "DELETE"))
+        ]
+        # Bulk update of the items, one DELETE, and the cart itself
+        self.assertEqual(writes, ["UPDATE", "DELETE", "UPDATE"])
+        self.assertEqual(
+            list(self.cart.items.values_list("quantity", flat=True).distinct()),
+            [2],
+        )
+        self.assertEqual(self.cart.items.count(), 50)
+
+
+class StockReservationTest(TestCase):
+    def setUp(self):
+        seed_products()
+
+    def test_reserve_and_release_stock(self):
+        with self.assertNumQueries(3):
+            reserve_stock([(1, 2), (3, 5), (1, 1)])
+        self.assertEqual(Product.objects.get(pk=1).stock, 7)
+        self.assertEqual(Product.objects.get(pk=3).stock, 95)
+
+        with self.assertNumQueries(1):
+            release_stock([(1, 3), (3, 5)])
+        self.assertEqual(Product.objects.get(pk=1).stock, 10)
+        self.assertEqual(Product.objects.get(pk=3).stock, 100)
+
+    def test_reserve_stock_is_all_or_nothing(self):
+        with self.assertRaises(InsufficientStock):
+            reserve_stock([(1, 2), (2, 6)])
+        self.assertEqual(Product.objects.get(pk=1).stock, 10)
+        self.assertEqual(Product.objects.get(pk=2).stock, 5)
+
+
+class StockShardTest(TestCase):
+    def setUp(self):
+        seed_products()
+        self.user, token = get_seed_user_token()
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + token)
+
+    def shards(self, pk):
+        return list(
+            StockShard.objects.filter(product_id=pk)
+            .order_by("shard")
+            .values_list("stock", flat=True)
+        )
+
+    def total(self, pk):
+        return Product.objects.get(pk=pk).stock + sum(self.shards(pk))
+
+    def test_set_stock_shards(self):
+        self.assertEqual(set_stock_shards(1, 3), 10)
+        self.assertEqual(self.shards(1), [4, 3, 3])
+        product = Product.objects.get(pk=1)
+        self.assertEqual((product.stock, product.stock_shards), (0, 3))
+
+        # Stock written to the product row is spread again
+        Product.objects.filter(pk=1).update(stock=2)
+        self.assertEqual(set_stock_shards(1, 2), 12)
+        self.assertEqual(self.shards(1), [6, 6])
+
+        self.assertEqual(set_stock_shards(1, 0), 12)
+        self.assertEqual(self.shards(1), [])
+        product = Product.objects.get(pk=1)
+        self.assertEqual((product.stock, product.stock_shards), (12, 0))
+
+    def test_reserve_and_release_sharded_stock(self):
+        set_stock_shards(1, 4)
+        self.assertEqual(self.shards(1), [3, 3, 2, 2])
+        reserve_stock([(1, 2), (3, 5)])
+        self.assertEqual(self.total(1), 8)
+        self.assertEqual(Product.objects.get(pk=3).stock, 95)
+        # One shard gave all of it
+        changed = [
+            before - after
+            for before, after in zip([3, 3, 2, 2], self.shards(1))
+            if before != after
+        ]
+        self.assertEqual(changed, [2])
+
+        release_stock([(1, 2), (3, 5)])
+        self.assertEqual(self.total(1), 10)
+        self.assertEqual(Product.objects.get(pk=3).stock, 100)
+
+    def test_reserve_spreads_over_shards(self):
+        set_stock_shards(1, 4)
+        Product.objects.filter(pk=1).update(stock=1)
+        reserve_stock([(1, 10)])
+        self.assertEqual(self.shards(1), [0, 0, 0, 0])
+        self.assertEqual(Product.objects.get(pk=1).stock, 1)
+
+        with self.assertRaises(InsufficientStock):
+            reserve_stock([(3, 1), (1, 2)])
+        self.assertEqual(self.total(1), 1)
+        self.assertEqual(Product.objects.get(pk=3).stock, 100)
+
+    def test_stock_writes_go_to_the_shards(self):
+        set_stock_shards(1, 2)
+        product = Product.objects.get(pk=1)
+        product.stock = 7
+        product.save()
+        self.assertEqual(self.shards(1), [4, 3])
+        self.assertEqual(self.total(1), 7)
+        # Saves which leave the stock alone leave the shards alone
+        product.price = 1200
+        product.save()
+        self.assertEqual(self.shards(1), [4, 3])
+
+        feed = [
+            "name,overview,model,year,stock,price",
+            "MRF tyres,Tyres,Honda City,2020,,1100",
+        ]
+        ProductImporter().run(read_csv(feed))
+        self.assertEqual(self.total(1), 7)
+        feed[1] = "MRF tyres,Tyres,Honda City,2020,10,1100"
+        ProductImporter().run(read_csv(feed))
+        self.assertEqual(self.shards(1), [5, 5])
+        self.assertEqual(self.total(1), 10)
+
+    def test_api_reads_sharded_stock(self):
+        set_stock_shards(1, 4)
+        Product.objects.filter(pk=1).update(stock=1)
+        response = self.client.get(reverse("product-list") + "1/")
+        self.assertEqual(response.data["stock"], 11)
+
+        data = self.client.get(
+            reverse("product-search"), {"q": "tyre", "in_stock": "true"}
+        ).data
+        self.assertEqual(data["results"][0]["stock"], 11)
+
+        Product.objects.filter(pk=1).update(stock=0)
+        StockShard.objects.filter(product_id=1).update(stock=0)
+        data = self.client.get(
+            reverse("product-search"), {"q": "tyre", "in_stock": "true"}
+        ).data
+        self.assertEqual([row["pk"] for row in data["results"]], [2, 5])
+
+    def test_checkout_of_sharded_product(self):
+        set_stock_shards(1, 4)
+        response = self.client.post(
+            reverse("cart-list"),
+            {"items": [{"product": 1, "quantity": 11}]},
+            format="json",
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        response = self.client.post(
+            reverse("cart-list"),
+            {
+                "items": [{"product": 1, "quantity": 10}],
+                "order_completed": True,
+            },
+            format="json",
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(self.total(1), 0)
+
+    def test_shard_stock_command(self):
+        out = StringIO()
+        call_command("shard_stock", "1", "3", shards=2, stdout=out)
+        self.assertIn("Product 1: 10 in stock over 2 shards", out.getvalue())
+        self.assertEqual(self.shards(3), [50, 50])
+        with self.assertRaises(CommandError):
+            call_command("shard_stock", "99", stdout=out)
+
+
+class OrderTransitionTest(TestCase):
+    def setUp(self):
+        self.user, _ = get_seed_user_token()
+        products = Product.objects.bulk_create(
+            Product(
+                name=f"Part {i}",
+                overview="Spare part",
+                model="Honda City",
+                year=date(2020, 1, 1),
+                stock=10,
+            )
+            for i in range(100)
+        )
+        cart = Cart.objects.create(user=self.user)
+        CartItem.objects.bulk_create(
+            CartItem(cart=cart, product=product, quantity=1)
+            for product in products
+        )
+        self.cart = Cart.objects.get(pk=cart.pk)
+
+    def test_save_without_transition_has_no_extra_queries(self):
+        self.cart.delivery_time = now()
+        # Just the UPDATE of the cart itself
+        with self.assertNumQueries(1):
+            self.cart.save()
+
+    def test_transitions_of_100_item_cart_are_bounded(self):
+        # Order state switch, cart items with prices, savepoint, stock
+        # update, release savepoint, price snapshot, checkout job, cart update
+        self.cart.order_completed = True
+        with self.assertNumQueries(8):
+            self.cart.save()
+        self.assertEqual(
+            Product.objects.filter(stock=9).count(), 100
+        )
+
+        # Order state switch, cart items, stock update, dropping the
+        # snapshot, cancelling the checkout job, cart update
+        self.cart.order_completed = False
+        with self.assertNumQueries(6):
+            self.cart.save()
+        self.assertEqual(
+            Product.objects.filter(stock=10).count(), 100
+        )
+
+
+def failing_step(cart):
+    raise RuntimeError("payment provider unavailable")
+
+
+class CheckoutQueueTest(TestCase):
+    def setUp(self):
+        seed_products()
+        self.user, token = get_seed_user_token()
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + token)
+        self.cart = Cart.objects.create(user=self.user)
+        CartItem.objects.create(cart=self.cart, product_id=1, quantity=2)
+        self.url = reverse("cart-list") + f"{self.cart.pk}/"
+
+    def checkout(self, **headers):
+        return self.client.patch(
+            self.url, {"order_completed": True}, format="json", **headers
+        )
+
+    def test_order_enqueues_one_job(self):
+        self.assertEqual(self.checkout().status_code, status.HTTP_200_OK)
+        self.assertEqual(self.checkout().status_code, status.HTTP_200_OK)
+        job = CheckoutJob.objects.get()
+        self.assertEqual(job.cart_id, self.cart.pk)
+        self.assertEqual(job.status, CheckoutJob.PENDING)
+
+        # Reversing the order cancels the job it did not run yet
+        self.client.patch(self.url, {"order_completed": False}, format="json")
+        job.refresh_from_db()
+        self.assertEqual(job.status, CheckoutJob.CANCELLED)
+        # Ordering again is a new checkout
+        self.checkout()
+        self.assertEqual(
+            CheckoutJob.objects.filter(status=CheckoutJob.PENDING).count(), 1
+        )
+
+    def test_retried_checkout_is_replayed(self):
+        data = {"items": [{"product": 2, "quantity": 1}], "order_completed": 1}
+        stock = Product.objects.get(pk=2).stock
+        first = self.client.post(
+            reverse("cart-list"), data, format="json", HTTP_IDEMPOTENCY_KEY="a"
+        )
+        self.assertEqual(first.status_code, status.HTTP_201_CREATED)
+        second = self.client.post(
+            reverse("cart-list"), data, format="json", HTTP_IDEMPOTENCY_KEY="a"
+        )
+        self.assertEqual(second.status_code, status.HTTP_200_OK)
+        self.assertEqual(second.headers["Idempotent-Replayed"], "true")
+        self.assertEqual(second.data["pk"], first.data["pk"])
+        self.assertEqual(Product.objects.get(pk=2).stock, stock - 1)
+        self.assertEqual(CheckoutJob.objects.count(), 1)
+
+        # The key can't be reused for another cart
+        response = self.checkout(HTTP_IDEMPOTENCY_KEY="a")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_racing_retry_is_rolled_back_and_replayed(self):
+        data = {"items": [{"product": 2, "quantity": 1}], "order_completed": 1}
+        stock = Product.objects.get(pk=2).stock
+        first = self.client.post(
+            reverse("cart-list"), data, format="json", HTTP_IDEMPOTENCY_KEY="a"
+        )
+        carts = Cart.objects.count()
+
+        replay = CartViewset.replay_checkout
+        calls = []
+
+        def racing_replay(view):
+            # The first request only commits after the retry looked
+            calls.append(view)
+            return None if len(calls) == 1 else replay(view)
+
+        with mock.patch.object(CartViewset, "replay_checkout", racing_replay):
+            second = self.client.post(
+                reverse("cart-list"),
+                data,
+                format="json",
+                HTTP_IDEMPOTENCY_KEY="a",
+            )
+        self.assertEqual(second.status_code, status.HTTP_200_OK)
+        self.assertEqual(second.headers["Idempotent-Replayed"], "true")
+        self.assertEqual(second.data["pk"], first.data["pk"])
+        self.assertEqual(Cart.objects.count(), carts)
+        self.assertEqual(Product.objects.get(pk=2).stock, stock - 1)
+        self.assertEqual(CheckoutJob.objects.count(), 1)
+
+    @override_settings(
+        CHECKOUT_QUEUE={**settings.CHECKOUT_QUEUE, "MAX_PENDING": 1}
+    )
+    def test_full_queue_refuses_checkouts(self):
+        other = Cart.objects.create(user=self.user)
+        other.order_completed = True
+        other.save()
+        stock = Product.objects.get(pk=1).stock
+
+        response = self.checkout()
+        self.assertEqual(
+            response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE
+        )
+        self.assertEqual(
+            response.headers["Retry-After"],
+            str(settings.CHECKOUT_QUEUE["RETRY_AFTER"]),
+        )
+        self.assertEqual(Product.objects.get(pk=1).stock, stock)
+        # Carts which are not ordered are still saved
+        response = self.client.patch(
+            self.url, {"delivery_time": None}, format="json"
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_worker_confirms_orders(self):
+        self.checkout()
+        out = StringIO()
+        # Would close the connection holding the transaction of the test
+        with mock.patch(
+            "autocompany.api.management.commands.run_checkout_worker."
+            "close_old_connections"
+        ):
+            call_command("run_checkout_worker", once=True, stdout=out)
+        self.assertIn("1 jobs", out.getvalue())
+
+        job = CheckoutJob.objects.get()
+        self.assertEqual(job.status, CheckoutJob.DONE)
+        self.assertEqual(job.attempts, 1)
+        self.assertIsNotNone(job.finished_at)
+        response = self.client.get(self.url)
+        self.assertIsNotNone(response.data["confirmed_at"])
+        # Nothing left to do
+        self.assertEqual(CheckoutWorker().run_once(), 0)
+
+    @override_settings(
+        CHECKOUT_QUEUE={
+            **settings.CHECKOUT_QUEUE,
+            "STEPS": ["autocompany.api.tests.failing_step"],
+            "MAX_ATTEMPTS": 2,
+        }
+    )
+    def test_failed_jobs_are_retried_with_backoff(self):
+        self.checkout()
+        worker = CheckoutWorker()
+        with self.assertLogs("autocompany.api.checkout", "ERROR"):
+            self.assertEqual(worker.run_once(), 1)
+        job = CheckoutJob.objects.get()
+        self.assertEqual(job.status, CheckoutJob.PENDING)
+        self.assertIn("payment provider unavailable", job.last_error)
+        self.assertGreater(job.run_after, now())
+        # Not due before the delay has passed
+        self.assertEqual(worker.run_once(), 0)
+
+        CheckoutJob.objects.update(run_after=now())
+        with self.assertLogs("autocompany.api.checkout", "ERROR"):
+            self.assertEqual(worker.run_once(), 1)
+        job.refresh_from_db()
+        self.assertEqual(job.status, CheckoutJob.FAILED)
+        self.assertEqual(job.attempts, 2)
+        self.assertIsNone(Cart.objects.get(pk=self.cart.pk).confirmed_at)
+
+    def test_jobs_of_reversed_orders_are_cancelled(self):
+        self.checkout()
+        # Reversed after the worker claimed the job
+        Cart.objects.filter(pk=self.cart.pk).update(order_completed=False)
+        CheckoutWorker().run_once()
+        self.assertEqual(
+            CheckoutJob.objects.get().status, CheckoutJob.CANCELLED
+        )
+
+
+class DeliverySlotTest(TestCase):
+    def setUp(self):
+        caches["default"].clear()
+        seed_products()
+        self.user, token = get_seed_user_token()
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + token)
+        start = now() + timedelta(days=1)
+        self.slot, self.other = DeliverySlot.objects.bulk_create(
+            DeliverySlot(
+                start=start + timedelta(hours=hour),
+                end=start + timedelta(hours=hour + 1),
+                capacity=1,
+            )
+            for hour in range(2)
+        )
+
+    def order(self, slot, **data):
+        return self.client.post(
+            reverse("cart-list"),
+            {
+                "items": [{"product": 1, "quantity": 1}],
+                "delivery_slot": slot.pk,
+                "order_completed": True,
+                **data,
+            },
+            format="json",
+        )
+
+    def booked(self):
+        return list(
+            DeliverySlot.objects.order_by("start").values_list(
+                "booked", flat=True
+            )
+        )
+
+    def test_orders_book_slot_capacity(self):
+        response = self.order(self.slot)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data["delivery_slot"], self.slot.pk)
+        self.assertEqual(
+            Cart.objects.get(pk=response.data["pk"]).delivery_time,
+            self.slot.start,
+        )
+        self.assertEqual(self.booked(), [1, 0])
+
+        # The slot is full now, also for carts which are only saved with it
+        stock = Product.objects.get(pk=1).stock
+        cart = Cart.objects.create(user=self.user, delivery_slot=self.slot)
+        CartItem.objects.create(cart=cart, product_id=1, quantity=1)
+        response = self.client.patch(
+            reverse("cart-list") + f"{cart.pk}/",
+            {"order_completed": True},
+            format="json",
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn("delivery_slot", response.data)
+        self.assertEqual(Product.objects.get(pk=1).stock, stock)
+        self.assertEqual(self.booked(), [1, 0])
+
+    def test_moving_and_reversing_orders_update_capacity(self):
+        url = reverse("cart-list") + f"{self.order(self.slot).data['pk']}/"
+        response = self.client.patch(
+            url, {"delivery_slot": self.other.pk}, format="json"
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.booked(), [0, 1])
+
+        self.client.patch(url, {"order_completed": False}, format="json")
+        self.assertEqual(self.booked(), [0, 0])
+        # Open carts hold no capacity
+        self.client.patch(url, {"delivery_slot": self.slot.pk}, format="json")
+        self.assertEqual(self.booked(), [0, 0])
+
+    def test_booking_is_one_conditional_update(self):
+        cart = Cart.objects.create(user=self.user, delivery_slot=self.slot)
+        cart = Cart.objects.get(pk=cart.pk)
+        cart.order_completed = True
+        with CaptureQueriesContext(connection) as ctx:
+            cart.save()
+        slot_queries = [
+            query["sql"] for query in ctx.captured_queries
+            if "api_deliveryslot" in query["sql"]
+        ]
+        self.assertEqual(len(slot_queries), 1)
+        self.assertTrue(slot_queries[0].startswith("UPDATE"))
+
+    def test_past_slots_are_refused(self):
+        DeliverySlot.objects.filter(pk=self.slot.pk).update(
+            start=now() - timedelta(hours=1)
+        )
+        response = self.order(self.slot)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.booked(), [0, 0])
+
+    def test_availability_is_cached_and_reads_no_carts(self):
+        self.order(self.slot)
+        url = reverse("delivery-slot-list")
+        # Anonymous, so there is no token lookup either
+        self.client = APIClient()
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url, {"days": 2})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(ctx.captured_queries), 1)
+        self.assertNotIn("api_cart", ctx.captured_queries[0]["sql"])
+        self.assertEqual(
+            [
+                (slot["pk"], slot["available"])
+                for slot in response.data["slots"]
+            ],
+            [(self.slot.pk, 0), (self.other.pk, 1)],
+        )
+        self.assertIn("max-age", response.headers["Cache-Control"])
+
+        with self.assertNumQueries(0):
+            self.client.get(url)
+        response = self.client.get(url, {"days": 1000})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_create_delivery_slots(self):
+        DeliverySlot.objects.all().delete()
+        call_command("create_delivery_slots", days=2, stdout=StringIO())
+        self.assertEqual(DeliverySlot.objects.count(), 24)
+        out = StringIO()
+        call_command("create_delivery_slots", days=3, stdout=out)
+        self.assertEqual(DeliverySlot.objects.count(), 36)
+        self.assertIn("Created 12", out.getvalue())
+
+
+@override_settings(CART_EXPIRY={**settings.CART_EXPIRY, "HOLD_SECONDS": 600})
+class CartExpiryTest(TestCase):
+    def setUp(self):
+        seed_products()
+        self.user, token = get_seed_user_token()
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + token)
+        self.stock = dict(Product.objects.values_list("pk", "stock"))
+
+    def stock_change(self):
+        return {
+            pk: stock - self.stock[pk]
+            for pk, stock in Product.objects.values_list("pk", "stock")
+            if stock != self.stock[pk]
+        }
+
+    def sweep(self, **options):
+        out = StringIO()
+        call_command("sweep_carts", stdout=out, **options)
+        return out.getvalue()
+
+    def test_open_carts_hold_stock(self):
+        response = self.client.post(
+            reverse("cart-list"),
+            {"items": [{"product": 1, "quantity": 2}]},
+            format="json",
+        )
+        url = reverse("cart-list") + f"{response.data['pk']}/"
+        self.assertEqual(self.stock_change(), {1: -2})
+        self.assertIsNotNone(Cart.objects.get().held_until)
+
+        self.client.post(url + "items/", {"product": 2, "quantity": 1})
+        self.client.patch(url + "items/1/", {"quantity": 1})
+        self.assertEqual(self.stock_change(), {1: -1, 2: -1})
+
+        # The order takes the held stock over
+        self.client.patch(url, {"order_completed": True}, format="json")
+        self.assertEqual(self.stock_change(), {1: -1, 2: -1})
+        self.assertIsNone(Cart.objects.get().held_until)
+        self.client.patch(url, {"order_completed": False}, format="json")
+        self.assertEqual(self.stock_change(), {})
+
+    def test_held_stock_is_not_checked_again(self):
+        Product.objects.filter(pk=1).update(stock=10)
+        self.stock[1] = 10
+        response = self.client.post(
+            reverse("cart-list"),
+            {"items": [{"product": 1, "quantity": 8}]},
+            format="json",
+        )
+        url = reverse("cart-list") + f"{response.data['pk']}/"
+        data = {"items": [{"product": 1, "quantity": 8}]}
+        response = self.client.patch(
+            url, {**data, "order_completed": True}, format="json"
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = self.client.patch(url, data, format="json")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.stock_change(), {1: -8})
+
+    def test_deleting_an_open_cart_releases_its_hold(self):
+        response = self.client.post(
+            reverse("cart-list"),
+            {"items": [{"product": 1, "quantity": 2}]},
+            format="json",
+        )
+        self.assertEqual(self.stock_change(), {1: -2})
+        self.client.delete(reverse("cart-list") + f"{response.data['pk']}/")
+        self.assertFalse(Cart.objects.exists())
+        self.assertEqual(self.stock_change(), {})
+
+    def test_sweep_releases_expired_holds(self):
+        for _ in range(3):
+            self.client.post(
+                reverse("cart-list"),
+                {
+                    "items": [
+                        {"product": 1, "quantity": 1},
+                        {"product": 3, "quantity": 2},
+                    ]
+                },
+                format="json",
+            )
+        self.assertEqual(self.stock_change(), {1: -3, 3: -6})
+        Cart.objects.update(held_until=now() - timedelta(minutes=1))
+
+        with CaptureQueriesContext(connection) as ctx:
+            out = self.sweep(batch_size=2)
+        # One stock UPDATE per batch, however many items
+        stock_updates = [
+            query for query in ctx.captured_queries
+            if query["sql"].startswith('UPDATE "api_product"')
+        ]
+        self.assertEqual(len(stock_updates), 2)
+        self.assertIn("3 holds released", out)
+        self.assertIn("rows/s", out)
+        self.assertEqual(self.stock_change(), {})
+        self.assertFalse(Cart.objects.filter(held_until__isnull=False).exists())
+        # Released carts stay, and hold again once changed
+        self.assertEqual(Cart.objects.count(), 3)
+
+    def test_sweep_deletes_stale_open_carts(self):
+        ordered = Cart.objects.create(user=self.user)
+        CartItem.objects.create(cart=ordered, product_id=3, quantity=1)
+        ordered.order_completed = True
+        ordered.save()
+        for _ in range(5):
+            self.client.post(
+                reverse("cart-list"),
+                {"items": [{"product": 1, "quantity": 1}]},
+                format="json",
+            )
+        fresh = Cart.objects.create(user=self.user)
+        Cart.objects.exclude(pk=fresh.pk).update(
+            updated_at=now() - timedelta(days=31)
+        )
+
+        out = self.sweep(batch_size=2, days=30)
+        self.assertIn("5 carts and 5 items deleted", out)
+        self.assertEqual(
+            set(Cart.objects.values_list("pk", flat=True)),
+            {ordered.pk, fresh.pk},
+        )
+        # The holds of deleted carts went back to stock
+        self.assertEqual(self.stock_change(), {3: -1})
+        self.assertIn("0 holds released, 0 carts", self.sweep(days=30))
+
+    def test_item_changes_count_as_activity(self):
+        cart = Cart.objects.create(user=self.user)
+        Cart.objects.update(updated_at=now() - timedelta(days=31))
+        self.client.post(
+            reverse("cart-list") + f"{cart.pk}/items/",
+            {"product": 1, "quantity": 1},
+        )
+        self.assertIn("0 carts", self.sweep(days=30))
+        self.assertTrue(Cart.objects.filter(pk=cart.pk).exists())
+
+
+class CartBatchTest(TestCase):
+    def setUp(self):
+        seed_products()
+        self.user, token = get_seed_user_token()
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + token)
+        self.stock = dict(Product.objects.values_list("pk", "stock"))
+
+    def batch(self, operations, **data):
+        return self.client.post(
+            reverse("cart-batch"),
+            {"operations": operations, **data},
+            format="json",
+        )
+
+    def create(self, *lines, ordered=False, **data):
+        return {
+            "op": "create",
+            "data": {
+                "items": [
+                    {"product": pk, "quantity": quantity}
+                    for pk, quantity in lines
+                ],
+                "order_completed": ordered,
+            },
+            **data,
+        }
+
+    def stock_change(self):
+        return {
+            pk: stock - self.stock[pk]
+            for pk, stock in Product.objects.values_list("pk", "stock")
+            if stock != self.stock[pk]
+        }
+
+    def test_batch_creates_carts(self):
+        response = self.batch(
+            [self.create((1, 2), (3, 1)), self.create((3, 4), ordered=True)]
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["succeeded"], 2)
+        open_cart, ordered = response.data["results"]
+        self.assertEqual(open_cart["status"], status.HTTP_201_CREATED)
+        self.assertEqual(len(open_cart["cart"]["items"]), 2)
+        self.assertIsNone(open_cart["cart"]["ordered_at"])
+        self.assertEqual(ordered["cart"]["item_count"], 4)
+        self.assertEqual(
+            ordered["cart"]["total_price"], 4 * Product.objects.get(pk=3).price
+        )
+        self.assertEqual(self.stock_change(), {3: -4})
+        self.assertEqual(
+            list(CheckoutJob.objects.values_list("cart_id", flat=True)),
+            [ordered["cart"]["pk"]],
+        )
+
+    def test_queries_do_not_grow_with_the_batch(self):
+        def queries(count):
+            with CaptureQueriesContext(connection) as context:
+                response = self.batch(
+                    [self.create((3, 1), ordered=True)] * count
+                )
+            self.assertEqual(response.data["succeeded"], count)
+            return len(context)
+
+        self.assertEqual(queries(2), queries(10))
+        self.assertEqual(self.stock_change(), {3: -12})
+
+    def test_atomic_batch_is_rolled_back(self):
+        cart = Cart.objects.create(user=self.user)
+        response = self.batch(
+            [
+                self.create((1, 1)),
+                self.create((2, 6), ordered=True),
+                {"op": "checkout", "cart": cart.pk},
+            ]
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(
+            [result["status"] for result in response.data["results"]],
+            [424, 400, 424],
+        )
+        self.assertEqual(Cart.objects.count(), 1)
+        self.assertEqual(self.stock_change(), {})
+
+    def test_operations_share_the_stock(self):
+        cart = Cart.objects.create(user=self.user)
+        CartItem.objects.create(cart=cart, product_id=2, quantity=2)
+        response = self.batch(
+            [
+                self.create((2, 3), ordered=True),
+                {"op": "checkout", "cart": cart.pk},
+                {"op": "update", "cart": 999, "data": {}},
+                self.create((9, 1)),
+            ],
+            atomic=False,
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            [result["status"] for result in response.data["results"]],
+            [201, 200, 404, 400],
+        )
+        results = response.data["results"]
+        self.assertTrue(results[1]["cart"]["order_completed"])
+        self.assertEqual(results[2]["errors"], {"detail": "Not found."})
+        self.assertIn("product", results[3]["errors"]["items"])
+        self.assertEqual(self.stock_change(), {2: -5})
+
+        # Only 0 left, the cart keeps what it holds
+        response = self.batch(
+            [
+                {
+                    "op": "update",
+                    "cart": cart.pk,
+                    "data": {"items": [{"product": 2, "quantity": 1}]},
+                },
+                self.create((2, 1), ordered=True),
+            ],
+            atomic=False,
+        )
+        self.assertEqual(
+            [result["status"] for result in response.data["results"]],
+            [200, 400],
+        )
+        self.assertEqual(self.stock_change(), {2: -4})
+
+    def test_failed_bulk_write_falls_back_to_savepoints(self):
+        start = now() + timedelta(days=1)
+        slot = DeliverySlot.objects.create(
+            start=start, end=start + timedelta(hours=1), capacity=1
+        )
+        order = self.create((1, 1), ordered=True)
+        order["data"]["delivery_slot"] = slot.pk
+        response = self.batch([order, order, self.create((1, 1))], atomic=False)
+        self.assertEqual(
+            [result["status"] for result in response.data["results"]],
+            [201, 400, 201],
+        )
+        self.assertIn("delivery_slot", response.data["results"][1]["errors"])
+        self.assertEqual(self.stock_change(), {1: -1})
+        self.assertEqual(DeliverySlot.objects.get().booked, 1)
+
+    def test_retried_operations_are_replayed(self):
+        operation = self.create((1, 1), ordered=True, idempotency_key="a")
+        first = self.batch([operation]).data["results"][0]
+        second = self.batch([operation]).data["results"][0]
+        self.assertEqual(second["status"], status.HTTP_200_OK)
+        self.assertTrue(second["replayed"])
+        self.assertEqual(second["cart"]["pk"], first["cart"]["pk"])
+        self.assertEqual(self.stock_change(), {1: -1})
+
+    @override_settings(CART_BATCH={"MAX_OPERATIONS": 2})
+    def test_invalid_batches(self):
+        response = self.batch([self.create((1, 1))] * 3)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn("operations", response.data)
+        response = self.batch([{"op": "checkout"}])
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(Cart.objects.count(), 0)
+
+    def test_invalid_operations_take_no_stock(self):
+        response = self.batch(
+            [
+                self.create((1, 1), ordered=True, idempotency_key="a"),
+                self.create((1, 1), ordered=True, idempotency_key="a"),
+                self.create((1, -5), ordered=True),
+            ],
+            atomic=False,
+        )
+        ordered, repeated, negative = response.data["results"]
+        self.assertEqual(ordered["status"], status.HTTP_201_CREATED)
+        self.assertIn("idempotency_key", repeated["errors"])
+        self.assertIn("items", negative["errors"])
+        self.assertEqual(Cart.objects.count(), 1)
+        self.assertEqual(CheckoutJob.objects.count(), 1)
+        self.assertEqual(self.stock_change(), {1: -1})
+
+
+class LoadDataTest(TestCase):
+    def generate(self):
+        call_command(
+            "generate_load_data",
+            products=200,
+            users=20,
+            carts=100,
+            seed=7,
+            batch_size=30,
+            stdout=StringIO(),
+        )
+        return (
+            list(
+                Product.objects.order_by("pk").values_list(
+                    "pk", "name", "stock", "year", "updated_at"
+                )
+            ),
+            list(
+                Token.objects.order_by("user_id").values_list(
+                    "key", "user_id"
+                )
+            ),
+            list(
+                Cart.objects.order_by("pk").values_list(
+                    "pk", "user_id", "order_completed", "total_price",
+                    "updated_at",
+                )
+            ),
+            list(
+                CartItem.objects.order_by("cart_id", "product_id")
+                .values_list("cart_id", "product_id")
+            ),
+        )
+
+    def test_generate_load_data_is_deterministic(self):
+        products, tokens, carts, items = self.generate()
+        self.assertEqual(len(products), 200)
+        self.assertEqual(len(tokens), 20)
+        self.assertEqual(len(carts), 100)
+        self.assertGreaterEqual(len(items), 100)
+        # Completed carts come with their order summary
+        self.assertFalse(
+            Cart.objects.filter(
+                order_completed=True, ordered_at__isnull=True
+            ).exists()
+        )
+
+        Product.objects.all().delete()
+        User.objects.all().delete()
+        self.assertEqual(self.generate(), (products, tokens, carts, items))
@@ -2,39 +2,510 @@
 
 __author__ = "Surya Banerjee"
 
-from rest_framework import viewsets
+import codecs
+import re
+from calendar import timegm
+
+from django.conf import settings
+from django.db import transaction
+from django.http import Http404, HttpResponse
+from django.shortcuts import get_object_or_404
+from django.utils.cache import (
+    get_conditional_response,
+    patch_cache_control,
+    patch_vary_headers,
+)
+from django.utils.crypto import constant_time_compare
+from django.utils.http import http_date
+from rest_framework import exceptions, serializers, status, viewsets
+from rest_framework.decorators import action
 from rest_framework.response import Response
-from rest_framework.permissions import IsAuthenticated, AllowAny
+from rest_framework.permissions import IsAuthenticated, AllowAny, IsAdminUser
+from rest_framework.views import APIView
 
-from autocompany.api.models import Product, Cart, CartItem
+from autocompany.api.batch import CartBatch, CartBatchSerializer
+from autocompany.api.checkout import CheckoutConflict, check_queue_capacity
+from autocompany.api.models import Product, Cart, CatalogVersion, CheckoutJob
+from autocompany.api.cache import get_product_cache, uncached_products
+from autocompany.api.delivery import (
+    AvailabilityQuerySerializer,
+    get_availability,
+)
+from autocompany.api.export import EXPORT_FORMATS, export_response
+from autocompany.api.fast_serializers import ValuesSerializer
+from autocompany.api.imports import IMPORT_FORMATS, READERS, ProductImporter
+from autocompany.api.metrics import registry
+from autocompany.api.pagination import (
+    OrderHistoryPagination,
+    ProductCursorPagination,
+)
+from autocompany.api.search import ProductSearch, ProductSearchSerializer
+from autocompany.api.sweep import release_held_stock
+from autocompany.api.stock import (
+    add_shard_stock,
+    product_stock,
+    quantities_by_product,
+)
+from autocompany.api.services import (
+    load_cart_items,
+    sync_cart_items,
+    touch_cart,
+)
 from autocompany.api.serializers import (
     CartSerializer,
+    CartItemSerializer,
+    CartItemUpdateSerializer,
+    check_stock,
+    OrderSummarySerializer,
     ProductListSerializer,
     ProductDetailSerializer,
 )
 
+ACCEPTS_GZIP = re.compile(r"\bgzip\b")
+
 
 class CartViewset(viewsets.ModelViewSet):
     permission_classes = [IsAuthenticated]
 
     serializer_class = CartSerializer
     http_method_names = ["get", "post", "patch", "delete"]
+    write_actions = (
+        "create",
+        "partial_update",
+        "destroy",
+        "add_item",
+        "change_item",
+    )
+
+    def create(self, request, *args, **kwargs):
+        return self.checkout_once(
+            super(CartViewset, self).create, request, *args, **kwargs
+        )
+
+    def update(self, request, *args, **kwargs):
+        return self.checkout_once(
+            super(CartViewset, self).update, request, *args, **kwargs
+        )
+
+    def checkout_once(self, write, *args, **kwargs):
+        """
+        Write the cart, unless its checkout is a retry. A retry racing the
+        request it repeats rolls its own order back and answers with the
+        cart of the other one.
+        """
+        try:
+            return self.write_cart(write, *args, **kwargs)
+        except CheckoutConflict:
+            replayed = self.replay_checkout()
+            if replayed is None:
+                raise
+            return replayed
+
+    # Validation and the write share a transaction, so the products locked
+    # while validating a checkout stay locked until the cart is saved
+    @transaction.atomic
+    def write_cart(self, write, *args, **kwargs):
+        replayed = self.replay_checkout()
+        if replayed is not None:
+            return replayed
+        if self.requests_checkout():
+            check_queue_capacity()
+        return write(*args, **kwargs)
+
+    def perform_create(self, serializer):
+        serializer.save(checkout_key=self.checkout_key())
+
+    def perform_update(self, serializer):
+        serializer.save(checkout_key=self.checkout_key())
+
+    @transaction.atomic
+    def destroy(self, request, *args, **kwargs):
+        return super(CartViewset, self).destroy(request, *args, **kwargs)
+
+    def perform_destroy(self, instance):
+        # The stock held by an open cart goes back with it, an ordered cart
+        # keeps what it took
+        if instance.held_until is not None and not instance.order_completed:
+            release_held_stock([instance.pk])
+        instance.delete()
+
+    def checkout_key(self):
+        """
+        The Idempotency-Key header of the request, scoped to the user
+        """
+        key = self.request.headers.get("Idempotency-Key")
+        return f"user:{self.request.user.pk}:{key}" if key else None
+
+    def requests_checkout(self):
+        try:
+            return serializers.BooleanField().to_internal_value(
+                self.request.data.get("order_completed", False)
+            )
+        except serializers.ValidationError:
+            return False
+
+    def replay_checkout(self):
+        """
+        Answer a checkout retried with the same Idempotency-Key with the
+        cart it ordered, without placing the order again
+        """
+        key = self.checkout_key()
+        if key is None:
+            return None
+        job = CheckoutJob.objects.filter(idempotency_key=key).first()
+        if job is None:
+            return None
+        if self.kwargs.get("pk") not in (None, str(job.cart_id)):
+            raise exceptions.ValidationError(
+                {"Idempotency-Key": ["Already used for another cart."]}
+            )
+        cart = get_object_or_404(self.get_queryset(), pk=job.cart_id)
+        response = Response(self.get_serializer(cart).data)
+        response.headers["Idempotent-Replayed"] = "true"
+        return response
+
+    @action(detail=True, methods=["post"], url_path="items")
+    @transaction.atomic
+    def add_item(self, request, pk=None):
+        """
+        Add a quantity of a product to the cart
+        """
+        line = CartItemSerializer(data=request.data)
+        line.is_valid(raise_exception=True)
+        return self.set_item_quantity(
+            line.validated_data["product_id"],
+            add=line.validated_data["quantity"],
+        )
+
+    @action(
+        detail=True,
+        methods=["patch", "delete"],
+        url_path=r"items/(?P<product_pk>\d+)",
+    )
+    @transaction.atomic
+    def change_item(self, request, pk=None, product_pk=None):
+        """
+        Change the quantity of a product in the cart or remove it
+        """
+        if request.method == "DELETE":
+            self.set_item_quantity(int(product_pk), quantity=0, remove=True)
+            return Response(status=status.HTTP_204_NO_CONTENT)
+
+        line = CartItemUpdateSerializer(
+            data={
+                "product": product_pk,
+                "quantity": request.data.get("quantity"),
+            }
+        )
+        line.is_valid(raise_exception=True)
+        return self.set_item_quantity(
+            line.validated_data["product_id"],
+            quantity=line.validated_data["quantity"],
+        )
+
+    def set_item_quantity(self, product_pk, quantity=None, add=0, remove=False):
+        """
+        Write a single cart line, leaving the other lines untouched. Removing
+        a line the cart doesn't have raises Http404.
+        """
+        cart = self.get_object()
+        existing = load_cart_items(cart)
+        lines = quantities_by_product(existing)
+        if remove and product_pk not in lines:
+            raise Http404
+        held = {}
+        if cart.order_completed or cart.held_until:
+            held = dict(lines)
+        if quantity is None:
+            quantity = lines.get(product_pk, 0) + add
+        lines[product_pk] = quantity
+
+        check_stock(
+            {product_pk: quantity}, lock=cart.order_completed, held=held
+        )
+        sync_cart_items(cart, lines, existing)
+        touch_cart(cart)
+        return Response(self.get_serializer(cart).data)
+
+    @action(detail=False, methods=["post"], url_path="batch")
+    def batch(self, request):
+        """
+        Create, change and order many carts at once, answering with the
+        result of every operation
+        """
+        batch = CartBatchSerializer(data=request.data)
+        batch.is_valid(raise_exception=True)
+        atomic = batch.validated_data["atomic"]
+        results = CartBatch(
+            request, batch.validated_data["operations"], atomic
+        ).run()
+
+        failed = sum(1 for result in results if "errors" in result)
+        return Response(
+            {
+                "atomic": atomic,
+                "succeeded": len(results) - failed,
+                "failed": failed,
+                "results": results,
+            },
+            status=(
+                status.HTTP_400_BAD_REQUEST
+                if atomic and failed
+                else status.HTTP_200_OK
+            ),
+        )
+
+    order_rows = ValuesSerializer(OrderSummarySerializer)
+
+    @action(detail=False, url_path="history")
+    def history(self, request):
+        """
+        Summaries of the completed orders of the user, newest first, read
+        with one query on the order history index
+        """
+        orders = self.order_rows.values(
+            Cart.objects.filter(user=request.user, order_completed=True)
+        )
+        paginator = OrderHistoryPagination()
+        page = paginator.paginate_queryset(orders, request, view=self)
+        return paginator.get_paginated_response(
+            self.order_rows.serialize(page)
+        )
 
     def get_queryset(self):
-        return Cart.objects.filter(user=self.request.user)
+        carts = Cart.objects.filter(user=self.request.user)
+        if self.action in ("list", "retrieve"):
+            # Items are loaded for all carts at once instead of once per cart
+            carts = carts.prefetch_related("items")
+        elif self.action in self.write_actions:
+            # Writes to a cart take turns, and the sweep skips the cart
+            # until the write commits
+            carts = carts.select_for_update()
+        return carts
 
 
 class ProductViewset(viewsets.ModelViewSet):
     permission_classes = [AllowAny]
     serializer_class = ProductListSerializer
     detail_serializer = ProductDetailSerializer
+    pagination_class = ProductCursorPagination
     http_method_names = ["get"]
 
     def get_queryset(self):
+        if self.action == "list":
+            # Only fetch the columns the overview actually shows
+            return Product.objects.only(*ProductListSerializer.Meta.fields)
         return Product.objects.all()
 
+    # Read-only row serializers producing the same output from .values()
+    list_rows = ValuesSerializer(ProductListSerializer)
+    detail_rows = ValuesSerializer(ProductDetailSerializer)
+
     def get_serializer_class(self):
         if self.action == "retrieve":
             if hasattr(self, "detail_serializer"):
                 return self.detail_serializer
         return super(ProductViewset, self).get_serializer_class()
+
+    def list(self, request, *args, **kwargs):
+        cache = get_product_cache() or uncached_products
+        version, updated_at = cache.get_catalog_version(CatalogVersion.current)
+        etag = f'"catalog-{version}-{request.accepted_renderer.format}"'
+
+        return self.conditional_response(
+            request,
+            etag,
+            updated_at,
+            lambda: cache.get_list(
+                version,
+                request.build_absolute_uri(),
+                lambda: self.list_data(request, *args, **kwargs),
+            ),
+        )
+
+    def retrieve(self, request, *args, **kwargs):
+        cache = get_product_cache() or uncached_products
+        try:
+            pk = int(self.kwargs[self.lookup_url_kwarg or self.lookup_field])
+        except ValueError:
+            raise Http404
+
+        # Stock and the version of the product, cached for a short time only
+        stock, updated_at, catalog_version = cache.get_stock(
+            pk, lambda: self.stock_or_404(pk)
+        )
+        version = int(updated_at.timestamp() * 1000000)
+        etag = f'"{pk}-{version}-{request.accepted_renderer.format}"'
+
+        return self.conditional_response(
+            request,
+            etag,
+            updated_at,
+            lambda: dict(
+                cache.get_detail(
+                    pk,
+                    catalog_version,
+                    lambda: self.retrieve_data(request, *args, **kwargs),
+                ),
+                stock=stock,
+            ),
+        )
+
+    def stock_or_404(self, pk):
+        stock = product_stock(pk)
+        if stock is None:
+            raise Http404
+        return stock
+
+    def conditional_response(self, request, etag, updated_at, load):
+        """
+        Answer with 304 if the client already has this version, otherwise
+        load and return the data. The body is never built for a 304.
+        """
+        last_modified = timegm(updated_at.utctimetuple())
+        response = get_conditional_response(
+            request, etag=etag, last_modified=last_modified
+        )
+        if response is None:
+            response = Response(load())
+
+        response.headers["ETag"] = etag
+        response.headers["Last-Modified"] = http_date(last_modified)
+        return response
+
+    def list_data(self, request, *args, **kwargs):
+        if not settings.PRODUCT_FAST_SERIALIZATION:
+            return super(ProductViewset, self).list(
+                request, *args, **kwargs
+            ).data
+
+        rows = self.list_rows.values(self.filter_queryset(self.get_queryset()))
+        page = self.paginate_queryset(rows)
+        return self.paginator.get_paginated_response(
+            self.list_rows.serialize(page)
+        ).data
+
+    def retrieve_data(self, request, *args, **kwargs):
+        if not settings.PRODUCT_FAST_SERIALIZATION:
+            return super(ProductViewset, self).retrieve(
+                request, *args, **kwargs
+            ).data
+
+        rows = self.detail_rows.values(
+            self.filter_queryset(self.get_queryset())
+        )
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+        row = get_object_or_404(
+            rows, **{self.lookup_field: self.kwargs[lookup_url_kwarg]}
+        )
+        return self.detail_rows.to_representation(row)
+
+    @action(detail=False)
+    def export(self, request):
+        """
+        Stream the whole catalog as a JSON array, or as NDJSON with
+        ?type=ndjson, gzipped for clients accepting it
+        """
+        export_format = request.query_params.get("type", "json")
+        if export_format not in EXPORT_FORMATS:
+            raise exceptions.ValidationError(
+                {"type": [f"Choose one of {', '.join(EXPORT_FORMATS)}."]}
+            )
+        compress = bool(
+            ACCEPTS_GZIP.search(request.headers.get("Accept-Encoding", ""))
+        )
+        response = export_response(export_format, compress)
+        patch_vary_headers(response, ["Accept-Encoding"])
+        return response
+
+    @action(detail=False, url_path="search")
+    def search(self, request):
+        """
+        Full-text search with range filters, returning the best matches, the
+        number of matches and facet counts
+        """
+        # A plain dict, so a missing in_stock is not read as an unticked
+        # checkbox
+        params = ProductSearchSerializer(data=request.query_params.dict())
+        params.is_valid(raise_exception=True)
+        search = ProductSearch(params.validated_data)
+        rows = add_shard_stock(search.results(self.detail_rows.fields))
+        return Response(
+            {
+                "count": search.count(),
+                "results": self.detail_rows.serialize(rows),
+                "facets": search.facets(),
+            }
+        )
+
+    @action(
+        detail=False,
+        url_path="cache-stats",
+        permission_classes=[IsAdminUser],
+    )
+    def cache_stats(self, request):
+        cache = get_product_cache()
+        return Response(cache.stats() if cache is not None else {})
+
+
+class DeliverySlotViewset(viewsets.ViewSet):
+    permission_classes = [AllowAny]
+
+    def list(self, request):
+        """
+        Upcoming delivery slots and the orders they can still take, read
+        from the slot table only
+        """
+        query = AvailabilityQuerySerializer(data=request.query_params)
+        query.is_valid(raise_exception=True)
+        config = settings.DELIVERY_SLOTS
+        days = query.validated_data.get("days", config["DEFAULT_DAYS"])
+
+        response = Response({"days": days, "slots": get_availability(days)})
+        patch_cache_control(
+            response, public=True, max_age=config["CACHE_TIMEOUT"]
+        )
+        return response
+
+
+class ProductImportView(APIView):
+    """
+    Create or update products from a CSV or NDJSON body, matched on name.
+
+    The body is read line by line and imported in batches, the answer
+    reports the created, updated and rejected rows and the throughput of
+    every batch.
+    """
+
+    permission_classes = [IsAdminUser]
+
+    def post(self, request):
+        formats = {media: name for name, media in IMPORT_FORMATS.items()}
+        import_format = formats.get(request.content_type.split(";")[0])
+        if import_format is None:
+            raise exceptions.UnsupportedMediaType(request.content_type)
+        if request.stream is None:
+            raise exceptions.ParseError("Empty feed.")
+
+        lines = codecs.iterdecode(request.stream, "utf-8-sig")
+        try:
+            report = ProductImporter().run(READERS[import_format](lines))
+        except UnicodeDecodeError:
+            raise exceptions.ParseError("The feed is not valid UTF-8.")
+        return Response(report.as_dict())
+
+
+def metrics(request):
+    """
+    Request metrics in the Prometheus text format, of every worker process
+    with METRICS["DIR"] set. Needs the METRICS["TOKEN"] bearer token.
+    """
+    token = settings.METRICS["TOKEN"]
+    authorization = request.headers.get("Authorization", "")
+    if not token or not constant_time_compare(
+        authorization, f"Bearer {token}"
+    ):
+        return HttpResponse(status=status.HTTP_401_UNAUTHORIZED)
+    return HttpResponse(
+        registry.render(), content_type="text/plain; version=0.0.4"
+    )
@@ -46,12 +46,15 @@ INSTALLED_APPS = [
     "django.contrib.sessions",
     "django.contrib.messages",
     "django.contrib.staticfiles",
+    "django.contrib.postgres",
     "autocompany.api",
     "rest_framework",
     "rest_framework.authtoken",
 ]
 
 MIDDLEWARE = [
+    # First, so its timings include the rest of the middleware
+    "autocompany.api.metrics.RequestMetricsMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -81,23 +84,44 @@ TEMPLATES = [
 
 WSGI_APPLICATION = "autocompany.wsgi.application"
 
+# "uwsgi" or "asgi", the server the Docker image runs the application with
+APPLICATION_SERVER = env.str('SERVER', default='uwsgi')
 
 
+# Hand out connections from a pool in each process, meant for ASGI where
+# connections can't persist across requests
+DB_POOL = env.bool('DB_POOL', default=False)
+
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.postgresql',
+        # The PostgreSQL backend with health checks and optional pooling
+        'ENGINE': 'autocompany.api.postgresql',
         'NAME': env.str('DB_NAME', 'postgres'),
         'USER': env.str('DB_USER', 'postgres'),
         'PASSWORD': env.str('DB_PASSWORD', 'postgres'),
         'HOST':  env.str('DB_HOST', 'db'),
         'PORT': env.str('DB_PORT', '5432'),
+        # Seconds a connection stays open across requests, 0 closes it
+        # when the request finishes
+        'CONN_MAX_AGE': env.int(
+            'DB_CONN_MAX_AGE',
+            default=0 if DB_POOL or APPLICATION_SERVER == 'asgi' else 60,
+        ),
+        'CONN_HEALTH_CHECKS': env.bool('DB_CONN_HEALTH_CHECKS', default=True),
+        'POOL': {
+            'MAX_SIZE': env.int('DB_POOL_MAX_SIZE', default=10),
+            'TIMEOUT': env.int('DB_POOL_TIMEOUT', default=10),
+        } if DB_POOL else None,
     }
 }
 
+# The startup check warns when opening a connection takes longer than this
+DB_SLOW_CONNECT_MS = env.int('DB_SLOW_CONNECT_MS', default=50)
+
 
 REST_FRAMEWORK = {
    'DEFAULT_AUTHENTICATION_CLASSES': (
-       'rest_framework.authentication.TokenAuthentication',
+       'autocompany.api.authentication.CachedTokenAuthentication',
    ),
    'DEFAULT_PERMISSION_CLASSES': (
         'rest_framework.permissions.IsAuthenticated',
@@ -105,6 +129,96 @@ REST_FRAMEWORK = {
    ),
 }
 
+# Serialize product reads straight from .values() rows instead of going
+# through the ModelSerializer fields, the output is the same
+PRODUCT_FAST_SERIALIZATION = env.bool(
+    'PRODUCT_FAST_SERIALIZATION', default=True
+)
+
+CACHES = {
+    'default': env.cache('CACHE_URL', default='locmemcache://'),
+}
+
+# Product catalog cache, BACKEND is "lru" for a cache inside each worker,
+# "django" to go through CACHES or empty to disable caching
+PRODUCT_CACHE = {
+    'BACKEND': env.str('PRODUCT_CACHE_BACKEND', default=''),
+    'CACHE_ALIAS': 'default',
+    'TIMEOUT': env.int('PRODUCT_CACHE_TIMEOUT', default=300),
+    'STOCK_TIMEOUT': env.int('PRODUCT_CACHE_STOCK_TIMEOUT', default=5),
+    'MAX_ENTRIES': env.int('PRODUCT_CACHE_MAX_ENTRIES', default=10000),
+}
+
+# Token to user lookups of CachedTokenAuthentication, BACKEND is "lru" for
+# a cache inside each worker or empty to disable caching. SHARED adds the
+# CACHES alias as a second tier shared by all workers.
+TOKEN_CACHE = {
+    'BACKEND': env.str('TOKEN_CACHE_BACKEND', default=''),
+    'SHARED': env.bool('TOKEN_CACHE_SHARED', default=False),
+    'CACHE_ALIAS': 'default',
+    'TIMEOUT': env.int('TOKEN_CACHE_TIMEOUT', default=30),
+    'SHARED_TIMEOUT': env.int('TOKEN_CACHE_SHARED_TIMEOUT', default=300),
+    'MAX_ENTRIES': env.int('TOKEN_CACHE_MAX_ENTRIES', default=10000),
+}
+
+# Background work of checkouts, run by manage.py run_checkout_worker. STEPS
+# are called with every ordered cart and must be idempotent. A failed job
+# is retried after RETRY_DELAY seconds, doubled for every attempt, up to
+# MAX_ATTEMPTS. Checkouts are refused with a 503 while MAX_PENDING jobs
+# wait, 0 lifts the limit.
+CHECKOUT_QUEUE = {
+    'STEPS': ['autocompany.api.checkout.confirm_order'],
+    'MAX_PENDING': env.int('CHECKOUT_QUEUE_MAX_PENDING', default=10000),
+    'RETRY_AFTER': env.int('CHECKOUT_QUEUE_RETRY_AFTER', default=5),
+    'MAX_ATTEMPTS': env.int('CHECKOUT_MAX_ATTEMPTS', default=5),
+    'RETRY_DELAY': env.int('CHECKOUT_RETRY_DELAY', default=10),
+    'LEASE_SECONDS': env.int('CHECKOUT_LEASE_SECONDS', default=300),
+    'BATCH_SIZE': env.int('CHECKOUT_BATCH_SIZE', default=100),
+    'POLL_INTERVAL': env.float('CHECKOUT_POLL_INTERVAL', default=1.0),
+}
+
+# Delivery slots, created by manage.py create_delivery_slots with CAPACITY
+# orders each. /api/delivery-slot/ lists the next DEFAULT_DAYS days, at
+# most MAX_DAYS, from the CACHE_ALIAS cache refreshed every CACHE_TIMEOUT
+# seconds.
+DELIVERY_SLOTS = {
+    'CAPACITY': env.int('DELIVERY_SLOT_CAPACITY', default=20),
+    'DEFAULT_DAYS': env.int('DELIVERY_SLOT_DEFAULT_DAYS', default=7),
+    'MAX_DAYS': env.int('DELIVERY_SLOT_MAX_DAYS', default=14),
+    'CACHE_ALIAS': 'default',
+    'CACHE_TIMEOUT': env.int('DELIVERY_SLOT_CACHE_TIMEOUT', default=10),
+}
+
+# Open carts hold the stock of their items for HOLD_SECONDS after their
+# last change, 0 only takes stock when the order is placed. sweep_carts
+# releases the holds which ran out and deletes open carts untouched for
+# OPEN_CART_DAYS, BATCH_SIZE carts at a time.
+CART_EXPIRY = {
+    'HOLD_SECONDS': env.int('CART_HOLD_SECONDS', default=0),
+    'OPEN_CART_DAYS': env.int('OPEN_CART_DAYS', default=30),
+    'BATCH_SIZE': env.int('CART_SWEEP_BATCH_SIZE', default=1000),
+}
+
+# /api/cart/batch/ accepts at most MAX_OPERATIONS cart operations per
+# request
+CART_BATCH = {
+    'MAX_OPERATIONS': env.int('CART_BATCH_MAX_OPERATIONS', default=100),
+}
+
+# Request metrics exposed on /metrics. Every request is counted and timed,
+# SAMPLE_RATE of them are broken down into SQL, serializer and render time
+# and answer with a Server-Timing header. With TOKEN set /metrics needs an
+# "Authorization: Bearer <token>" header.
+METRICS = {
+    'ENABLED': env.bool('METRICS_ENABLED', default=True),
+    'SAMPLE_RATE': env.float('METRICS_SAMPLE_RATE', default=0.01),
+    # /metrics answers no one while it is empty
+    'TOKEN': env.str('METRICS_TOKEN', default=''),
+    # Shared by the worker processes, /metrics then reports all of them
+    'DIR': env.str('METRICS_DIR', default=''),
+    'FLUSH_SECONDS': env.float('METRICS_FLUSH_SECONDS', default=1.0),
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.0/ref/settings/#auth-password-validators
@@ -7,14 +7,48 @@ from django.contrib import admin
 from django.conf.urls import include
 
 from rest_framework.routers import DefaultRouter
-from autocompany.api.views import CartViewset, ProductViewset
+from autocompany.api import async_views
+from autocompany.api.views import (
+    CartViewset,
+    DeliverySlotViewset,
+    ProductImportView,
+    ProductViewset,
+    metrics,
+)
 
 
 router = DefaultRouter()
 router.register(r"cart", CartViewset, basename="cart")
 router.register(r"product", ProductViewset, basename="product")
+router.register(
+    r"delivery-slot", DeliverySlotViewset, basename="delivery-slot"
+)
 
 urlpatterns = [
     path('admin/', admin.site.urls),
+    path("metrics", metrics, name="metrics"),
+    # Before the router, which would take "import" for a product pk
+    path(
+        "api/product/import/",
+        ProductImportView.as_view(),
+        name="product-import",
+    ),
     path("api/", include(router.urls)),
+    # Read endpoints served natively async when running under ASGI
+    path(
+        "api/async/product/",
+        async_views.product_list,
+        name="async-product-list",
+    ),
+    path(
+        "api/async/product/<int:pk>/",
+        async_views.product_retrieve,
+        name="async-product-detail",
+    ),
+    path("api/async/cart/", async_views.cart_list, name="async-cart-list"),
+    path(
+        "api/async/cart/<int:pk>/",
+        async_views.cart_retrieve,
+        name="async-cart-detail",
+    ),
 ]
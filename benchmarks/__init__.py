@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the shopping cart API.
+
+Each benchmark is a module that can be run from the project root, e.g.
+
+    $ python -m benchmarks.serializers --sizes 1000 10000
+
+They run against a throwaway test database created from the configured
+DATABASES settings, so they never touch real data.
+"""
+
+__author__ = "Surya Banerjee"
+
+import os
+import time
+from contextlib import contextmanager
+
+import django
+
+
+def setup():
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "autocompany.settings")
+    django.setup()
+
+
+@contextmanager
+def test_database():
+    from django.db import connection
+
+    old_name = connection.settings_dict["NAME"]
+    connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+def timed(func, repeat=3):
+    """
+    Run func `repeat` times, returning the best wall time and its result
+    """
+    best, result = None, None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def create_products(count, seed=0):
+    from autocompany.api.load_data import LoadDataGenerator
+    from autocompany.api.models import Product
+
+    Product.objects.all().delete()
+    return LoadDataGenerator(seed=seed).generate_products(count)
+
+
+def percentile(values, q):
+    """
+    Nearest rank percentile of a list of numbers, q between 0 and 100
+    """
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    rank = max(0, min(len(ordered) - 1, round(q / 100 * len(ordered)) - 1))
+    return ordered[rank]
+
+
+def summarize(latencies, elapsed, queries=None):
+    """
+    Latency percentiles in milliseconds, throughput in requests per second
+    and the average number of queries per request
+    """
+    summary = {
+        "requests": len(latencies),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+        "throughput_rps": round(len(latencies) / elapsed, 1),
+    }
+    if queries:
+        summary["queries"] = round(sum(queries) / len(queries), 2)
+    return summary
+
+
+def environment():
+    """
+    Describe where the numbers come from, latencies are only comparable
+    between runs on the same environment
+    """
+    import platform
+
+    from django.conf import settings
+    from django.db import connection
+
+    return {
+        "database": connection.vendor,
+        "python": platform.python_version(),
+        "product_cache": settings.PRODUCT_CACHE.get("BACKEND") or None,
+    }
+
+
+def find_regressions(results, baseline, tolerance=0.2):
+    """
+    Compare results with a baseline produced by the same benchmark.
+
+    Query counts must never grow, they are compared when both runs use the
+    same database, which may count statements like BEGIN the other one
+    does not. Latencies and throughput are only compared when both runs
+    come from the same environment, transport and options, with
+    `tolerance` as the allowed relative slowdown.
+    """
+    regressions = []
+    same_database = results.get("environment", {}).get(
+        "database"
+    ) == baseline.get("environment", {}).get("database")
+    same_environment = all(
+        results.get(key) == baseline.get(key)
+        for key in ("environment", "transport", "options")
+    )
+
+    for name, current in results["scenarios"].items():
+        previous = baseline.get("scenarios", {}).get(name)
+        if previous is None:
+            continue
+
+        more_queries = current.get("queries", 0) > previous.get("queries", 0)
+        if same_database and more_queries:
+            regressions.append(
+                f"{name}: {current['queries']} queries per request, "
+                f"baseline {previous['queries']}"
+            )
+        if not same_environment:
+            continue
+
+        for key in ("p50_ms", "p95_ms", "p99_ms"):
+            if current[key] > previous[key] * (1 + tolerance):
+                regressions.append(
+                    f"{name}: {key} {current[key]}, baseline {previous[key]}"
+                )
+        limit = previous["throughput_rps"] * (1 - tolerance)
+        if current["throughput_rps"] < limit:
+            regressions.append(
+                f"{name}: {current['throughput_rps']} requests/s, "
+                f"baseline {previous['throughput_rps']}"
+            )
+    return regressions
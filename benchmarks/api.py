@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+"""
+Latency, throughput and query counts of the product and cart API.
+
+    $ python -m benchmarks.api --sizes 1000 10000
+    $ python -m benchmarks.api --transport uwsgi --processes 2
+
+Scenarios:
+
+* product list and detail at every catalog size
+* cart creation with 1, 10 and 100 items
+* checkout and reversal of carts with 10 items
+* concurrent checkouts of the same product
+
+Results are compared with benchmarks/baseline.json and the command exits
+with an error if any scenario regressed. Use --update-baseline to record
+a new baseline.
+"""
+
+__author__ = "Surya Banerjee"
+
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+from contextlib import nullcontext
+from pathlib import Path
+
+from benchmarks import (
+    setup,
+    test_database,
+    create_products,
+    summarize,
+    environment,
+    find_regressions,
+)
+from benchmarks.clients import WSGIClient, HTTPClient, run_uwsgi
+
+BASELINE = Path(__file__).resolve().parent / "baseline.json"
+
+
+class Runner:
+    def __init__(self, make_client, requests, concurrency):
+        self.make_client = make_client
+        self.requests = requests
+        self.concurrency = concurrency
+        self.results = {}
+        self._local = threading.local()
+
+    def client(self):
+        if not hasattr(self._local, "client"):
+            self._local.client = self.make_client()
+        return self._local.client
+
+    def run(self, name, make_request, requests=None, concurrency=None):
+        """
+        Call make_request(client, i) for every request, in parallel when
+        concurrency is above one, and record the latency of each call
+        """
+        requests = requests or self.requests
+        concurrency = concurrency or 1
+        latencies, queries = [], []
+
+        def call(i):
+            start = time.perf_counter()
+            status, _, query_count = make_request(self.client(), i)
+            latency = time.perf_counter() - start
+            if status >= 400:
+                raise RuntimeError(f"{name}: request {i} failed ({status})")
+            latencies.append(latency)
+            if query_count is not None:
+                queries.append(query_count)
+
+        indexes = iter(range(requests))
+        lock = threading.Lock()
+        errors = []
+
+        def worker():
+            from django.db import connections
+
+            try:
+                while not errors:
+                    with lock:
+                        i = next(indexes, None)
+                    if i is None:
+                        return
+                    call(i)
+            except Exception as error:
+                errors.append(error)
+            finally:
+                # Leave no connection behind, the test database is dropped
+                if threading.current_thread() is not threading.main_thread():
+                    connections.close_all()
+
+        start = time.perf_counter()
+        if concurrency == 1:
+            worker()
+        else:
+            threads = [
+                threading.Thread(target=worker) for _ in range(concurrency)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        elapsed = time.perf_counter() - start
+        if errors:
+            raise errors[0]
+
+        self.results[name] = summarize(latencies, elapsed, queries)
+        print(f"{name:<30}{json.dumps(self.results[name])}")
+
+
+def product_scenarios(runner, size):
+    from autocompany.api.models import Product
+
+    create_products(size)
+    pks = list(Product.objects.values_list("pk", flat=True))
+    rng = random.Random(size)
+
+    runner.run(
+        f"product_list_{size}",
+        lambda client, i: client.request("GET", "/api/product/"),
+    )
+    runner.run(
+        f"product_detail_{size}",
+        lambda client, i: client.request(
+            "GET", f"/api/product/{rng.choice(pks)}/"
+        ),
+    )
+
+
+def open_carts(user, product_pks, count, items):
+    """
+    Create open carts straight in the database, outside the timed part
+    """
+    from autocompany.api.models import Cart, CartItem
+
+    carts = Cart.objects.bulk_create(Cart(user=user) for _ in range(count))
+    if not carts or carts[0].pk is None:
+        carts = list(Cart.objects.filter(user=user).order_by("-pk")[:count])
+    CartItem.objects.bulk_create(
+        CartItem(cart=cart, product_id=pk, quantity=1)
+        for cart in carts
+        for pk in product_pks[:items]
+    )
+    return [cart.pk for cart in carts]
+
+
+def cart_scenarios(runner, user, concurrency):
+    from autocompany.api.models import Product
+
+    Product.objects.update(stock=10 ** 6)
+    pks = list(Product.objects.values_list("pk", flat=True)[:100])
+
+    for items in (1, 10, 100):
+        data = {
+            "items": [{"product": pk, "quantity": 1} for pk in pks[:items]]
+        }
+        runner.run(
+            f"cart_create_{items}",
+            lambda client, i: client.request("POST", "/api/cart/", data),
+        )
+
+    cart_pks = open_carts(user, pks, runner.requests, 10)
+    runner.run(
+        "checkout_10",
+        lambda client, i: client.request(
+            "PATCH", f"/api/cart/{cart_pks[i]}/", {"order_completed": True}
+        ),
+    )
+    runner.run(
+        "checkout_reverse_10",
+        lambda client, i: client.request(
+            "PATCH", f"/api/cart/{cart_pks[i]}/", {"order_completed": False}
+        ),
+    )
+
+    # Everyone checks out the same product, the last unit must not oversell
+    hot_pk = pks[0]
+    Product.objects.filter(pk=hot_pk).update(stock=runner.requests)
+    cart_pks = open_carts(user, [hot_pk], runner.requests, 1)
+    runner.run(
+        "concurrent_checkout_same_sku",
+        lambda client, i: client.request(
+            "PATCH", f"/api/cart/{cart_pks[i]}/", {"order_completed": True}
+        ),
+        concurrency=concurrency,
+    )
+    stock = Product.objects.get(pk=hot_pk).stock
+    if stock != 0:
+        raise RuntimeError(f"Hot product ended with stock {stock}, not 0")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000])
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument(
+        "--transport", choices=["wsgi", "uwsgi"], default="wsgi"
+    )
+    parser.add_argument("--processes", type=int, default=2)
+    parser.add_argument("--output", help="Write the results to this file")
+    parser.add_argument("--baseline", default=str(BASELINE))
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="Allowed relative slowdown against the baseline",
+    )
+    args = parser.parse_args()
+
+    setup()
+
+    from rest_framework.authtoken.models import Token
+
+    from autocompany.api.load_data import LoadDataGenerator
+
+    with test_database():
+        user_pk = LoadDataGenerator().generate_users(1)[0]
+        token = Token.objects.get(user_id=user_pk)
+
+        server = (
+            run_uwsgi(args.processes)
+            if args.transport == "uwsgi" else nullcontext()
+        )
+        with server as base_url:
+            if base_url:
+                def make_client():
+                    return HTTPClient(base_url, token.key)
+            else:
+                def make_client():
+                    return WSGIClient(token.key)
+
+            runner = Runner(make_client, args.requests, args.concurrency)
+            for size in args.sizes:
+                product_scenarios(runner, size)
+            cart_scenarios(runner, token.user, args.concurrency)
+
+    results = {
+        "transport": args.transport,
+        "options": {
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+        },
+        "environment": environment(),
+        "scenarios": runner.results,
+    }
+    if args.output:
+        Path(args.output).write_text(json.dumps(results, indent=2) + "\n")
+
+    if args.update_baseline:
+        Path(args.baseline).write_text(json.dumps(results, indent=2) + "\n")
+        print(f"Baseline written to {args.baseline}")
+        return
+
+    baseline_path = Path(args.baseline)
+    if not baseline_path.exists():
+        print("No baseline to compare with")
+        return
+
+    regressions = find_regressions(
+        results, json.loads(baseline_path.read_text()), args.tolerance
+    )
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    if regressions:
+        sys.exit(1)
+    print("No regressions against the baseline")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""
+Throughput of the sync API under uWSGI against the async API under uvicorn
+as the number of concurrent connections grows.
+
+    $ python -m benchmarks.asgi --workers 2 --connections 1 16 64
+
+Both servers run with the same number of worker processes against the
+same throwaway database. Every scenario is run at each connection count:
+
+* product detail, /api/product/<pk>/ against /api/async/product/<pk>/
+* product list, /api/product/ against /api/async/product/
+* cart list of a user, /api/cart/ against /api/async/cart/
+
+The product cache is disabled so every request reaches the database.
+"""
+
+__author__ = "Surya Banerjee"
+
+import argparse
+import json
+import os
+import random
+from pathlib import Path
+
+from benchmarks import setup, test_database, create_products, environment
+from benchmarks.clients import HTTPClient, run_uwsgi, run_uvicorn
+
+SERVERS = {
+    "uwsgi": (run_uwsgi, ""),
+    "uvicorn": (run_uvicorn, "/async"),
+}
+
+
+def run_scenarios(runner, prefix, product_pks, connections):
+    rng = random.Random(0)
+    for count in connections:
+        runner.run(
+            f"product_detail_c{count}",
+            lambda client, i: client.request(
+                "GET", f"/api{prefix}/product/{rng.choice(product_pks)}/"
+            ),
+            concurrency=count,
+        )
+        runner.run(
+            f"product_list_c{count}",
+            lambda client, i: client.request("GET", f"/api{prefix}/product/"),
+            concurrency=count,
+        )
+        runner.run(
+            f"cart_list_c{count}",
+            lambda client, i: client.request("GET", f"/api{prefix}/cart/"),
+            concurrency=count,
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument("--size", type=int, default=10000)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument(
+        "--connections", type=int, nargs="+", default=[1, 16, 64]
+    )
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument(
+        "--servers", nargs="+", choices=list(SERVERS), default=list(SERVERS)
+    )
+    parser.add_argument("--output", help="Write the results to this file")
+    args = parser.parse_args()
+
+    # The servers inherit the environment, measure the database not the cache
+    os.environ["PRODUCT_CACHE_BACKEND"] = ""
+    setup()
+
+    from rest_framework.authtoken.models import Token
+
+    from benchmarks.api import Runner, open_carts
+    from autocompany.api.load_data import LoadDataGenerator
+
+    results = {}
+    with test_database():
+        product_pks = create_products(args.size)
+        user_pk = LoadDataGenerator().generate_users(1)[0]
+        token = Token.objects.get(user_id=user_pk)
+        open_carts(token.user, product_pks, 10, 10)
+
+        for name in args.servers:
+            run, prefix = SERVERS[name]
+            print(f"{name} with {args.workers} workers")
+            with run(args.workers) as base_url:
+                runner = Runner(
+                    lambda: HTTPClient(base_url, token.key),
+                    args.requests,
+                    1,
+                )
+                run_scenarios(runner, prefix, product_pks, args.connections)
+            results[name] = runner.results
+
+    print(f"\n{'scenario':<25}" + "".join(f"{n:>12}" for n in results))
+    for scenario in next(iter(results.values())):
+        print(
+            f"{scenario:<25}"
+            + "".join(
+                f"{server[scenario]['throughput_rps']:>10.0f}/s"
+                for server in results.values()
+            )
+        )
+
+    if args.output:
+        Path(args.output).write_text(
+            json.dumps(
+                {
+                    "options": {
+                        "size": args.size,
+                        "requests": args.requests,
+                        "workers": args.workers,
+                    },
+                    "environment": environment(),
+                    "servers": results,
+                },
+                indent=2,
+            )
+            + "\n"
+        )
+
+
+if __name__ == "__main__":
+    main()
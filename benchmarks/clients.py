@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+"""
+HTTP clients used by the API benchmarks.
+
+`WSGIClient` calls the Django WSGI application in-process and counts the
+queries of every request. `HTTPClient` talks to a real server, such as
+the uWSGI one started by `run_uwsgi` or the ASGI one started by
+`run_uvicorn`.
+"""
+
+__author__ = "Surya Banerjee"
+
+import json
+import os
+import socket
+import subprocess
+import time
+import urllib.error
+import urllib.request
+from contextlib import contextmanager
+
+
+class WSGIClient:
+    transport = "wsgi"
+
+    def __init__(self, token=None):
+        from django.test import Client
+
+        headers = {"HTTP_AUTHORIZATION": f"Token {token}"} if token else {}
+        self.client = Client(**headers)
+
+    def request(self, method, path, data=None):
+        """
+        Return the status, decoded body and number of queries of a request
+        """
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        # The query log is capped, keep it from filling up over a long run
+        connection.queries_log.clear()
+        with CaptureQueriesContext(connection) as queries:
+            response = getattr(self.client, method.lower())(
+                path,
+                json.dumps(data) if data is not None else None,
+                content_type="application/json",
+            )
+        body = json.loads(response.content) if response.content else None
+        return response.status_code, body, len(queries)
+
+
+class HTTPClient:
+    transport = "http"
+
+    def __init__(self, base_url, token=None):
+        self.base_url = base_url.rstrip("/")
+        self.headers = {"Content-Type": "application/json"}
+        if token:
+            self.headers["Authorization"] = f"Token {token}"
+
+    def request(self, method, path, data=None):
+        request = urllib.request.Request(
+            self.base_url + path,
+            data=json.dumps(data).encode() if data is not None else None,
+            headers=self.headers,
+            method=method.upper(),
+        )
+        try:
+            with urllib.request.urlopen(request) as response:
+                status, content = response.status, response.read()
+        except urllib.error.HTTPError as error:
+            status, content = error.code, error.read()
+        body = json.loads(content) if content else None
+        return status, body, None
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_server(url, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen(url).close()
+            return
+        except (urllib.error.URLError, ConnectionError):
+            time.sleep(0.2)
+    raise RuntimeError(f"Server at {url} did not come up")
+
+
+@contextmanager
+def run_server(command, port, env=None):
+    """
+    Start a server process for the current test database and stop it again
+    """
+    from django.db import connection
+
+    env = dict(os.environ, **(env or {}))
+    # Point the server at the throwaway database of this benchmark run
+    env["DB_NAME"] = connection.settings_dict["NAME"]
+    process = subprocess.Popen(command, env=env)
+    try:
+        wait_for_server(f"http://127.0.0.1:{port}/api/product/")
+        yield f"http://127.0.0.1:{port}"
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def run_uwsgi(processes=2, port=None):
+    """
+    Start uWSGI the way the Dockerfile does
+    """
+    port = port or free_port()
+    return run_server(
+        [
+            "uwsgi",
+            "--http", f"127.0.0.1:{port}",
+            "--processes", str(processes),
+            "--module", "autocompany.wsgi:application",
+            "--master",
+            "--die-on-term",
+            "--disable-logging",
+        ],
+        port,
+    )
+
+
+def run_uvicorn(workers=2, port=None):
+    """
+    Start uvicorn the way the Dockerfile does with SERVER=asgi
+    """
+    port = port or free_port()
+    return run_server(
+        [
+            "uvicorn",
+            "autocompany.asgi:application",
+            "--host", "127.0.0.1",
+            "--port", str(port),
+            "--workers", str(workers),
+            "--no-access-log",
+        ],
+        port,
+    )
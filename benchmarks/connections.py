@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+"""
+Connection churn and latency of the API with each connection option.
+
+    $ python -m benchmarks.connections --requests 500 --concurrency 1 8
+
+Options:
+
+* close, a new connection for every request (CONN_MAX_AGE = 0)
+* persistent, connections kept across requests (CONN_MAX_AGE = 60)
+* health_checks, persistent connections checked once per request
+* pooled, connections handed back to a pool after every request
+
+Health checks and the pool come with the project PostgreSQL backend, on
+other databases only the first two options are run. Requests go through
+the WSGI application in-process, opening and closing connections at the
+same points as under a server.
+"""
+
+__author__ = "Surya Banerjee"
+
+import argparse
+import json
+import os
+import random
+from pathlib import Path
+
+from benchmarks import setup, test_database, create_products, environment
+
+OPTIONS = {
+    "close": {"CONN_MAX_AGE": 0},
+    "persistent": {"CONN_MAX_AGE": 60},
+    "health_checks": {"CONN_MAX_AGE": 60, "CONN_HEALTH_CHECKS": True},
+    "pooled": {
+        "CONN_MAX_AGE": 0,
+        "CONN_HEALTH_CHECKS": True,
+        "POOL": {"MAX_SIZE": 32},
+    },
+}
+
+
+def server_client():
+    """
+    The Django test client keeps connections open across requests, this
+    one closes old connections at request boundaries like the handler of
+    a real server does
+    """
+    from django.db import close_old_connections
+
+    from benchmarks.clients import WSGIClient
+
+    class ServerWSGIClient(WSGIClient):
+        def request(self, method, path, data=None):
+            close_old_connections()
+            try:
+                return super().request(method, path, data)
+            finally:
+                close_old_connections()
+
+    return ServerWSGIClient()
+
+
+def supported_options(connection):
+    if connection.settings_dict["ENGINE"] == "autocompany.api.postgresql":
+        return list(OPTIONS)
+    return ["close", "persistent"]
+
+
+def apply_option(connection, name):
+    from autocompany.api.postgresql.base import close_idle_connections
+
+    connection.close()
+    close_idle_connections()
+    connection.settings_dict.update(
+        {"CONN_MAX_AGE": 0, "CONN_HEALTH_CHECKS": False, "POOL": None}
+    )
+    connection.settings_dict.update(OPTIONS[name])
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument("--size", type=int, default=1000)
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument(
+        "--concurrency", type=int, nargs="+", default=[1, 8]
+    )
+    parser.add_argument(
+        "--options", nargs="+", choices=list(OPTIONS), default=None
+    )
+    parser.add_argument("--output", help="Write the results to this file")
+    args = parser.parse_args()
+
+    # Every request should reach the database
+    os.environ["PRODUCT_CACHE_BACKEND"] = ""
+    os.environ["TOKEN_CACHE_BACKEND"] = ""
+    setup()
+
+    from django.db import connection
+    from django.db.backends.signals import connection_created
+
+    from benchmarks.api import Runner
+
+    opened = []
+    connection_created.connect(lambda **kwargs: opened.append(1), weak=False)
+
+    results = {}
+    with test_database():
+        product_pks = create_products(args.size)
+        rng = random.Random(0)
+
+        for name in args.options or supported_options(connection):
+            if name not in supported_options(connection):
+                print(f"{name}: needs the project PostgreSQL backend")
+                continue
+            for concurrency in args.concurrency:
+                apply_option(connection, name)
+                opened.clear()
+                runner = Runner(server_client, args.requests, concurrency)
+                scenario = f"{name}_c{concurrency}"
+                runner.run(
+                    scenario,
+                    lambda client, i: client.request(
+                        "GET", f"/api/product/{rng.choice(product_pks)}/"
+                    ),
+                    concurrency=concurrency,
+                )
+                result = runner.results[scenario]
+                result["connections_opened"] = len(opened)
+                results[scenario] = result
+                print(f"{'':<30}{len(opened)} connections opened")
+        apply_option(connection, "close")
+
+    if args.output:
+        Path(args.output).write_text(
+            json.dumps(
+                {
+                    "options": {"size": args.size, "requests": args.requests},
+                    "environment": environment(),
+                    "scenarios": results,
+                },
+                indent=2,
+            )
+            + "\n"
+        )
+
+
+if __name__ == "__main__":
+    main()
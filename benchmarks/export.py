@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""
+Peak memory and throughput of the catalog export against building the
+whole body in memory, as the catalog grows.
+
+    $ python -m benchmarks.export --sizes 10000 100000 1000000
+
+Peak memory is what tracemalloc sees allocated by Python while the body
+is produced and thrown away, database driver buffers outside of Python
+are not included. The streaming export should stay flat across sizes.
+"""
+
+__author__ = "Surya Banerjee"
+
+import argparse
+import time
+import tracemalloc
+
+from benchmarks import setup, test_database, create_products
+
+
+def profile(produce):
+    """
+    Run produce, returning its wall time, peak memory and body size
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        size = sum(len(chunk) for chunk in produce())
+        elapsed = time.perf_counter() - start
+        return elapsed, tracemalloc.get_traced_memory()[1], size
+    finally:
+        tracemalloc.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[10000, 100000, 1000000]
+    )
+    parser.add_argument("--chunk-size", type=int, default=2000)
+    parser.add_argument(
+        "--streaming-only",
+        action="store_true",
+        help="Skip the in-memory body, which needs memory for every row",
+    )
+    args = parser.parse_args()
+
+    setup()
+
+    from rest_framework.renderers import JSONRenderer
+
+    from autocompany.api.export import detail_rows, export_catalog, export_rows
+    from autocompany.api.models import Product
+
+    def materialized():
+        rows = detail_rows.values(Product.objects.order_by("pk"))
+        return [JSONRenderer().render(detail_rows.serialize(rows))]
+
+    paths = {
+        "json": lambda: export_catalog(
+            "json", rows=export_rows(args.chunk_size)
+        ),
+        "ndjson+gzip": lambda: export_catalog(
+            "ndjson", True, export_rows(args.chunk_size)
+        ),
+    }
+    if not args.streaming_only:
+        paths["in memory"] = materialized
+
+    print(f"{'path':<14}{'products':>10}{'peak MB':>10}{'body MB':>10}"
+          f"{'rows/s':>10}")
+    with test_database():
+        for size in args.sizes:
+            create_products(size)
+            for name, produce in paths.items():
+                elapsed, peak, body = profile(produce)
+                print(
+                    f"{name:<14}{size:>10}{peak / 2 ** 20:>10.1f}"
+                    f"{body / 2 ** 20:>10.1f}{size / elapsed:>10.0f}"
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""
+Compare the ModelSerializer and the .values() row serializer paths for the
+product endpoints, from query to rendered JSON bytes.
+
+    $ python -m benchmarks.serializers --sizes 1000 10000 100000
+"""
+
+__author__ = "Surya Banerjee"
+
+import argparse
+
+from benchmarks import setup, test_database, timed, create_products
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[1000, 10000, 100000]
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    setup()
+
+    from rest_framework.renderers import JSONRenderer
+
+    from autocompany.api.fast_serializers import ValuesSerializer
+    from autocompany.api.models import Product
+    from autocompany.api.serializers import (
+        ProductListSerializer,
+        ProductDetailSerializer,
+    )
+
+    renderer = JSONRenderer()
+
+    def model_path(serializer_class):
+        fields = serializer_class.Meta.fields
+        queryset = Product.objects.only(*fields).order_by("pk")
+        return renderer.render(serializer_class(queryset, many=True).data)
+
+    def values_path(serializer_class):
+        rows = ValuesSerializer(serializer_class)
+        queryset = rows.values(Product.objects.order_by("pk"))
+        return renderer.render(rows.serialize(queryset))
+
+    print(f"{'serializer':<26}{'products':>10}{'model':>10}{'values':>10}"
+          f"{'speedup':>9}")
+    with test_database():
+        for size in args.sizes:
+            create_products(size)
+            for serializer_class in (
+                ProductListSerializer,
+                ProductDetailSerializer,
+            ):
+                slow, expected = timed(
+                    lambda: model_path(serializer_class), args.repeat
+                )
+                fast, output = timed(
+                    lambda: values_path(serializer_class), args.repeat
+                )
+                assert output == expected, "outputs differ"
+                print(
+                    f"{serializer_class.__name__:<26}{size:>10}"
+                    f"{slow * 1000:>8.1f}ms{fast * 1000:>8.1f}ms"
+                    f"{slow / fast:>8.1f}x"
+                )
+
+
+if __name__ == "__main__":
+    main()
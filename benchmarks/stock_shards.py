@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+Throughput of concurrent checkouts of a single product as its stock is
+spread over more shards.
+
+    $ python -m benchmarks.stock_shards --shards 0 2 8 32 --concurrency 32
+
+Every request orders an open cart holding one unit of the same product,
+through PATCH /api/cart/<pk>/. With 0 shards they all queue on the lock of
+the product row, with K shards up to K of them can hold a lock at once.
+The product has exactly one unit per request, so the run also checks that
+the last units are not oversold when shards run dry.
+
+Only PostgreSQL shows the effect, SQLite locks the whole database for
+every write whatever the number of shards.
+"""
+
+__author__ = "Surya Banerjee"
+
+import argparse
+import json
+from contextlib import nullcontext
+from pathlib import Path
+
+from benchmarks import setup, test_database, environment
+from benchmarks.api import Runner, open_carts
+from benchmarks.clients import WSGIClient, HTTPClient, run_uwsgi
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument(
+        "--shards", type=int, nargs="+", default=[0, 2, 8, 32]
+    )
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument(
+        "--transport", choices=["wsgi", "uwsgi"], default="wsgi"
+    )
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--output", help="Write the results to this file")
+    args = parser.parse_args()
+
+    setup()
+
+    from rest_framework.authtoken.models import Token
+
+    from autocompany.api.load_data import LoadDataGenerator
+    from autocompany.api.models import Product, StockShard
+    from autocompany.api.stock import set_stock_shards
+
+    with test_database():
+        generator = LoadDataGenerator()
+        user_pk = generator.generate_users(1)[0]
+        token = Token.objects.get(user_id=user_pk)
+        hot_pk = generator.generate_products(1)[0]
+
+        server = (
+            run_uwsgi(args.processes)
+            if args.transport == "uwsgi" else nullcontext()
+        )
+        with server as base_url:
+            if base_url:
+                def make_client():
+                    return HTTPClient(base_url, token.key)
+            else:
+                def make_client():
+                    return WSGIClient(token.key)
+
+            runner = Runner(make_client, args.requests, args.concurrency)
+            for shards in args.shards:
+                Product.objects.filter(pk=hot_pk).update(
+                    stock=args.requests
+                )
+                set_stock_shards(hot_pk, shards)
+                cart_pks = open_carts(
+                    token.user, [hot_pk], args.requests, 1
+                )
+                runner.run(
+                    f"checkout_same_sku_k{shards}",
+                    lambda client, i: client.request(
+                        "PATCH",
+                        f"/api/cart/{cart_pks[i]}/",
+                        {"order_completed": True},
+                    ),
+                    concurrency=args.concurrency,
+                )
+
+                left = Product.objects.get(pk=hot_pk).stock + sum(
+                    StockShard.objects.filter(product_id=hot_pk)
+                    .values_list("stock", flat=True)
+                )
+                if left != 0:
+                    raise RuntimeError(
+                        f"{shards} shards: stock ended at {left}, not 0"
+                    )
+
+    if args.output:
+        Path(args.output).write_text(
+            json.dumps(
+                {
+                    "transport": args.transport,
+                    "options": {
+                        "requests": args.requests,
+                        "concurrency": args.concurrency,
+                    },
+                    "environment": environment(),
+                    "scenarios": runner.results,
+                },
+                indent=2,
+            )
+            + "\n"
+        )
+
+
+if __name__ == "__main__":
+    main()